@@ -2,7 +2,6 @@ import logging
 from logging.handlers import SMTPHandler, RotatingFileHandler
 import os
 from flask import Flask, request
-from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_login import LoginManager
 from flask_mail import Mail
@@ -10,10 +9,15 @@ from flask_bootstrap import Bootstrap
 from flask_moment import Moment
 from flask_babel import Babel, lazy_gettext as _l
 from config import Config
+from app import database
 
 app = Flask(__name__)
 app.config.from_object(Config)
-db = SQLAlchemy(app)
+app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS',
+                      database.engine_options(app.config))
+db = database.RoutingSQLAlchemy(app)
+app.before_request(database.route_reads)
+app.after_request(database.remember_writes)
 migrate = Migrate(app, db)
 login = LoginManager(app)
 login.login_view = 'login'
@@ -0,0 +1,84 @@
+import atexit
+import threading
+from datetime import datetime
+from time import monotonic
+from sqlalchemy import case
+from app import app, db
+from app.cache import TTLCache
+from app.models import User
+
+
+## Write-behind buffer for User.last_seen. Requests only record a timestamp
+## in memory; pending timestamps are written with a single UPDATE once the
+## buffer is big enough or old enough, and once more when the worker exits.
+
+class ActivityTracker(object):
+    def __init__(self):
+        self.pending = {}
+        self.recent = None
+        self.last_flush = monotonic()
+        self.lock = threading.Lock()
+        self.flusher = None
+        self.stopping = threading.Event()
+
+    def touch(self, user_id, when=None):
+        """Record activity; returns False if it falls inside the resolution
+        window of the last recorded timestamp for this user."""
+        when = when or datetime.utcnow()
+        with self.lock:
+            if self.recent is None:
+                self.recent = TTLCache(
+                    maxsize=app.config['LAST_SEEN_CACHE_SIZE'],
+                    ttl=app.config['LAST_SEEN_RESOLUTION'])
+            if self.recent.get(user_id) is not None:
+                return False
+            self.recent.set(user_id, when)
+            self.pending[user_id] = when
+            due = len(self.pending) >= app.config['LAST_SEEN_FLUSH_SIZE'] \
+                or monotonic() - self.last_flush >= \
+                app.config['LAST_SEEN_FLUSH_INTERVAL']
+            self.start_flusher()
+        if due:
+            self.flush()
+        return True
+
+    def flush(self):
+        """Write every pending timestamp; returns the number of users."""
+        with self.lock:
+            batch, self.pending = self.pending, {}
+            self.last_flush = monotonic()
+        if not batch:
+            return 0
+        users = User.__table__
+        ## Own connection, so a flush never joins a request's transaction
+        with db.engine.begin() as connection:
+            connection.execute(users.update().where(
+                users.c.id.in_(list(batch))).values(
+                    last_seen=case(batch, value=users.c.id)))
+        return len(batch)
+
+    def start_flusher(self):
+        ## Started lazily so each forked worker gets its own thread
+        if self.flusher is None or not self.flusher.is_alive():
+            self.flusher = threading.Thread(target=self.run,
+                                            name='last-seen-flusher',
+                                            daemon=True)
+            self.flusher.start()
+
+    def run(self):
+        while not self.stopping.wait(app.config['LAST_SEEN_FLUSH_INTERVAL']):
+            try:
+                self.flush()
+            except Exception:
+                app.logger.exception('Could not flush last_seen updates')
+
+    def shutdown(self):
+        self.stopping.set()
+        try:
+            self.flush()
+        except Exception:
+            app.logger.exception('Could not flush last_seen updates')
+
+
+tracker = ActivityTracker()
+atexit.register(tracker.shutdown)
@@ -0,0 +1,181 @@
+import numpy as np
+from sqlalchemy import select
+from app import app, db
+from app.cache import TTLCache
+from app.models import Item, Account, Transaction, RenameRule, \
+    UNCATEGORIZED
+
+
+## Columnar, vectorized analytics over one user's transaction history. Rows
+## are loaded with a column-only query straight into NumPy arrays, never as
+## ORM objects. Amounts keep Plaid's sign: positive is money out, so "spend"
+## below only counts positive amounts.
+
+class TransactionFrame(object):
+    def __init__(self, dates, amounts, category_codes, categories,
+                 account_codes, accounts, merchant_codes, merchants,
+                 balances):
+        self.dates = dates
+        self.amounts = amounts
+        self.category_codes = category_codes
+        self.categories = categories
+        self.account_codes = account_codes
+        self.accounts = accounts
+        self.merchant_codes = merchant_codes
+        self.merchants = merchants
+        ## Current balance of each account, aligned with `accounts`
+        self.balances = balances
+        self.results = {}
+
+    def __len__(self):
+        return len(self.amounts)
+
+    @classmethod
+    def load(cls, user_id):
+        accounts = select(Account.id).join(Item).where(
+            Item.user_id == user_id, Item.deleted_at.is_(None))
+        ## Core rows on the session's connection skip the ORM loading layer
+        rows = db.session.connection().execute(select(
+            db.func.date(Transaction.date), Transaction.amount,
+            db.func.coalesce(Transaction.category_name, UNCATEGORIZED),
+            Transaction.account_id,
+            db.func.coalesce(Transaction.new_name, Transaction.original_name,
+                             '')).where(
+                Transaction.account_id.in_(accounts),
+                Transaction.date.isnot(None))).fetchall()
+        columns = list(zip(*rows)) or [()] * 5
+        categories, category_codes = unique(columns[2])
+        account_ids, account_codes = unique(columns[3])
+        merchants, merchant_codes = unique(columns[4])
+        current = dict(db.session.query(Account.id, Account.current_balance)
+                       .filter(Account.id.in_(accounts)))
+        balances = np.array([current.get(a) or 0.0 for a in account_ids],
+                            dtype=float)
+        return cls(np.array(columns[0], dtype='datetime64[D]'),
+                   np.array(columns[1], dtype=float), category_codes,
+                   categories, account_codes, account_ids, merchant_codes,
+                   merchants, balances)
+
+    def memoized(self, key, compute):
+        if key not in self.results:
+            self.results[key] = compute()
+        return self.results[key]
+
+    def month_index(self):
+        ## Every month from the first transaction to the last, and each
+        ## row's position in that range
+        months = self.dates.astype('datetime64[M]')
+        if not len(months):
+            return np.array([], dtype='datetime64[M]'), np.array([], int)
+        first = months.min()
+        span = np.arange(first, months.max() + 1)
+        return span, (months - first).astype(int)
+
+    def spend(self):
+        return np.where(self.amounts > 0, self.amounts, 0.0)
+
+    def monthly_spend_by_category(self):
+        """Returns (months, categories, totals) with totals[month, category]."""
+        def compute():
+            months, codes = self.month_index()
+            width = len(self.categories)
+            totals = np.bincount(codes * width + self.category_codes,
+                                 weights=self.spend(),
+                                 minlength=len(months) * width)
+            return months, self.categories, totals.reshape(len(months),
+                                                           width)
+        return self.memoized('monthly_spend_by_category', compute)
+
+    def month_over_month(self):
+        """Returns (months, totals, deltas, ratios) of total monthly spend;
+        the first month's delta and ratio are NaN."""
+        def compute():
+            months, _, totals = self.monthly_spend_by_category()
+            totals = totals.sum(axis=1)
+            deltas = np.concatenate(([np.nan], np.diff(totals)))
+            previous = np.concatenate(([np.nan], totals[:-1]))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                ratios = np.where(previous > 0, deltas / previous, np.nan)
+            return months, totals, deltas, ratios
+        return self.memoized('month_over_month', compute)
+
+    def running_balances(self):
+        """Returns {account_id: (dates, balances)}, the balance after each
+        transaction, worked back from the account's current balance."""
+        def compute():
+            order = np.lexsort((self.dates, self.account_codes))
+            codes = self.account_codes[order]
+            amounts = self.amounts[order]
+            ## Everything spent after a row is added back onto today's
+            ## balance: balance_i = current + sum(amounts after i)
+            spent = np.cumsum(amounts)
+            ends = np.searchsorted(codes, np.arange(len(self.accounts)),
+                                   side='right')
+            after = spent[ends - 1][codes] - spent
+            balances = self.balances[codes] + after
+            starts = np.searchsorted(codes, np.arange(len(self.accounts)))
+            dates = self.dates[order]
+            return {account: (dates[start:end], balances[start:end])
+                    for account, start, end in zip(self.accounts, starts,
+                                                   ends)}
+        return self.memoized('running_balances', compute)
+
+    def top_merchants(self, n=10):
+        """Returns [(merchant, spend, count)] for the biggest merchants."""
+        def compute():
+            spend = self.spend()
+            totals = np.bincount(self.merchant_codes, weights=spend,
+                                 minlength=len(self.merchants))
+            counts = np.bincount(self.merchant_codes[spend > 0],
+                                 minlength=len(self.merchants))
+            top = np.argsort(-totals, kind='stable')[:n]
+            return [(self.merchants[i], float(totals[i]), int(counts[i]))
+                    for i in top if totals[i] > 0]
+        return self.memoized(('top_merchants', n), compute)
+
+
+def unique(values):
+    ## Distinct values and the code of each entry, like pandas.factorize
+    if not values:
+        return [], np.array([], dtype=int)
+    labels, codes = np.unique(np.array(values, dtype=str),
+                              return_inverse=True)
+    return labels.tolist(), codes
+
+
+## Frames are cached per user along with a stamp of the data they were built
+## from: each Item's sync cursor and balance refresh time, and the latest
+## rename rule. A sync, refresh or rename in any process moves the stamp, so
+## a stale frame is rebuilt on next use.
+_frames = None
+
+
+def cache():
+    global _frames
+    if _frames is None:
+        _frames = TTLCache(app.config['ANALYTICS_CACHE_SIZE'],
+                           app.config['ANALYTICS_CACHE_TTL'])
+    return _frames
+
+
+def stamp(user_id):
+    cursors = db.session.query(Item.id, Item.cursor,
+                               Item.balances_updated_at).filter_by(
+        user_id=user_id, deleted_at=None).order_by(Item.id).all()
+    renamed = db.session.query(db.func.max(RenameRule.updated_at)).filter_by(
+        user_id=user_id).scalar()
+    return tuple(cursors), renamed
+
+
+def frame_for(user):
+    current = stamp(user.id)
+    cached = cache().get(user.id)
+    if cached is not None and cached[0] == current:
+        return cached[1]
+    frame = TransactionFrame.load(user.id)
+    cache().set(user.id, (current, frame))
+    return frame
+
+
+def invalidate(user_id):
+    cache().delete(user_id)
@@ -0,0 +1,146 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from time import monotonic, perf_counter, sleep
+from sqlalchemy import case, or_
+from app import app, db
+from plaid.model.accounts_balance_get_request import AccountsBalanceGetRequest
+from app.models import Item, Account
+from app.plaid_connect import configure
+
+
+## Scheduled balance refresh for every linked Item. The Plaid calls are I/O
+## bound, so they fan out over a bounded thread pool, throttled by one rate
+## limit shared by all threads. Results are written back on the calling
+## thread, one bulk UPDATE and commit per Item.
+
+
+class RateLimiter(object):
+    """Token bucket allowing `rate` acquisitions per second, with bursts of
+    up to `burst`. Thread-safe; acquire() blocks until a token is free."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self.tokens = self.burst
+        self.updated = monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = monotonic()
+                self.tokens = min(self.burst, self.tokens +
+                                  (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+
+def store_balances(item_id, accounts, refreshed_at=None):
+    ## One UPDATE ... CASE for all of the item's accounts; the caller commits
+    balances = {a['account_id']: a['balances']['current'] for a in accounts}
+    if balances:
+        table = Account.__table__
+        db.session.execute(table.update().where(
+            table.c.id.in_(list(balances)), table.c.item_id == item_id).values(
+                current_balance=case(balances, value=table.c.id)))
+    Item.query.filter_by(id=item_id).update(
+        {Item.balances_updated_at: refreshed_at or datetime.utcnow()},
+        synchronize_session=False)
+    return len(balances)
+
+
+def stale_items(min_age=None):
+    """(id, access_token) of every Item not refreshed in `min_age` seconds."""
+    if min_age is None:
+        min_age = app.config['BALANCE_REFRESH_MIN_AGE']
+    fresh_after = datetime.utcnow() - timedelta(seconds=min_age)
+    return db.session.query(Item.id, Item.access_token).filter(
+        Item.access_token.isnot(None), Item.deleted_at.is_(None),
+        or_(Item.balances_updated_at.is_(None),
+            Item.balances_updated_at < fresh_after)).order_by(
+        Item.balances_updated_at).all()
+
+
+def fetch_balances(client, limiter, access_token):
+    limiter.acquire()
+    response = client.accounts_balance_get(
+        AccountsBalanceGetRequest(access_token=access_token))
+    return response.to_dict()['accounts']
+
+
+def refresh_all(workers=None, rate=None, min_age=None):
+    """Refresh the balances of every stale Item and return a summary with
+    the throughput in items per second."""
+    workers = workers or app.config['BALANCE_REFRESH_WORKERS']
+    rate = rate or app.config['BALANCE_REFRESH_RATE']
+    client = configure()
+    limiter = RateLimiter(rate)
+    items = stale_items(min_age)
+    total = db.session.query(Item.id).filter(Item.deleted_at.is_(None)).count()
+    result = {'items': len(items), 'skipped': total - len(items),
+              'refreshed': 0, 'failed': 0, 'accounts': 0}
+    started = perf_counter()
+
+    with ThreadPoolExecutor(max_workers=workers,
+                            thread_name_prefix='balance-refresh') as pool:
+        futures = {pool.submit(fetch_balances, client, limiter, token): id
+                   for id, token in items}
+        for future in as_completed(futures):
+            item_id = futures[future]
+            try:
+                accounts = future.result()
+                result['accounts'] += store_balances(item_id, accounts)
+                db.session.commit()
+                result['refreshed'] += 1
+            except Exception:
+                db.session.rollback()
+                app.logger.exception('Balance refresh failed for item %s',
+                                     item_id)
+                result['failed'] += 1
+
+    result['elapsed'] = perf_counter() - started
+    result['items_per_second'] = result['refreshed'] / result['elapsed'] \
+        if result['elapsed'] else 0.0
+    app.logger.info(
+        'Refreshed balances for %d items (%d failed, %d skipped) in %.3fs, '
+        '%.1f items/s', result['refreshed'], result['failed'],
+        result['skipped'], result['elapsed'], result['items_per_second'])
+    return result
+
+
+class Scheduler(object):
+    """Runs refresh_all every `interval` seconds on a background thread."""
+
+    def __init__(self, interval=None, **options):
+        self.interval = interval or app.config['BALANCE_REFRESH_INTERVAL']
+        self.options = options
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run,
+                                       name='balance-scheduler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+
+    def join(self, timeout=None):
+        self.thread.join(timeout)
+
+    def run(self):
+        with app.app_context():
+            while not self.stopping.is_set():
+                try:
+                    refresh_all(**self.options)
+                except Exception:
+                    app.logger.exception('Balance refresh error')
+                    db.session.rollback()
+                finally:
+                    db.session.remove()
+                self.stopping.wait(self.interval)
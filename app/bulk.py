@@ -0,0 +1,52 @@
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from app import db
+
+
+## Set-based write helpers shared by the ingest paths
+
+BATCH_SIZE = 1000
+
+
+def chunks(rows, size=BATCH_SIZE):
+    rows = list(rows)
+    for i in range(0, len(rows), size):
+        yield rows[i:i + size]
+
+
+def upsert(table, rows, index_elements, update_columns, increment=False):
+    ## INSERT ... ON CONFLICT DO UPDATE (or the dialect's equivalent) of
+    ## `rows`, overwriting only `update_columns` on rows that already exist,
+    ## or adding to them with increment=True. Returns the number of rows sent.
+    if not rows:
+        return 0
+
+    def new_value(column, incoming):
+        return table.c[column] + incoming if increment else incoming
+
+    dialect = db.engine.dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        insert = postgresql.insert if dialect == 'postgresql' \
+            else sqlite.insert
+        stmt = insert(table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=index_elements,
+            set_={c: new_value(c, stmt.excluded[c]) for c in update_columns})
+    elif dialect == 'mysql':
+        stmt = mysql.insert(table)
+        stmt = stmt.on_duplicate_key_update(
+            {c: new_value(c, stmt.inserted[c]) for c in update_columns})
+    else:
+        for row in rows:
+            key = {c: row[c] for c in index_elements}
+            exists = db.session.execute(
+                db.select(table.c[index_elements[0]]).filter_by(**key)
+            ).first()
+            if exists:
+                db.session.execute(table.update().filter_by(**key).values(
+                    **{c: new_value(c, row[c]) for c in update_columns}))
+            else:
+                db.session.execute(table.insert().values(**row))
+        return len(rows)
+    for batch in chunks(rows):
+        db.session.execute(stmt, batch)
+    return len(rows)
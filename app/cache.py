@@ -0,0 +1,57 @@
+import threading
+from collections import Counter, OrderedDict
+from time import monotonic
+
+
+## Small in-process caches shared by the app's lookup paths
+
+MISSING = object()
+
+
+class TTLCache(object):
+    """Thread-safe LRU mapping whose entries also expire after `ttl` seconds.
+
+    `stats` counts hits, misses, expirations and evictions.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stats = Counter()
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, MISSING)
+            if entry is not MISSING:
+                value, expires = entry
+                if expires is None or expires > monotonic():
+                    self._data.move_to_end(key)
+                    self.stats['hits'] += 1
+                    return value
+                del self._data[key]
+                self.stats['expired'] += 1
+            self.stats['misses'] += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = None if ttl is None else monotonic() + ttl
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
@@ -1,6 +1,11 @@
 import os
+import signal
 import click
 from app import app
+from app.models import User, rebuild_timelines, rebuild_spend_rollups, \
+    check_spend_rollups
+from app.jobs import Worker, work_off
+from app import balances, language
 
 
 @app.cli.group()
@@ -35,4 +40,136 @@ def update():
 def compile():
     """Compile all languages."""
     if os.system('pybabel compile -d app/translations'):
-        raise RuntimeError('compile command failed')
\ No newline at end of file
+        raise RuntimeError('compile command failed')
+
+@app.cli.group()
+def timeline():
+    """Home timeline maintenance commands."""
+    pass
+
+
+@timeline.command()
+def rebuild():
+    """Rebuild every home timeline from posts and the follow graph."""
+    count = rebuild_timelines()
+    print('{} timeline entries written'.format(count))
+
+
+@app.cli.group()
+def followers():
+    """Follow graph maintenance commands."""
+    pass
+
+
+@followers.command()
+def repair():
+    """Recompute every user's follower and following counters."""
+    print('{} users repaired'.format(User.repair_follow_counts()))
+
+
+
+@app.cli.group()
+def rollups():
+    """Spending rollup maintenance commands."""
+    pass
+
+
+@rollups.command('rebuild')
+@click.option('--user', 'user_id', type=int, default=None,
+              help='Only rebuild this user id.')
+def rebuild_rollups(user_id):
+    """Recompute the daily and monthly spending rollups."""
+    daily, monthly = rebuild_spend_rollups(user_id)
+    print('{} daily and {} monthly rollup rows written'.format(daily, monthly))
+
+
+@rollups.command()
+@click.option('--user', 'user_id', type=int, default=None,
+              help='Only check this user id.')
+def check(user_id):
+    """Compare the spending rollups with the transactions they summarize."""
+    mismatches = check_spend_rollups(user_id)
+    for table, key, expected, actual in mismatches:
+        print('{} {}: expected {}, found {}'.format(table, key, expected,
+                                                    actual))
+    if mismatches:
+        raise click.ClickException(
+            '{} rollup rows out of date'.format(len(mismatches)))
+    print('Rollups match transactions')
+
+
+@app.cli.group('balances')
+def balances_group():
+    """Account balance refresh commands."""
+    pass
+
+
+@balances_group.command('refresh')
+@click.option('--workers', '-w', type=int, default=None,
+              help='Concurrent Plaid calls (defaults to '
+                   'BALANCE_REFRESH_WORKERS).')
+@click.option('--rate', type=float, default=None,
+              help='Plaid calls per second (defaults to '
+                   'BALANCE_REFRESH_RATE).')
+@click.option('--min-age', type=int, default=None,
+              help='Skip items refreshed within this many seconds.')
+@click.option('--every', type=int, default=None,
+              help='Keep running, refreshing every this many seconds.')
+def refresh_balances(workers, rate, min_age, every):
+    """Refresh the balances of every linked item."""
+    options = {'workers': workers, 'rate': rate, 'min_age': min_age}
+    if every is None:
+        result = balances.refresh_all(**options)
+        print('{refreshed} items refreshed, {failed} failed, {skipped} '
+              'skipped in {elapsed:.3f}s ({items_per_second:.1f} items/s)'
+              .format(**result))
+        return
+    scheduler = balances.Scheduler(every, **options)
+    signal.signal(signal.SIGTERM, lambda signum, frame: scheduler.stop())
+    scheduler.start()
+    print('Refreshing balances every {} seconds'.format(scheduler.interval))
+    try:
+        while scheduler.thread.is_alive():
+            scheduler.join(timeout=1)
+    except KeyboardInterrupt:
+        scheduler.stop()
+        scheduler.join()
+
+
+@app.cli.group()
+def posts():
+    """Post maintenance commands."""
+    pass
+
+
+@posts.command('detect-languages')
+@click.option('--batch-size', type=int, default=None,
+              help='Posts per batch (defaults to LANGUAGE_BACKFILL_BATCH).')
+@click.option('--processes', '-p', type=int, default=None,
+              help='Detection processes (defaults to the CPU count).')
+def detect_languages(batch_size, processes):
+    """Set the language of every post that has none yet."""
+    print('{} posts labelled'.format(
+        language.backfill(batch_size, processes)))
+
+
+@app.cli.command()
+@click.option('--concurrency', '-c', type=int, default=None,
+              help='Worker threads (defaults to JOB_WORKERS).')
+@click.option('--burst', is_flag=True,
+              help='Run queued jobs in this process, then exit.')
+def worker(concurrency, burst):
+    """Run background jobs from the job queue."""
+    if burst:
+        print('{} jobs processed'.format(work_off()))
+        return
+    pool = Worker(concurrency)
+    signal.signal(signal.SIGTERM, lambda signum, frame: pool.stop())
+    pool.start()
+    print('Started {} job workers'.format(pool.concurrency))
+    try:
+        while any(t.is_alive() for t in pool.threads):
+            pool.join(timeout=1)
+    except KeyboardInterrupt:
+        pool.stop()
+        pool.join()
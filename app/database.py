@@ -0,0 +1,272 @@
+import logging
+import threading
+import weakref
+from functools import wraps
+from collections import Counter
+from time import monotonic, perf_counter, time
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, exc, orm, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+
+
+## Engine options for Flask-SQLAlchemy, built from Config without touching
+## the database: the engine and its pool are only created on first use.
+## Pool settings come from a named profile (DB_PROFILE), each overridable
+## on its own through the DB_* settings.
+
+logger = logging.getLogger(__name__)
+
+PROFILES = {
+    'development': {'pool_size': 5, 'max_overflow': 5, 'pool_timeout': 30,
+                    'pool_recycle': 1800, 'pool_pre_ping': True,
+                    'statement_timeout': 0, 'sslmode': None},
+    'production': {'pool_size': 5, 'max_overflow': 10, 'pool_timeout': 10,
+                   'pool_recycle': 300, 'pool_pre_ping': True,
+                   'statement_timeout': 30000, 'sslmode': 'require'},
+    'test': {'pool_size': 2, 'max_overflow': 0, 'pool_timeout': 5,
+             'pool_recycle': -1, 'pool_pre_ping': False,
+             'statement_timeout': 5000, 'sslmode': None},
+}
+
+SETTINGS = {'pool_size': 'DB_POOL_SIZE', 'max_overflow': 'DB_MAX_OVERFLOW',
+            'pool_timeout': 'DB_POOL_TIMEOUT',
+            'pool_recycle': 'DB_POOL_RECYCLE',
+            'pool_pre_ping': 'DB_POOL_PRE_PING',
+            'statement_timeout': 'DB_STATEMENT_TIMEOUT',
+            'sslmode': 'DB_SSLMODE'}
+
+
+def profile(config):
+    """The pool profile named by DB_PROFILE with any DB_* overrides."""
+    settings = dict(PROFILES[config['DB_PROFILE']])
+    for key, name in SETTINGS.items():
+        if config.get(name) is not None:
+            settings[key] = config[name]
+    return settings
+
+
+def engine_options(config):
+    """SQLALCHEMY_ENGINE_OPTIONS for the configured database URL."""
+    settings = profile(config)
+    stats.slow_wait = config.get('DB_POOL_SLOW_WAIT')
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    if url.get_backend_name() == 'sqlite':
+        ## SQLite gets Flask-SQLAlchemy's own single-file pools, which take
+        ## no sizing options
+        return {}
+    options = {'poolclass': InstrumentedPool,
+               'pool_size': settings['pool_size'],
+               'max_overflow': settings['max_overflow'],
+               'pool_timeout': settings['pool_timeout'],
+               'pool_recycle': settings['pool_recycle'],
+               'pool_pre_ping': settings['pool_pre_ping']}
+    if url.get_backend_name() == 'postgresql':
+        connect_args = {}
+        if settings['statement_timeout']:
+            connect_args['options'] = '-c statement_timeout={}'.format(
+                int(settings['statement_timeout']))
+        if settings['sslmode']:
+            connect_args['sslmode'] = settings['sslmode']
+        options['connect_args'] = connect_args
+    elif url.get_backend_name() == 'mysql' and settings['statement_timeout']:
+        options['connect_args'] = {
+            'init_command': 'SET SESSION max_execution_time={}'.format(
+                int(settings['statement_timeout']))}
+    return options
+
+
+class PoolStats(object):
+    """Checkout counts and time spent waiting for a pooled connection."""
+
+    def __init__(self):
+        self.counts = Counter()
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.pools = weakref.WeakSet()
+        ## Log checkouts that wait longer than this many seconds
+        self.slow_wait = None
+        self._lock = threading.Lock()
+
+    def count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def waited(self, seconds):
+        with self._lock:
+            self.counts['checkouts'] += 1
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+        if self.slow_wait and seconds > self.slow_wait:
+            logger.warning('Waited %.3fs for a database connection: %s',
+                           seconds, self.snapshot())
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self.counts)
+            checkouts = stats.get('checkouts', 0)
+            stats['wait_total'] = self.wait_total
+            stats['wait_max'] = self.wait_max
+            stats['wait_avg'] = self.wait_total / checkouts if checkouts \
+                else 0.0
+        ## Summed over the primary's and any replica's pool
+        pools = list(self.pools)
+        if pools:
+            stats.update(size=sum(p.size() for p in pools),
+                         checked_out=sum(p.checkedout() for p in pools),
+                         overflow=sum(max(0, p.overflow()) for p in pools),
+                         idle=sum(p.checkedin() for p in pools))
+        return stats
+
+    def reset(self):
+        with self._lock:
+            self.counts.clear()
+            self.wait_total = self.wait_max = 0.0
+
+
+stats = PoolStats()
+
+
+class InstrumentedPool(QueuePool):
+    ## QueuePool that records how long each checkout waited for a slot
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        stats.pools.add(self)
+
+    def _do_get(self):
+        started = perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            stats.count('timeouts')
+            raise
+        finally:
+            stats.waited(perf_counter() - started)
+
+
+@event.listens_for(InstrumentedPool, 'connect')
+def connected(dbapi_connection, connection_record):
+    stats.count('connects')
+
+
+@event.listens_for(InstrumentedPool, 'invalidate')
+def invalidated(dbapi_connection, connection_record, exception):
+    stats.count('invalidated')
+
+
+def pool_stats():
+    """Process-wide pool statistics: checkouts, connects, timeouts, wait
+    time in seconds and the pool's current occupancy."""
+    return stats.snapshot()
+
+
+## Read replica routing. With a 'replica' entry in SQLALCHEMY_BINDS, plain
+## SELECTs made while serving GET and HEAD requests go to the replica. Writes,
+## locking reads and every read after a write in the same session stay on the
+## primary, as do all requests for DB_REPLICA_STICKY seconds after one of the
+## client's requests wrote, and all requests while the replica lags more than
+## DB_REPLICA_MAX_LAG seconds. Jobs, CLI commands and tests outside a request
+## always use the primary.
+
+REPLICA = 'replica'
+
+## Seconds the replica is behind the primary, or NULL if it can't tell
+LAG_QUERIES = {
+    'postgresql': 'SELECT CASE WHEN pg_last_wal_receive_lsn() = '
+                  'pg_last_wal_replay_lsn() THEN 0 ELSE EXTRACT(EPOCH FROM '
+                  'now() - pg_last_xact_replay_timestamp()) END',
+}
+
+_lag = {'checked': None, 'seconds': None}
+_lag_lock = threading.Lock()
+
+
+def writes(clause):
+    return clause is not None and (
+        getattr(clause, 'is_dml', False) or
+        getattr(clause, '_for_update_arg', None) is not None)
+
+
+class RoutingSession(SignallingSession):
+    def __init__(self, db, **options):
+        self.db = db
+        self.wrote = False
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or writes(clause):
+            self.wrote = True
+            if has_request_context():
+                g.db_wrote = True
+        elif not self.wrote and has_request_context() and \
+                g.get('db_replica'):
+            stats.count('replica_reads')
+            return self.db.get_engine(self.app, bind=REPLICA)
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def replica_lag():
+    """Replica lag in seconds, checked at most every DB_REPLICA_LAG_INTERVAL
+    seconds per process; None if it could not be measured."""
+    with _lag_lock:
+        now = monotonic()
+        if _lag['checked'] is not None and now - _lag['checked'] < \
+                current_app.config['DB_REPLICA_LAG_INTERVAL']:
+            return _lag['seconds']
+        _lag['checked'] = now
+    engine = current_app.extensions['sqlalchemy'].db.get_engine(
+        current_app, bind=REPLICA)
+    query = LAG_QUERIES.get(engine.dialect.name)
+    try:
+        if query is None:
+            seconds = 0.0
+        else:
+            with engine.connect() as connection:
+                seconds = connection.execute(text(query)).scalar()
+            seconds = None if seconds is None else float(seconds)
+    except Exception:
+        logger.exception('Could not measure replica lag')
+        seconds = None
+    _lag['seconds'] = seconds
+    return seconds
+
+
+def route_reads():
+    ## before_request: may this request read from the replica?
+    g.db_replica = False
+    if REPLICA not in (current_app.config['SQLALCHEMY_BINDS'] or {}) or \
+            request.method not in ('GET', 'HEAD'):
+        return
+    wrote_at = session.get('db_wrote_at')
+    if wrote_at is not None and \
+            time() - wrote_at < current_app.config['DB_REPLICA_STICKY']:
+        stats.count('sticky_primary')
+        return
+    lag = replica_lag()
+    if lag is None or lag > current_app.config['DB_REPLICA_MAX_LAG']:
+        stats.count('lag_fallbacks')
+        return
+    g.db_replica = True
+
+
+def remember_writes(response):
+    ## after_request: pin the client to the primary after it wrote
+    if REPLICA in (current_app.config['SQLALCHEMY_BINDS'] or {}) and (
+            g.get('db_wrote') or request.method not in ('GET', 'HEAD')):
+        session['db_wrote_at'] = time()
+    return response
+
+
+def use_primary(f):
+    """Keep a GET view's reads on the primary."""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        g.db_replica = False
+        return f(*args, **kwargs)
+    return decorated
@@ -1,20 +1,162 @@
-from threading import Thread
+import atexit
+import queue
+import smtplib
+import threading
+from collections import Counter
+from time import monotonic
 from flask import render_template
 from flask_mail import Message
 from flask_babel import _
 from app import app, mail
 
 
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+## Bounded email delivery. send_email only queues the message; a fixed set
+## of workers each hold one SMTP connection open and send whatever is queued
+## over it in batches. A full queue blocks the caller for at most
+## MAIL_QUEUE_TIMEOUT seconds, then the message is refused.
+
+STOP = object()
+
+
+def transient(e):
+    ## Worth retrying on a fresh connection: 4xx replies, dropped
+    ## connections and network errors. Other SMTP errors are permanent.
+    if isinstance(e, smtplib.SMTPResponseException):
+        return 400 <= e.smtp_code < 500
+    if isinstance(e, smtplib.SMTPServerDisconnected):
+        return True
+    if isinstance(e, smtplib.SMTPException):
+        return False
+    return isinstance(e, OSError)
+
+
+class MailPool(object):
+    def __init__(self):
+        self.queue = None
+        self.workers = []
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.stats = Counter()
+
+    def submit(self, msg):
+        """Queue a message; returns False if the queue stayed full."""
+        if self.stopping.is_set():
+            self.stats['refused'] += 1
+            return False
+        self.start()
+        try:
+            self.queue.put(msg, timeout=app.config['MAIL_QUEUE_TIMEOUT'])
+        except queue.Full:
+            self.stats['refused'] += 1
+            app.logger.warning('Email queue full, dropping %r', msg.subject)
+            return False
+        self.stats['queued'] += 1
+        return True
+
+    def start(self):
+        ## Started lazily so each forked worker gets its own threads
+        with self.lock:
+            if self.queue is None:
+                self.queue = queue.Queue(app.config['MAIL_QUEUE_SIZE'])
+            self.workers = [t for t in self.workers if t.is_alive()]
+            if self.stopping.is_set():
+                return
+            for n in range(len(self.workers), app.config['MAIL_WORKERS']):
+                thread = threading.Thread(target=self.run,
+                                          name='mail-worker-{}'.format(n),
+                                          daemon=True)
+                thread.start()
+                self.workers.append(thread)
+
+    def batch(self):
+        ## Block for one message, then take whatever else is already queued,
+        ## up to and including the first STOP: each worker consumes exactly
+        ## one, leaving the rest for the other workers
+        messages = [self.queue.get(timeout=app.config['MAIL_IDLE_TIMEOUT'])]
+        while messages[-1] is not STOP and \
+                len(messages) < app.config['MAIL_BATCH_SIZE']:
+            try:
+                messages.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return messages
+
+    def run(self):
+        connection = None
+        with app.app_context():
+            while True:
+                try:
+                    messages = self.batch()
+                except queue.Empty:
+                    ## Idle: don't keep a connection the server will drop
+                    connection = self.close(connection)
+                    continue
+                for msg in messages:
+                    if msg is STOP:
+                        self.close(connection)
+                        return
+                    connection = self.deliver(connection, msg)
+
+    def deliver(self, connection, msg):
+        attempts = app.config['MAIL_MAX_RETRIES'] + 1
+        for attempt in range(1, attempts + 1):
+            try:
+                if connection is None:
+                    connection = mail.connect()
+                    connection.__enter__()
+                    self.stats['connections'] += 1
+                connection.send(msg)
+                self.stats['sent'] += 1
+                return connection
+            except Exception as e:
+                connection = self.close(connection)
+                if not transient(e) or attempt == attempts:
+                    self.stats['failed'] += 1
+                    app.logger.exception('Could not send email %r',
+                                         msg.subject)
+                    return connection
+                self.stats['retries'] += 1
+                self.stopping.wait(
+                    app.config['MAIL_RETRY_BACKOFF'] * 2 ** (attempt - 1))
+        return connection
+
+    def close(self, connection):
+        if connection is not None:
+            try:
+                connection.__exit__(None, None, None)
+            except Exception:
+                pass
+        return None
+
+    def shutdown(self, timeout=None):
+        """Stop taking messages and let the workers drain the queue."""
+        if self.queue is None:
+            return
+        self.stopping.set()
+        self.workers = [t for t in self.workers if t.is_alive()]
+        deadline = monotonic() + (app.config['MAIL_DRAIN_TIMEOUT']
+                                  if timeout is None else timeout)
+        for thread in self.workers:
+            try:
+                self.queue.put(STOP, timeout=max(0, deadline - monotonic()))
+            except queue.Full:
+                break
+        for thread in self.workers:
+            thread.join(max(0, deadline - monotonic()))
+        if not self.queue.empty():
+            app.logger.warning('%d emails left unsent at shutdown',
+                               self.queue.qsize())
+
+
+pool = MailPool()
+atexit.register(pool.shutdown)
 
 
 def send_email(subject, sender, recipients, text_body, html_body):
     msg = Message(subject, sender=sender, recipients=recipients)
     msg.body = text_body
     msg.html = html_body
-    Thread(target=send_async_email, args=(app, msg)).start()
+    return pool.submit(msg)
 
 
 def send_password_reset_email(user):
@@ -25,4 +167,4 @@ def send_password_reset_email(user):
                text_body=render_template('email/reset_password.txt',
                                          user=user, token=token),
                html_body=render_template('email/reset_password.html',
-                                         user=user, token=token))
\ No newline at end of file
+                                         user=user, token=token))
@@ -0,0 +1,162 @@
+import hashlib
+import os
+import stat
+import tempfile
+from time import time
+from flask import g, render_template
+from markupsafe import Markup
+from werkzeug.utils import import_string
+from app import app
+from app.cache import TTLCache
+from app.models import User
+
+
+## Cache of rendered _post.html rows, keyed by post id and language, locale,
+## template version and a digest of the author fields the row shows. A
+## profile edit changes the digest, so every worker stops serving the old
+## rows at once without any invalidation message.
+
+class MemoryBackend(object):
+    def __init__(self, config):
+        self.cache = TTLCache(config['FRAGMENT_CACHE_SIZE'],
+                              config['FRAGMENT_CACHE_TTL'])
+
+    def get_many(self, keys):
+        values = {}
+        for key in keys:
+            value = self.cache.get(key)
+            if value is not None:
+                values[key] = value
+        return values
+
+    def set_many(self, mapping):
+        for key, value in mapping.items():
+            self.cache.set(key, value)
+
+    def clear(self):
+        self.cache.clear()
+
+
+class FileBackend(object):
+    ## One text file per entry, shared by every worker on the host: the
+    ## expiry time on the first line, then the HTML
+    def __init__(self, config):
+        self.path = config['FRAGMENT_CACHE_DIR'] or os.path.join(
+            tempfile.gettempdir(), 'annex-fragments-{}'.format(os.getuid()))
+        self.ttl = config['FRAGMENT_CACHE_TTL']
+        self.maxsize = config['FRAGMENT_CACHE_SIZE']
+        self.writes = 0
+        os.makedirs(self.path, mode=0o700, exist_ok=True)
+        ## Rows are served verbatim, so nobody else may be able to write them
+        info = os.stat(self.path)
+        if info.st_uid != os.getuid() or \
+                info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+            raise RuntimeError('Fragment cache directory {} must be owned '
+                               'and writable only by this user'.format(
+                                   self.path))
+
+    def filename(self, key):
+        return os.path.join(self.path, hashlib.sha1(
+            key.encode('utf-8')).hexdigest())
+
+    def get_many(self, keys):
+        values = {}
+        for key in keys:
+            try:
+                with open(self.filename(key), encoding='utf-8') as f:
+                    expires = float(f.readline())
+                    value = f.read()
+            except (OSError, ValueError):
+                continue
+            if expires > time():
+                values[key] = value
+        return values
+
+    def set_many(self, mapping):
+        for key, value in mapping.items():
+            fd, tmp = tempfile.mkstemp(dir=self.path)
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write('{!r}\n'.format(time() + self.ttl))
+                f.write(value)
+            os.replace(tmp, self.filename(key))
+        self.writes += len(mapping)
+        if self.writes >= self.maxsize // 10:
+            self.writes = 0
+            self.prune()
+
+    def prune(self):
+        ## Drop the least recently written entries beyond maxsize
+        entries = sorted(os.scandir(self.path),
+                         key=lambda e: e.stat().st_mtime, reverse=True)
+        for entry in entries[self.maxsize:]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+    def clear(self):
+        for entry in os.scandir(self.path):
+            os.remove(entry.path)
+
+
+BACKENDS = {'memory': MemoryBackend, 'file': FileBackend}
+
+_backend = None
+
+
+def backend():
+    ## None when FRAGMENT_CACHE is 'null'; any other value that is not a
+    ## built-in name is imported as 'package.module:Class'
+    global _backend
+    name = app.config['FRAGMENT_CACHE']
+    if name == 'null':
+        return None
+    if _backend is None:
+        cls = BACKENDS.get(name) or import_string(name)
+        _backend = cls(app.config)
+    return _backend
+
+
+def template_version():
+    version = app.config['FRAGMENT_CACHE_VERSION']
+    if version is None:
+        source = app.jinja_env.loader.get_source(app.jinja_env, '_post.html')
+        version = hashlib.md5(source[0].encode('utf-8')).hexdigest()[:8]
+        app.config['FRAGMENT_CACHE_VERSION'] = version
+    return version
+
+
+def author_digest(user):
+    ## The author fields _post.html shows: username, and email for the avatar
+    return hashlib.md5('{}\0{}'.format(user.username, user.email).encode(
+        'utf-8')).hexdigest()[:12]
+
+
+def render_posts(posts):
+    cache = backend()
+    if cache is None:
+        return Markup(''.join(render_template('_post.html', post=post)
+                              for post in posts))
+    version = template_version()
+    ## One query for every author on the page; post.author then comes from
+    ## the identity map, for the keys and for any rows rendered below
+    authors = {p.user_id for p in posts}
+    if authors:
+        User.query.filter(User.id.in_(authors)).all()
+    keys = ['post:{}:{}:{}:{}:{}'.format(p.id, p.language, g.locale, version,
+                                         author_digest(p.author))
+            for p in posts]
+    found = cache.get_many(keys)
+    rendered = {}
+    for key, post in zip(keys, posts):
+        if key not in found:
+            rendered[key] = found[key] = render_template('_post.html',
+                                                         post=post)
+    if rendered:
+        cache.set_many(rendered)
+    return Markup(''.join(found[key] for key in keys))
+
+
+@app.context_processor
+def inject_render_posts():
+    return {'render_posts': render_posts}
@@ -0,0 +1,200 @@
+import json
+import random
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import and_, or_
+from sqlalchemy.exc import IntegrityError
+from app import app, db
+from app.models import Job
+
+
+## Durable background jobs stored in the app database. Webhooks enqueue,
+## `flask worker` claims and runs them. A claimed job is leased for
+## JOB_VISIBILITY_TIMEOUT seconds and the lease is renewed while the handler
+## runs; if its worker dies the lease expires and another worker picks it up
+## again. A keyed job gives up its dedupe_key while running, so a webhook
+## arriving mid-run queues a fresh job, and takes it back when queued for a
+## retry; a retry that finds a fresh job already queued is superseded by it.
+
+handlers = {}
+
+
+def job(name):
+    """Register a function as the handler for jobs called `name`."""
+    def decorator(f):
+        handlers[name] = f
+        return f
+    return decorator
+
+
+def enqueue(name, key=None, **payload):
+    """Queue a job, or return the queued job already holding `key`."""
+    dedupe_key = None if key is None else '{}:{}'.format(name, key)
+    if dedupe_key is not None:
+        existing = Job.query.filter_by(dedupe_key=dedupe_key).first()
+        if existing is not None:
+            return existing
+    new_job = Job(name=name, payload=json.dumps(payload),
+                  dedupe_key=dedupe_key, job_key=dedupe_key,
+                  max_attempts=app.config['JOB_MAX_ATTEMPTS'])
+    db.session.add(new_job)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        ## Lost a race with a concurrent enqueue of the same key
+        db.session.rollback()
+        return Job.query.filter_by(dedupe_key=dedupe_key).first()
+    return new_job
+
+
+def backoff(attempts):
+    delay = min(app.config['JOB_RETRY_BACKOFF'] * 2 ** (attempts - 1),
+                app.config['JOB_RETRY_BACKOFF_MAX'])
+    return timedelta(seconds=delay * random.uniform(0.5, 1.0))
+
+
+def claim():
+    """Lease the next runnable job to this worker, or return None."""
+    now = datetime.utcnow()
+    runnable = or_(and_(Job.status == 'queued', Job.run_at <= now),
+                   and_(Job.status == 'running', Job.locked_until < now))
+    candidates = db.session.query(Job.id).filter(runnable).order_by(
+        Job.run_at).limit(10).all()
+    lease = now + timedelta(seconds=app.config['JOB_VISIBILITY_TIMEOUT'])
+    for (id,) in candidates:
+        ## The conditional UPDATE is the lock: only one worker can win it
+        claimed = Job.query.filter(Job.id == id, runnable).update(
+            {Job.status: 'running', Job.locked_until: lease,
+             Job.attempts: Job.attempts + 1, Job.dedupe_key: None},
+            synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            return Job.query.get(id)
+    return None
+
+
+class Heartbeat(object):
+    ## Renews a running job's lease every third of JOB_VISIBILITY_TIMEOUT,
+    ## so a long handler is not claimed again while it still runs
+    def __init__(self, id, lease):
+        self.id = id
+        self.lease = lease
+        self.timeout = app.config['JOB_VISIBILITY_TIMEOUT']
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run,
+                                       name='job-heartbeat-{}'.format(id),
+                                       daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopping.set()
+        self.thread.join()
+
+    def run(self):
+        jobs = Job.__table__
+        while not self.stopping.wait(self.timeout / 3):
+            lease = datetime.utcnow() + timedelta(seconds=self.timeout)
+            try:
+                with db.engine.begin() as connection:
+                    renewed = connection.execute(jobs.update().where(
+                        jobs.c.id == self.id,
+                        jobs.c.locked_until == self.lease).values(
+                            locked_until=lease)).rowcount
+            except Exception:
+                app.logger.exception('Could not renew the lease of job %s',
+                                     self.id)
+                continue
+            if not renewed:
+                return
+            self.lease = lease
+
+
+def run_job(claimed):
+    """Run a claimed job and record success, a retry, or failure."""
+    id, key = claimed.id, claimed.job_key
+    now = datetime.utcnow()
+    heartbeat = Heartbeat(id, claimed.locked_until)
+    try:
+        if claimed.attempts > claimed.max_attempts:
+            raise RuntimeError('Visibility timeout exceeded too many times')
+        handler = handlers.get(claimed.name)
+        if handler is None:
+            raise LookupError('No handler for job {}'.format(claimed.name))
+        with heartbeat:
+            handler(**json.loads(claimed.payload or '{}'))
+        result = {Job.status: 'done', Job.finished_at: datetime.utcnow(),
+                  Job.last_error: None}
+    except Exception as e:
+        db.session.rollback()
+        app.logger.exception('Job %s (%s) failed', id, claimed.name)
+        if claimed.attempts >= claimed.max_attempts:
+            result = {Job.status: 'failed', Job.finished_at: now}
+        else:
+            result = {Job.status: 'queued', Job.dedupe_key: key,
+                      Job.run_at: now + backoff(claimed.attempts)}
+        result[Job.last_error] = repr(e)
+    result[Job.locked_until] = None
+    ## Only record the outcome if our lease was not taken over meanwhile
+    outcome = Job.query.filter_by(id=id, locked_until=heartbeat.lease)
+    try:
+        outcome.update(result, synchronize_session=False)
+        db.session.commit()
+    except IntegrityError:
+        ## A job with the same key was queued while this one ran
+        db.session.rollback()
+        del result[Job.dedupe_key]
+        result.update({Job.status: 'superseded', Job.finished_at: now})
+        outcome.update(result, synchronize_session=False)
+        db.session.commit()
+
+
+def work_off():
+    """Run jobs until none are runnable; returns the number processed."""
+    count = 0
+    while True:
+        claimed = claim()
+        if claimed is None:
+            return count
+        run_job(claimed)
+        count += 1
+
+
+class Worker(object):
+    def __init__(self, concurrency=None, poll_interval=None):
+        self.concurrency = concurrency or app.config['JOB_WORKERS']
+        self.poll_interval = poll_interval or app.config['JOB_POLL_INTERVAL']
+        self.stopping = threading.Event()
+        self.threads = []
+
+    def start(self):
+        for n in range(self.concurrency):
+            thread = threading.Thread(target=self.run,
+                                      name='job-worker-{}'.format(n))
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.stopping.set()
+
+    def join(self, timeout=None):
+        for thread in self.threads:
+            thread.join(timeout)
+
+    def run(self):
+        with app.app_context():
+            while not self.stopping.is_set():
+                try:
+                    claimed = claim()
+                    if claimed is None:
+                        self.stopping.wait(self.poll_interval)
+                    else:
+                        run_job(claimed)
+                except Exception:
+                    app.logger.exception('Job worker error')
+                    db.session.rollback()
+                    self.stopping.wait(self.poll_interval)
+                finally:
+                    db.session.remove()
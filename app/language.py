@@ -0,0 +1,206 @@
+import atexit
+import hashlib
+import os
+import re
+import threading
+import unicodedata
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from time import monotonic
+from langdetect import DetectorFactory, detect, detector_factory
+from langdetect.lang_detect_exception import LangDetectException
+from sqlalchemy import case, event, orm, select
+from app import app, db
+from app.cache import TTLCache
+from app.models import Post
+
+
+## Post.language, detected off the request path. Inserting a Post only notes
+## its id and body on the session; once the session commits, the batch is
+## handed to a small thread pool that detects each body and writes the
+## results with one UPDATE. At most LANGUAGE_QUEUE_SIZE posts wait for the
+## pool; beyond that they are left NULL for `flask posts detect-languages`.
+## Posts whose language can't be told are stored as ''.
+
+DetectorFactory.seed = 0
+
+UNKNOWN = ''
+IGNORED = re.compile(r'https?://\S+|@\w+|#')
+
+_cache = None
+_factory_lock = threading.Lock()
+
+
+def normalize(body):
+    ## Case, links, mentions and spacing don't change the language
+    body = unicodedata.normalize('NFKC', body or '')
+    return ' '.join(IGNORED.sub(' ', body).lower().split())
+
+
+def body_hash(body):
+    return hashlib.sha1(normalize(body).encode('utf-8')).hexdigest()
+
+
+def cache():
+    global _cache
+    if _cache is None:
+        _cache = TTLCache(app.config['LANGUAGE_CACHE_SIZE'])
+    return _cache
+
+
+def detect_language(body):
+    """The language code of `body`, or '' if it can't be told; memoized by
+    the hash of the normalized body."""
+    key = body_hash(body)
+    language = cache().get(key)
+    if language is None:
+        text = normalize(body)
+        with _factory_lock:
+            ## langdetect loads its profiles on first use, unguarded
+            detector_factory.init_factory()
+        try:
+            language = detect(text)[:5] if text else UNKNOWN
+        except LangDetectException:
+            language = UNKNOWN
+        cache().set(key, language)
+    return language
+
+
+def detect_batch(rows):
+    """[(id, language)] for [(id, body)]; also run in backfill processes."""
+    return [(id, detect_language(body)) for id, body in rows]
+
+
+def store_languages(languages):
+    ## One UPDATE for the whole batch, on its own connection so it never
+    ## joins a request's transaction; returns the number of posts
+    if not languages:
+        return 0
+    posts = Post.__table__
+    with db.engine.begin() as connection:
+        connection.execute(posts.update().where(
+            posts.c.id.in_(list(languages))).values(
+                language=case(languages, value=posts.c.id)))
+    return len(languages)
+
+
+class Detector(object):
+    def __init__(self):
+        self.executor = None
+        self.slots = None
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+
+    def submit(self, rows):
+        """Detect and store the languages of [(id, body)] in the background;
+        returns the number of posts accepted."""
+        workers = app.config['LANGUAGE_DETECT_WORKERS']
+        if not rows or not workers or self.stopping.is_set():
+            return 0
+        with self.lock:
+            if self.executor is None:
+                ## Created lazily so each forked worker gets its own threads
+                self.executor = ThreadPoolExecutor(
+                    workers, thread_name_prefix='language-detect')
+                self.slots = threading.BoundedSemaphore(
+                    app.config['LANGUAGE_QUEUE_SIZE'])
+        accepted = []
+        for row in rows:
+            if not self.slots.acquire(blocking=False):
+                app.logger.warning('Language queue full, leaving %d posts '
+                                   'for the backfill',
+                                   len(rows) - len(accepted))
+                break
+            accepted.append(row)
+        if accepted:
+            future = self.executor.submit(self.run, accepted)
+            with self.lock:
+                self.pending.add(future)
+            future.add_done_callback(self.done)
+        return len(accepted)
+
+    def run(self, rows):
+        try:
+            with app.app_context():
+                store_languages(dict(detect_batch(rows)))
+        except Exception:
+            app.logger.exception('Could not detect post languages')
+        finally:
+            for row in rows:
+                self.slots.release()
+
+    def done(self, future):
+        with self.lock:
+            self.pending.discard(future)
+
+    def wait(self, timeout=None):
+        """Block until every submitted batch has been stored."""
+        deadline = None if timeout is None else monotonic() + timeout
+        while True:
+            with self.lock:
+                pending = list(self.pending)
+            if not pending:
+                return True
+            for future in pending:
+                remaining = None if deadline is None \
+                    else max(0, deadline - monotonic())
+                try:
+                    future.result(remaining)
+                except Exception:
+                    return False
+
+    def shutdown(self):
+        self.stopping.set()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+
+detector = Detector()
+atexit.register(detector.shutdown)
+
+
+@event.listens_for(Post, 'after_insert')
+def note_new_post(mapper, connection, post):
+    if post.language is None:
+        session = orm.object_session(post)
+        session.info.setdefault('new_posts', []).append((post.id, post.body))
+
+
+@event.listens_for(db.session, 'after_commit')
+def detect_new_posts(session):
+    rows = session.info.pop('new_posts', None)
+    if rows:
+        detector.submit(rows)
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def forget_new_posts(session, previous_transaction):
+    if not session.in_transaction():
+        session.info.pop('new_posts', None)
+
+
+def backfill(batch_size=None, processes=None):
+    """Label every post with no language yet, detecting each batch in a
+    separate process; returns the number of posts labelled."""
+    batch_size = batch_size or app.config['LANGUAGE_BACKFILL_BATCH']
+    processes = processes or os.cpu_count() or 1
+    posts = Post.__table__
+    labelled, last_id = 0, 0
+    with ProcessPoolExecutor(processes) as executor:
+        while True:
+            ## Read one batch per process, detect them side by side
+            batches = []
+            for n in range(processes):
+                rows = db.session.execute(
+                    select(posts.c.id, posts.c.body).where(
+                        posts.c.language.is_(None), posts.c.id > last_id)
+                    .order_by(posts.c.id).limit(batch_size)).fetchall()
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+                batches.append([tuple(row) for row in rows])
+            db.session.commit()
+            if not batches:
+                return labelled
+            for languages in executor.map(detect_batch, batches):
+                labelled += store_languages(dict(languages))
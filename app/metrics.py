@@ -0,0 +1,272 @@
+import json
+import os
+import re
+import tempfile
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+from time import monotonic, perf_counter
+from flask import g, has_request_context, request, request_finished, \
+    request_started
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from app import app
+from app.database import pool_stats
+from app.models import identity_cache_stats
+
+
+## Per-endpoint request and SQL instrumentation, kept in memory per worker
+## process and served in the Prometheus text format at /metrics. Engine
+## events time every statement; request signals open and close a per-request
+## record in `g`. A statement shape repeated METRICS_N_PLUS_ONE times within
+## one request is counted as an N+1. With several workers, set METRICS_DIR:
+## each worker then writes its request metrics there at most once a second
+## and /metrics adds up every worker's file. Without it a scrape only sees
+## the worker that served it. Pool and identity cache statistics are always
+## those of the serving worker.
+
+PARAMETER = r'(?:\?|%s|%\(\w+\)s|:\w+)'
+PARAMETER_LIST = re.compile(r'\({0}(?:, ?{0})+\)'.format(PARAMETER))
+
+
+def shape(statement):
+    ## The statement with whitespace and expanded IN lists collapsed, so
+    ## the same query with different parameters has the same shape
+    statement = re.sub(r'\s+', ' ', statement).strip()
+    return PARAMETER_LIST.sub('(?)', statement)
+
+
+class Registry(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = defaultdict(lambda: {
+            'count': 0, 'sum': 0.0, 'buckets': None, 'queries': 0,
+            'query_time': 0.0, 'n_plus_one': 0})
+        ## (endpoint, shape) -> slowest single execution in seconds
+        self.slowest = {}
+        self.dumped = 0.0
+
+    def record(self, endpoint, method, duration, queries):
+        buckets = app.config['METRICS_BUCKETS']
+        with self.lock:
+            entry = self.requests[(endpoint, method)]
+            if entry['buckets'] is None:
+                entry['buckets'] = [0] * (len(buckets) + 1)
+            entry['count'] += 1
+            entry['sum'] += duration
+            entry['buckets'][bisect_left(buckets, duration)] += 1
+            entry['queries'] += len(queries)
+            entry['query_time'] += sum(seconds for _, seconds in queries)
+            if repeated(queries):
+                entry['n_plus_one'] += 1
+            for statement, seconds in queries:
+                key = (endpoint, statement)
+                if seconds > self.slowest.get(key, 0.0):
+                    self.slowest[key] = seconds
+            keep = app.config['METRICS_SLOW_STATEMENTS']
+            if len(self.slowest) > keep * 10:
+                self.slowest = dict(sorted(
+                    self.slowest.items(), key=lambda item: -item[1])[:keep])
+        if app.config['METRICS_DIR'] and monotonic() - self.dumped >= 1:
+            self.dump()
+
+    def snapshot(self):
+        with self.lock:
+            return {'requests': [[endpoint, method, dict(entry)]
+                                 for (endpoint, method), entry
+                                 in self.requests.items()],
+                    'slowest': [[endpoint, statement, seconds]
+                                for (endpoint, statement), seconds
+                                in self.slowest.items()]}
+
+    def dump(self):
+        ## Replace this worker's file in METRICS_DIR
+        self.dumped = monotonic()
+        path = app.config['METRICS_DIR']
+        fd, tmp = tempfile.mkstemp(dir=path)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp, os.path.join(path, '{}.json'.format(os.getpid())))
+
+    def collect(self):
+        ## (requests, slowest) of this worker, or of every worker that has
+        ## written to METRICS_DIR
+        path = app.config['METRICS_DIR']
+        if not path:
+            snapshots = [self.snapshot()]
+        else:
+            self.dump()
+            snapshots = []
+            for entry in os.scandir(path):
+                if entry.name.endswith('.json'):
+                    try:
+                        with open(entry.path) as f:
+                            snapshots.append(json.load(f))
+                    except (OSError, ValueError):
+                        continue
+        requests, slowest = {}, {}
+        for snapshot in snapshots:
+            for endpoint, method, entry in snapshot['requests']:
+                total = requests.get((endpoint, method))
+                if total is None:
+                    requests[(endpoint, method)] = dict(
+                        entry, buckets=list(entry['buckets']))
+                    continue
+                for key in ('count', 'sum', 'queries', 'query_time',
+                            'n_plus_one'):
+                    total[key] += entry[key]
+                total['buckets'] = [a + b for a, b in zip(
+                    total['buckets'], entry['buckets'])]
+            for endpoint, statement, seconds in snapshot['slowest']:
+                key = (endpoint, statement)
+                slowest[key] = max(seconds, slowest.get(key, 0.0))
+        return requests, sorted(slowest.items(), key=lambda item: -item[1])
+
+    def render(self):
+        """The registry, pool and identity cache statistics in Prometheus text
+        format."""
+        buckets = app.config['METRICS_BUCKETS']
+        lines = []
+
+        def metric(name, kind, help):
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+
+        requests, slowest = self.collect()
+        slowest = slowest[:app.config['METRICS_SLOW_STATEMENTS']]
+
+        metric('annex_request_duration_seconds', 'histogram',
+               'Request latency by endpoint.')
+        for (endpoint, method), entry in sorted(requests.items()):
+            base = labels(endpoint=endpoint, method=method)
+            total = 0
+            for bound, count in zip(buckets + [None], entry['buckets']):
+                total += count
+                le = '+Inf' if bound is None else repr(float(bound))
+                lines.append('annex_request_duration_seconds_bucket{} {}'
+                             .format(labels(endpoint=endpoint, method=method,
+                                            le=le), total))
+            lines.append('annex_request_duration_seconds_sum{} {}'.format(
+                base, entry['sum']))
+            lines.append('annex_request_duration_seconds_count{} {}'.format(
+                base, entry['count']))
+        for name, key, help in (
+                ('annex_request_queries_total', 'queries',
+                 'SQL statements executed while serving requests.'),
+                ('annex_request_query_seconds_total', 'query_time',
+                 'Time spent in SQL while serving requests.'),
+                ('annex_request_n_plus_one_total', 'n_plus_one',
+                 'Requests that repeated one statement shape at least '
+                 'METRICS_N_PLUS_ONE times.')):
+            metric(name, 'counter', help)
+            for (endpoint, method), entry in sorted(requests.items()):
+                lines.append('{}{} {}'.format(
+                    name, labels(endpoint=endpoint, method=method),
+                    entry[key]))
+        metric('annex_slow_statement_seconds', 'gauge',
+               'Slowest single execution of the slowest statement shapes.')
+        for (endpoint, statement), seconds in slowest:
+            lines.append('annex_slow_statement_seconds{} {}'.format(
+                labels(endpoint=endpoint, statement=statement[:200]),
+                seconds))
+        for key, value in sorted(pool_stats().items()):
+            name = 'annex_db_pool_' + key
+            metric(name, 'counter' if key in COUNTERS else 'gauge',
+                   'Database pool statistic {}.'.format(key))
+            lines.append('{} {}'.format(name, value))
+        for key, value in sorted(identity_cache_stats().items()):
+            name = 'annex_identity_cache_' + key
+            metric(name, 'gauge' if key in ('entries', 'hit_rate')
+                   else 'counter', 'load_user identity cache {}.'.format(key))
+            lines.append('{} {}'.format(name, value))
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        with self.lock:
+            self.requests.clear()
+            self.slowest.clear()
+
+
+COUNTERS = {'checkouts', 'connects', 'invalidated', 'timeouts',
+            'wait_total', 'replica_reads', 'sticky_primary', 'lag_fallbacks'}
+
+registry = Registry()
+
+
+def labels(**values):
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+            .replace('\n', '\\n')
+    return '{' + ','.join('{}="{}"'.format(k, escape(v))
+                          for k, v in values.items()) + '}'
+
+
+def repeated(queries):
+    """Statement shapes run at least METRICS_N_PLUS_ONE times."""
+    counts = defaultdict(int)
+    for statement, _ in queries:
+        counts[statement] += 1
+    return {statement: count for statement, count in counts.items()
+            if count >= app.config['METRICS_N_PLUS_ONE']}
+
+
+def breakdown(duration, queries):
+    ## Per-request summary for the debug header: totals plus the statement
+    ## shapes that took the most time
+    totals = defaultdict(lambda: [0, 0.0])
+    for statement, seconds in queries:
+        totals[statement][0] += 1
+        totals[statement][1] += seconds
+    top = sorted(totals.items(), key=lambda item: -item[1][1])[:10]
+    return {'duration': round(duration, 6), 'queries': len(queries),
+            'query_time': round(sum(s for _, s in queries), 6),
+            'statements': [{'statement': statement[:120], 'count': count,
+                            'time': round(seconds, 6)}
+                           for statement, (count, seconds) in top],
+            'n_plus_one': [statement[:120]
+                           for statement in repeated(queries)]}
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    conn.info.setdefault('metrics_started', []).append(perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    started = conn.info['metrics_started'].pop()
+    if has_request_context() and 'metrics_queries' in g:
+        g.metrics_queries.append((shape(statement),
+                                  perf_counter() - started))
+
+
+@event.listens_for(Engine, 'handle_error')
+def handle_error(context):
+    started = context.connection.info.get('metrics_started') \
+        if context.connection is not None else None
+    if started:
+        started.pop()
+
+
+@request_started.connect_via(app)
+def start_request(sender, **extra):
+    g.metrics_started = perf_counter()
+    g.metrics_queries = []
+
+
+@request_finished.connect_via(app)
+def finish_request(sender, response, **extra):
+    if 'metrics_started' not in g or request.endpoint in (None, 'static'):
+        return
+    duration = perf_counter() - g.metrics_started
+    queries = g.metrics_queries
+    registry.record(request.endpoint, request.method, duration, queries)
+    for statement, count in repeated(queries).items():
+        app.logger.warning('Possible N+1 in %s: %d x %s', request.endpoint,
+                           count, statement[:200])
+    if app.config['METRICS_DEBUG_HEADER'] and \
+            request.headers.get('X-Debug-Metrics'):
+        response.headers['X-Request-Metrics'] = json.dumps(
+            breakdown(duration, queries))
@@ -1,16 +1,37 @@
-from datetime import datetime
+from datetime import datetime, timedelta
+from functools import lru_cache
 from hashlib import md5
-from time import time
+from time import time, perf_counter
+from types import MappingProxyType
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import event, inspect, literal, select
+from sqlalchemy.orm import make_transient_to_detached
 import jwt
 from app import app, db, login
+from app.bulk import chunks, upsert
+from app.cache import TTLCache
+from app.passwords import hasher
 
 
 followers = db.Table(
     'followers',
-    db.Column('follower_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('followed_id', db.Integer, db.ForeignKey('user.id'))
+    db.Column('follower_id', db.Integer, db.ForeignKey('user.id'),
+              primary_key=True),
+    db.Column('followed_id', db.Integer, db.ForeignKey('user.id'),
+              primary_key=True),
+    db.Index('ix_followers_followed_id', 'followed_id', 'follower_id')
+)
+
+## Precomputed home feeds: one row per (reader, post), written on post/follow
+timeline = db.Table(
+    'timeline',
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id'),
+              primary_key=True),
+    db.Column('post_id', db.Integer, db.ForeignKey('post.id'),
+              primary_key=True),
+    db.Column('author_id', db.Integer, db.ForeignKey('user.id')),
+    db.Column('timestamp', db.DateTime),
+    db.Index('ix_timeline_user_id_timestamp', 'user_id', 'timestamp')
 )
 
 
@@ -18,10 +39,19 @@ class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), index=True, unique=True)
     email = db.Column(db.String(120), index=True, unique=True)
-    password_hash = db.Column(db.String(128))
+    password_hash = db.Column(db.String(256))
     posts = db.relationship('Post', backref='author', lazy='dynamic')
     about_me = db.Column(db.String(140))
     last_seen = db.Column(db.DateTime, default=datetime.utcnow)
+    ## Materialized sizes of `followers` and `followed`, kept in step by
+    ## follow()/unfollow(); `flask followers repair` recomputes them
+    follower_count = db.Column(db.Integer, default=0, server_default='0',
+                               nullable=False)
+    followed_count = db.Column(db.Integer, default=0, server_default='0',
+                               nullable=False)
+    ## Set whenever a column other than last_seen changes, so every worker
+    ## can drop its cached copy of the user (see expire_changed_users)
+    changed_at = db.Column(db.DateTime, index=True)
     followed = db.relationship(
         'User', secondary=followers,
         primaryjoin=(followers.c.follower_id == id),
@@ -32,27 +62,70 @@ class User(UserMixin, db.Model):
         return '<User {}>'.format(self.username)
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hasher.hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        ## A match against outdated hash parameters also replaces the
+        ## stored hash; the caller commits it
+        matches, upgraded = hasher.verify(self.password_hash, password)
+        if upgraded is not None:
+            self.password_hash = upgraded
+        return matches
 
     def avatar(self, size):
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
-        return 'https://www.gravatar.com/avatar/{}?d=identicon&s={}'.format(
-            digest, size)
+        return avatar_url(self.email, size)
 
     def follow(self, user):
         if not self.is_following(user):
             self.followed.append(user)
+            self.followed_count = User.followed_count + 1
+            user.follower_count = User.follower_count + 1
+            if app.config['TIMELINE_FANOUT']:
+                ## Backfill the followed user's posts into our timeline
+                db.session.execute(timeline.insert().from_select(
+                    TIMELINE_COLUMNS,
+                    select(literal(self.id), Post.id, Post.user_id,
+                           Post.timestamp).where(Post.user_id == user.id)))
 
     def unfollow(self, user):
         if self.is_following(user):
             self.followed.remove(user)
+            self.followed_count = User.followed_count - 1
+            user.follower_count = User.follower_count - 1
+            if app.config['TIMELINE_FANOUT']:
+                db.session.execute(timeline.delete().where(
+                    (timeline.c.user_id == self.id) &
+                    (timeline.c.author_id == user.id)))
 
     def is_following(self, user):
-        return self.followed.filter(
-            followers.c.followed_id == user.id).count() > 0
+        return user.id in self.followed_among([user])
+
+    def followed_among(self, users):
+        ## Ids of those `users` this user follows, in a single query
+        ids = [u.id for u in users]
+        if not ids:
+            return set()
+        rows = db.session.query(followers.c.followed_id).filter(
+            followers.c.follower_id == self.id,
+            followers.c.followed_id.in_(ids))
+        return {id for (id,) in rows}
+
+    @staticmethod
+    def repair_follow_counts():
+        ## Recompute both counters from `followers`; returns users fixed
+        followers_of = select(db.func.count()).where(
+            followers.c.followed_id == User.id).scalar_subquery()
+        followed_by = select(db.func.count()).where(
+            followers.c.follower_id == User.id).scalar_subquery()
+        fixed = User.query.filter(
+            (User.follower_count != followers_of) |
+            (User.followed_count != followed_by)).update(
+                {User.follower_count: followers_of,
+                 User.followed_count: followed_by,
+                 User.changed_at: datetime.utcnow()},
+                synchronize_session=False)
+        db.session.commit()
+        return fixed
 
     def followed_posts(self):
         followed = Post.query.join(
@@ -61,6 +134,23 @@ class User(UserMixin, db.Model):
         own = Post.query.filter_by(user_id=self.id)
         return followed.union(own).order_by(Post.timestamp.desc())
 
+    def timeline_posts(self):
+        return Post.query.join(
+            timeline, (timeline.c.post_id == Post.id)).filter(
+                timeline.c.user_id == self.id).order_by(
+                    timeline.c.timestamp.desc(), timeline.c.post_id.desc())
+
+    def home_posts(self):
+        if app.config['TIMELINE_FANOUT']:
+            return self.timeline_posts()
+        return self.followed_posts()
+
+    def home_feed_keys(self):
+        ## Sort key columns of home_posts(), for keyset pagination
+        if app.config['TIMELINE_FANOUT']:
+            return timeline.c.timestamp, timeline.c.post_id
+        return Post.timestamp, Post.id
+
     def get_reset_password_token(self, expires_in=600):
         return jwt.encode(
             {'reset_password': self.id, 'exp': time() + expires_in},
@@ -76,9 +166,94 @@ class User(UserMixin, db.Model):
         return User.query.get(id)
 
 
+@lru_cache(maxsize=4096)
+def avatar_url(email, size):
+    digest = md5(email.lower().encode('utf-8')).hexdigest()
+    return 'https://www.gravatar.com/avatar/{}?d=identicon&s={}'.format(
+        digest, size)
+
+
+## Per-worker cache of User rows for load_user, so an authenticated request
+## doesn't open with a SELECT on user. Entries are read-only mappings of
+## column values, never ORM instances: each request gets its own instance,
+## merged into its session without a query. password_hash is left out and
+## loaded only when used. Routes that change a user call invalidate_user for
+## this worker; every worker also polls User.changed_at at most once per
+## IDENTITY_CACHE_POLL seconds and drops the users changed since, so a
+## change made elsewhere is seen within about that long.
+
+identity_cache = None
+identity_polled_at = None
+
+## Overlap between polls, for clock skew between workers and for rows
+## committed a little after their changed_at was stamped
+POLL_MARGIN = timedelta(seconds=5)
+UNCACHED = {'password_hash'}
+
+
+@event.listens_for(User, 'before_update')
+def stamp_changed_user(mapper, connection, user):
+    state = inspect(user)
+    if any(state.attrs[attr.key].history.has_changes()
+           for attr in mapper.column_attrs
+           if attr.key not in ('last_seen', 'changed_at')):
+        user.changed_at = datetime.utcnow()
+
+
+def user_snapshot(user):
+    return MappingProxyType({attr.key: getattr(user, attr.key)
+                             for attr in inspect(User).column_attrs
+                             if attr.key not in UNCACHED})
+
+
+def expire_changed_users():
+    global identity_polled_at
+    now = datetime.utcnow()
+    if now - identity_polled_at < timedelta(
+            seconds=app.config['IDENTITY_CACHE_POLL']):
+        return
+    changed = db.session.query(User.id).filter(
+        User.changed_at >= identity_polled_at - POLL_MARGIN)
+    invalidate_user(*[id for (id,) in changed])
+    identity_polled_at = now
+
+
 @login.user_loader
 def load_user(id):
-    return User.query.get(int(id))
+    global identity_cache, identity_polled_at
+    if not app.config['IDENTITY_CACHE_SIZE']:
+        return User.query.get(int(id))
+    if identity_cache is None:
+        identity_cache = TTLCache(app.config['IDENTITY_CACHE_SIZE'],
+                                  app.config['IDENTITY_CACHE_TTL'])
+        identity_polled_at = datetime.utcnow()
+    expire_changed_users()
+    values = identity_cache.get(int(id))
+    if values is None:
+        user = User.query.get(int(id))
+        if user is not None:
+            identity_cache.set(user.id, user_snapshot(user))
+        return user
+    user = User(**values)
+    make_transient_to_detached(user)
+    user = db.session.merge(user, load=False)
+    db.session.expire(user, UNCACHED)
+    return user
+
+
+def invalidate_user(*ids):
+    if identity_cache is not None:
+        for id in ids:
+            identity_cache.delete(id)
+
+
+def identity_cache_stats():
+    stats = dict(identity_cache.stats) if identity_cache is not None else {}
+    lookups = stats.get('hits', 0) + stats.get('misses', 0)
+    stats['entries'] = len(identity_cache) if identity_cache is not None \
+        else 0
+    stats['hit_rate'] = stats.get('hits', 0) / lookups if lookups else 0.0
+    return stats
 
 
 class Post(db.Model):
@@ -86,17 +261,63 @@ class Post(db.Model):
     body = db.Column(db.String(140))
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    language = db.Column(db.String(5))
+    __table_args__ = (
+        db.Index('ix_post_user_id_timestamp', 'user_id', 'timestamp'),)
 
     def __repr__(self):
         return '<Post {}>'.format(self.body)
 
+
+TIMELINE_COLUMNS = ['user_id', 'post_id', 'author_id', 'timestamp']
+
+
+@event.listens_for(Post, 'after_insert')
+def fan_out_post(mapper, connection, post):
+    ## Push a new post into the author's and every follower's timeline
+    if not app.config['TIMELINE_FANOUT']:
+        return
+    readers = select(followers.c.follower_id).where(
+        followers.c.followed_id == post.user_id).union(
+            select(literal(post.user_id))).subquery()
+    connection.execute(timeline.insert().from_select(
+        TIMELINE_COLUMNS,
+        select(readers.c[0], literal(post.id), literal(post.user_id),
+               literal(post.timestamp))))
+
+
+def rebuild_timelines():
+    ## Recompute every timeline from the follow graph; returns the row count
+    db.session.execute(timeline.delete())
+    followed = select(followers.c.follower_id, Post.id,
+                      Post.user_id.label('author_id'), Post.timestamp).join(
+        followers, (followers.c.followed_id == Post.user_id))
+    own = select(Post.user_id, Post.id, Post.user_id.label('author_id'),
+                 Post.timestamp)
+    db.session.execute(timeline.insert().from_select(
+        TIMELINE_COLUMNS, followed.union(own)))
+    db.session.commit()
+    return db.session.query(timeline).count()
+
+class Group(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(64))
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
+
+    def __repr__(self):
+        return '<Group {}>'.format(self.name)
+
+
 class Item(db.Model):
     id = db.Column(db.String(60), primary_key=True)
-    access_token = db.Column(db.String(60), primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    access_token = db.Column(db.String(60), unique=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
     ins_id = db.Column(db.String(10))
     ins_name = db.Column(db.String(120))
     cursor = db.Column(db.String(120))
+    balances_updated_at = db.Column(db.DateTime, index=True)
+    ## Set when the item is queued for a background purge
+    deleted_at = db.Column(db.DateTime)
 
     def __repr__(self):
         return '<Item {}>'.format(self.ins_name)
@@ -109,21 +330,49 @@ class Item(db.Model):
             cursor = item.cursor
         return cursor
 
+class Institution(db.Model):
+    id = db.Column(db.String(20), primary_key=True)
+    name = db.Column(db.String(120))
+    data = db.Column(db.Text)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return '<Institution {}>'.format(self.name)
+
+
+class Translation(db.Model):
+    ## Translated post bodies, keyed by the sha1 of the source text
+    body_hash = db.Column(db.String(40), primary_key=True)
+    source = db.Column(db.String(5), primary_key=True)
+    dest = db.Column(db.String(5), primary_key=True)
+    text = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return '<Translation {} {}->{}>'.format(self.body_hash[:8],
+                                                self.source, self.dest)
+
+
 class Account(db.Model):
     id = db.Column(db.String(60), primary_key=True)
     name = db.Column(db.String(128), index=True)
-    item_id = db.Column(db.String(60), db.ForeignKey('item.id'))
+    item_id = db.Column(db.String(60),
+                        db.ForeignKey('item.id', ondelete='CASCADE'),
+                        index=True)
     current_balance = db.Column(db.Float)
     type = db.Column(db.String(20))
-    group_id = db.Column(db.Integer, db.ForeignKey('group.id'))
+    group_id = db.Column(db.Integer, db.ForeignKey('group.id'), index=True)
 
     def __repr__(self):
         return '<Account {}>'.format(self.name)
 class Transaction(db.Model):
     id = db.Column(db.String(60), primary_key=True)
-    original_name = db.Column(db.String(140))
+    original_name = db.Column(db.String(140), index=True)
+    ## Normalized original_name, the key rename rules match on
+    merchant_key = db.Column(db.String(140))
     new_name = db.Column(db.String(140))
-    account_id = db.Column(db.String(60), db.ForeignKey('account.id'))
+    account_id = db.Column(db.String(60),
+                           db.ForeignKey('account.id', ondelete='CASCADE'))
     date = db.Column(db.DateTime)
     vendor_name = db.Column(db.String(140))
     vendor_type = db.Column(db.String(32))
@@ -132,6 +381,10 @@ class Transaction(db.Model):
     transaction_type = db.Column(db.String(20))
     category_name = db.Column(db.String(128))
     category_id = db.Column(db.Integer)
+    __table_args__ = (
+        db.Index('ix_transaction_account_id_date', 'account_id', 'date'),
+        db.Index('ix_transaction_account_id_merchant_key', 'account_id',
+                 'merchant_key'))
 
     def __repr__(self):
         return '<Transaction {}>'.format(self.vendor_name)
@@ -139,48 +392,86 @@ class Transaction(db.Model):
     def month_day(self):
         return "{:s} {:02d}".format(self.date.strftime("%b"), self.date.day)
 
-    def handle_db_transactions(added, modified, removed, current_user):
-        count = 0
-        if added != []:
-            for a in added:
-                count +=1
-                ## Check if this particular transaction has been renamed by the user
-                name_check = db.session.query(Transaction).join(
-                    Account).join(
-                        Item).filter(
-                            and_(Item.user_id == current_user.id, Transaction.original_name.like(a['name']))).first()
-                if name_check != None:
-                    new_name = name_check.new_name
-                else:
-                    new_name = None
-                date = None if str(a['date']) == "None" else datetime.strptime(str(a['date']), "%Y-%m-%d")
-                transaction = Transaction(id=a['transaction_id'], original_name=a['name'], new_name=new_name,
-                                account_id=a['account_id'], 
-                                date=date, vendor_name=a['merchant_name'], 
-                                amount=a['amount'], iso_currency_code=a['iso_currency_code'],
-                                transaction_type=a['payment_channel'], category_name=a['category'][0], category_id=a['category_id'])
-                db.session.add(transaction)
-        print(str(count) +" Transactions added")
-
-        if modified != []:   
-            for m in modified:
-                transaction = Transaction.query.filter_by(id=m['transaction_id']).first()
-                transaction.original_name = m['name']
-                transaction.account_id = m['account_id']
-                transaction.datetime = None if str(m['date']) == "None" else datetime.strptime(str(m['date']), "%Y-%m-%d")
-                transaction.vendor_name = m['merchant_name']
-                transaction.amount = m['amount']
-                transaction.currency_code = m['iso_currency_code']
-                transaction.transaction_type = m['payment_channel']
-                transaction.category_name = m['category'][0]
-                transaction.category_id = m['category_id']
-        
-        if removed != []:
-            for r in removed:
-                transaction = Transaction.query.filter_by(id=r['transaction_id']).first()
-                db.session.delete(transaction)
+    def rename_map(user):
+        ## {merchant_key: new_name} from the user's rename rules
+        return RenameRule.rules_for(user)
 
-        db.session.commit()
+    def from_plaid(t, renames):
+        date = None if str(t['date']) == "None" else \
+            datetime.strptime(str(t['date']), "%Y-%m-%d")
+        key = merchant_key(t['name'])
+        return {'id': t['transaction_id'], 'original_name': t['name'],
+                'merchant_key': key, 'new_name': renames.get(key),
+                'account_id': t['account_id'], 'date': date,
+                'vendor_name': t['merchant_name'], 'amount': t['amount'],
+                'iso_currency_code': t['iso_currency_code'],
+                'transaction_type': t['payment_channel'],
+                'category_name': (t['category'] or [None])[0],
+                'category_id': t['category_id']}
+
+    def handle_db_transactions(added, modified, removed, current_user,
+                               renames=None, commit=True):
+        ## Set-based ingest of one sync: a single rename lookup, batched
+        ## upserts for added/modified rows and one DELETE ... IN for removals.
+        ## Returns per-phase counts and timings (seconds). Pass `renames` to
+        ## reuse a rename map across pages, and commit=False to leave the
+        ## transaction open for the caller.
+        stats = {'added': len(added), 'modified': len(modified),
+                 'removed': len(removed), 'timings': {}}
+        timings = stats['timings']
+
+        start = perf_counter()
+        if renames is None:
+            renames = Transaction.rename_map(current_user) \
+                if added or modified else {}
+        timings['renames'] = perf_counter() - start
+
+        ## Later pages win when the same id shows up more than once; the
+        ## user's own new_name is never overwritten by an update.
+        rows = {}
+        for t in list(added) + list(modified):
+            row = Transaction.from_plaid(t, renames)
+            rows[row['id']] = row
+        removed_ids = [r['transaction_id'] for r in removed]
+
+        start = perf_counter()
+        previous = Transaction.spend_rows(list(rows) + removed_ids)
+        timings['previous'] = perf_counter() - start
+
+        start = perf_counter()
+        upsert(Transaction.__table__, list(rows.values()), ['id'],
+               [c for c in TRANSACTION_COLUMNS if c not in ('id', 'new_name')])
+        timings['upsert'] = perf_counter() - start
+
+        start = perf_counter()
+        for batch in chunks(removed_ids):
+            Transaction.query.filter(Transaction.id.in_(batch)).delete(
+                synchronize_session=False)
+        timings['delete'] = perf_counter() - start
+
+        start = perf_counter()
+        apply_spend_deltas(current_user.id, previous, rows.values())
+        timings['rollups'] = perf_counter() - start
+
+        if commit:
+            start = perf_counter()
+            db.session.commit()
+            timings['commit'] = perf_counter() - start
+
+        app.logger.info(
+            'Transactions ingested: %(added)d added, %(modified)d modified, '
+            '%(removed)d removed', stats)
+        return stats
+
+    def spend_rows(ids):
+        ## The rollup-relevant columns of whichever of `ids` already exist
+        rows = []
+        for batch in chunks(list(set(ids))):
+            rows.extend(dict(row._mapping) for row in db.session.query(
+                Transaction.account_id, Transaction.date,
+                Transaction.category_name, Transaction.amount).filter(
+                    Transaction.id.in_(batch)))
+        return rows
 
     def transactions(accounts):
         ## Create an WHERE account_id=(this OR this OR)
@@ -188,4 +479,297 @@ class Transaction(db.Model):
         for a in accounts:
             account_list.append(a.id)  
         transactions = Transaction.query.filter(Transaction.account_id.in_(account_list)).all()
-        return transactions
\ No newline at end of file
+        return transactions
+
+
+TRANSACTION_COLUMNS = [c.name for c in Transaction.__table__.columns]
+
+
+class Job(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(64))
+    payload = db.Column(db.Text)
+    ## Set only while queued, so identical pending jobs collapse into one
+    dedupe_key = db.Column(db.String(128), unique=True)
+    ## The same key for the job's whole life, restored on a retry
+    job_key = db.Column(db.String(128))
+    status = db.Column(db.String(16), default='queued')
+    attempts = db.Column(db.Integer, default=0)
+    max_attempts = db.Column(db.Integer)
+    run_at = db.Column(db.DateTime, default=datetime.utcnow)
+    locked_until = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+    __table_args__ = (db.Index('ix_job_status_run_at', 'status', 'run_at'),)
+
+    def __repr__(self):
+        return '<Job {} {}>'.format(self.name, self.status)
+
+
+def merchant_key(name):
+    return None if name is None else name.strip().lower()
+
+
+class RenameRule(db.Model):
+    ## A user's chosen display name for a merchant, applied at ingest
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'),
+                        primary_key=True)
+    merchant_key = db.Column(db.String(140), primary_key=True)
+    new_name = db.Column(db.String(140))
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return '<RenameRule {} -> {}>'.format(self.merchant_key, self.new_name)
+
+    @staticmethod
+    def rules_for(user):
+        rows = db.session.query(RenameRule.merchant_key,
+                                RenameRule.new_name).filter_by(
+                                    user_id=user.id)
+        return {key: new_name for key, new_name in rows}
+
+    @staticmethod
+    def rename(user, old_name, new_name):
+        ## Point every merchant currently shown as `old_name` at `new_name`
+        ## and relabel the user's matching transactions in one UPDATE.
+        ## Returns the number of transactions renamed.
+        keys = {merchant_key(old_name)}
+        keys.update(key for (key,) in db.session.query(
+            RenameRule.merchant_key).filter_by(user_id=user.id,
+                                               new_name=old_name))
+        upsert(RenameRule.__table__,
+               [{'user_id': user.id, 'merchant_key': key,
+                 'new_name': new_name, 'updated_at': datetime.utcnow()}
+                for key in keys],
+               ['user_id', 'merchant_key'], ['new_name', 'updated_at'])
+        accounts = select(Account.id).join(Item).where(
+            Item.user_id == user.id)
+        count = Transaction.query.filter(
+            Transaction.account_id.in_(accounts),
+            Transaction.merchant_key.in_(keys)).update(
+                {Transaction.new_name: new_name}, synchronize_session=False)
+        db.session.commit()
+        return count
+
+
+## Spending rollups, kept in step with `transaction` at ingest so dashboards
+## read a handful of pre-summed rows instead of scanning every transaction.
+## Amounts keep Plaid's sign: positive is money out.
+UNCATEGORIZED = 'Uncategorized'
+
+
+class DailySpend(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'),
+                        primary_key=True)
+    account_id = db.Column(db.String(60), primary_key=True)
+    category_name = db.Column(db.String(128), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    total = db.Column(db.Float, default=0)
+    count = db.Column(db.Integer, default=0)
+    __table_args__ = (db.Index('ix_daily_spend_user_id_day', 'user_id',
+                               'day'),)
+
+    def __repr__(self):
+        return '<DailySpend {} {} {}>'.format(self.day, self.category_name,
+                                             self.total)
+
+
+class MonthlySpend(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'),
+                        primary_key=True)
+    ## First day of the month
+    month = db.Column(db.Date, primary_key=True)
+    total = db.Column(db.Float, default=0)
+    count = db.Column(db.Integer, default=0)
+
+    def __repr__(self):
+        return '<MonthlySpend {} {}>'.format(self.month, self.total)
+
+
+def spend_deltas(user_id, old_rows, new_rows):
+    ## Net (total, count) changes per daily and monthly key from replacing
+    ## `old_rows` with `new_rows` (transaction dicts or rows)
+    daily, monthly = {}, {}
+    for sign, rows in ((-1, old_rows), (1, new_rows)):
+        for row in rows:
+            if row['date'] is None:
+                continue
+            day = row['date'].date() if isinstance(row['date'], datetime) \
+                else row['date']
+            amount = sign * (row['amount'] or 0)
+            for deltas, key in (
+                    (daily, (row['account_id'],
+                             row['category_name'] or UNCATEGORIZED, day)),
+                    (monthly, day.replace(day=1))):
+                total, count = deltas.get(key, (0, 0))
+                deltas[key] = (total + amount, count + sign)
+    daily = [{'user_id': user_id, 'account_id': account_id,
+              'category_name': category, 'day': day, 'total': total,
+              'count': count}
+             for (account_id, category, day), (total, count) in daily.items()
+             if count or abs(total) > 1e-9]
+    monthly = [{'user_id': user_id, 'month': month, 'total': total,
+                'count': count}
+               for month, (total, count) in monthly.items()
+               if count or abs(total) > 1e-9]
+    return daily, monthly
+
+
+def apply_spend_deltas(user_id, old_rows, new_rows):
+    ## Add the deltas into the rollups and drop rows that emptied out
+    daily, monthly = spend_deltas(user_id, old_rows, new_rows)
+    upsert(DailySpend.__table__, daily,
+           ['user_id', 'account_id', 'category_name', 'day'],
+           ['total', 'count'], increment=True)
+    upsert(MonthlySpend.__table__, monthly, ['user_id', 'month'],
+           ['total', 'count'], increment=True)
+    if any(row['count'] < 0 for row in daily + monthly):
+        DailySpend.query.filter(DailySpend.user_id == user_id,
+                                DailySpend.count <= 0).delete(
+                                    synchronize_session=False)
+        MonthlySpend.query.filter(MonthlySpend.user_id == user_id,
+                                  MonthlySpend.count <= 0).delete(
+                                      synchronize_session=False)
+    return len(daily), len(monthly)
+
+
+def daily_spend_query(user_id=None):
+    ## (user_id, account_id, category_name, day, total, count) recomputed
+    ## from the transactions themselves
+    day = db.func.date(Transaction.date)
+    category = db.func.coalesce(Transaction.category_name, UNCATEGORIZED)
+    query = db.session.query(
+        Item.user_id, Transaction.account_id, category, day,
+        db.func.sum(Transaction.amount), db.func.count()).select_from(
+            Transaction).join(Account).join(Item).filter(
+                Transaction.date.isnot(None))
+    if user_id is not None:
+        query = query.filter(Item.user_id == user_id)
+    return query.group_by(Item.user_id, Transaction.account_id, category,
+                          day)
+
+
+def as_date(value):
+    ## func.date() comes back as a string on SQLite
+    if isinstance(value, str):
+        return datetime.strptime(value[:10], '%Y-%m-%d').date()
+    return value.date() if isinstance(value, datetime) else value
+
+
+def expected_spend(user_id=None):
+    daily, monthly = {}, {}
+    for user, account_id, category, day, total, count in \
+            daily_spend_query(user_id):
+        day = as_date(day)
+        daily[(user, account_id, category, day)] = (total or 0, count)
+        key = (user, day.replace(day=1))
+        month_total, month_count = monthly.get(key, (0, 0))
+        monthly[key] = (month_total + (total or 0), month_count + count)
+    return daily, monthly
+
+
+def rebuild_spend_rollups(user_id=None):
+    ## Recompute the rollups from scratch for one user, or everyone
+    daily, monthly = expected_spend(user_id)
+    for model in (DailySpend, MonthlySpend):
+        query = model.query
+        if user_id is not None:
+            query = query.filter(model.user_id == user_id)
+        query.delete(synchronize_session=False)
+    for batch in chunks([
+            {'user_id': user, 'account_id': account_id,
+             'category_name': category, 'day': day, 'total': total,
+             'count': count}
+            for (user, account_id, category, day), (total, count)
+            in daily.items()]):
+        db.session.execute(DailySpend.__table__.insert(), batch)
+    for batch in chunks([
+            {'user_id': user, 'month': month, 'total': total, 'count': count}
+            for (user, month), (total, count) in monthly.items()]):
+        db.session.execute(MonthlySpend.__table__.insert(), batch)
+    db.session.commit()
+    return len(daily), len(monthly)
+
+
+def purge_item(item_id, chunk_size=None):
+    ## Delete an item's transactions one bounded chunk per commit, so no
+    ## single transaction holds row locks or WAL for its whole history, then
+    ## the emptied accounts and the item. Rollups are adjusted chunk by chunk
+    ## in the same commits. Returns the number of transactions removed.
+    chunk_size = chunk_size or app.config['ITEM_PURGE_CHUNK_SIZE']
+    user_id = db.session.query(Item.user_id).filter_by(id=item_id).scalar()
+    accounts = select(Account.id).where(Account.item_id == item_id)
+    removed = 0
+    while True:
+        ids = [id for (id,) in db.session.query(Transaction.id).filter(
+            Transaction.account_id.in_(accounts)).limit(chunk_size)]
+        if not ids:
+            break
+        previous = Transaction.spend_rows(ids)
+        Transaction.query.filter(Transaction.id.in_(ids)).delete(
+            synchronize_session=False)
+        if user_id is not None:
+            apply_spend_deltas(user_id, previous, [])
+        db.session.commit()
+        removed += len(ids)
+    ## Nothing references the accounts any more, so the cascade is cheap
+    Account.query.filter_by(item_id=item_id).delete(
+        synchronize_session=False)
+    Item.query.filter_by(id=item_id).delete(synchronize_session=False)
+    db.session.commit()
+    app.logger.info('Purged item %s: %d transactions', item_id, removed)
+    return removed
+
+
+def check_spend_rollups(user_id=None, tolerance=0.005):
+    ## Compare the rollups with totals recomputed from `transaction`;
+    ## returns a list of (table, key, expected, actual) mismatches
+    expected = dict(zip(('daily_spend', 'monthly_spend'),
+                        expected_spend(user_id)))
+    actual = {'daily_spend': {}, 'monthly_spend': {}}
+    for model, table, columns in (
+            (DailySpend, 'daily_spend', ('user_id', 'account_id',
+                                         'category_name', 'day')),
+            (MonthlySpend, 'monthly_spend', ('user_id', 'month'))):
+        query = model.query
+        if user_id is not None:
+            query = query.filter(model.user_id == user_id)
+        for row in query:
+            key = tuple(getattr(row, c) for c in columns[:-1]) + (
+                as_date(getattr(row, columns[-1])),)
+            actual[table][key] = (row.total, row.count)
+    mismatches = []
+    for table in ('daily_spend', 'monthly_spend'):
+        for key in set(expected[table]) | set(actual[table]):
+            want = expected[table].get(key)
+            got = actual[table].get(key)
+            if want is None or got is None or want[1] != got[1] or \
+                    abs(want[0] - got[0]) > tolerance:
+                mismatches.append((table, key, want, got))
+    return sorted(mismatches, key=str)
+
+
+def monthly_totals(user, start=None, end=None):
+    ## [(month, total, count)] for the dashboard, oldest first
+    query = db.session.query(MonthlySpend.month, MonthlySpend.total,
+                             MonthlySpend.count).filter_by(user_id=user.id)
+    if start is not None:
+        query = query.filter(MonthlySpend.month >= start.replace(day=1))
+    if end is not None:
+        query = query.filter(MonthlySpend.month <= end)
+    return query.order_by(MonthlySpend.month).all()
+
+
+def category_totals(user, start=None, end=None):
+    ## [(category, total, count)] between two days, largest spend first
+    total = db.func.sum(DailySpend.total)
+    query = db.session.query(DailySpend.category_name, total,
+                             db.func.sum(DailySpend.count)).filter(
+                                 DailySpend.user_id == user.id)
+    if start is not None:
+        query = query.filter(DailySpend.day >= start)
+    if end is not None:
+        query = query.filter(DailySpend.day <= end)
+    return query.group_by(DailySpend.category_name).order_by(
+        total.desc()).all()
@@ -0,0 +1,94 @@
+import base64
+import json
+from datetime import datetime
+from flask import request, url_for
+from sqlalchemy import and_, or_
+from app import app
+
+
+## Keyset ("seek") pagination over feeds ordered newest first by
+## (timestamp, id). Pages are addressed by opaque cursors instead of page
+## numbers, so there is no COUNT(*) and no OFFSET scan on deep pages.
+
+def encode_cursor(direction, post):
+    key = [direction, post.timestamp.isoformat(), post.id]
+    return base64.urlsafe_b64encode(
+        json.dumps(key).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        direction, timestamp, id = json.loads(
+            base64.urlsafe_b64decode(padded.encode('ascii')))
+        if direction not in ('next', 'prev'):
+            raise ValueError(direction)
+        return direction, (datetime.fromisoformat(timestamp), int(id))
+    except (ValueError, TypeError, json.JSONDecodeError):
+        return None, None
+
+
+class KeysetPage(object):
+    def __init__(self, items, next_cursor, prev_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+
+def keyset_paginate(query, keys, cursor=None, per_page=None):
+    per_page = per_page or app.config['POSTS_PER_PAGE']
+    timestamp, id = keys
+    direction, key = decode_cursor(cursor) if cursor else (None, None)
+    query = query.order_by(None)
+    if direction == 'prev':
+        query = query.filter(or_(
+            timestamp > key[0], and_(timestamp == key[0], id > key[1]))
+        ).order_by(timestamp.asc(), id.asc())
+    else:
+        if direction == 'next':
+            query = query.filter(or_(
+                timestamp < key[0], and_(timestamp == key[0], id < key[1])))
+        query = query.order_by(timestamp.desc(), id.desc())
+
+    ## Fetch one extra row to learn whether another page exists
+    items = query.limit(per_page + 1).all()
+    more = len(items) > per_page
+    items = items[:per_page]
+    if direction == 'prev':
+        items.reverse()
+    has_next = more if direction != 'prev' else True
+    has_prev = more if direction == 'prev' else direction == 'next'
+    if not items:
+        return KeysetPage(items, None, None)
+    return KeysetPage(
+        items,
+        encode_cursor('next', items[-1]) if has_next else None,
+        encode_cursor('prev', items[0]) if has_prev else None)
+
+
+def feed_page(query, keys, endpoint, **values):
+    ## Returns (posts, next_url, prev_url) for a feed route. Cursors are the
+    ## default; a legacy ?page=N link still gets classic offset pagination.
+    per_page = app.config['POSTS_PER_PAGE']
+    if 'page' in request.args and 'cursor' not in request.args:
+        page = request.args.get('page', 1, type=int)
+        posts = query.paginate(page=page, per_page=per_page, error_out=False)
+        next_url = url_for(endpoint, page=posts.next_num, **values) \
+            if posts.has_next else None
+        prev_url = url_for(endpoint, page=posts.prev_num, **values) \
+            if posts.has_prev else None
+        return posts.items, next_url, prev_url
+    posts = keyset_paginate(query, keys, request.args.get('cursor'), per_page)
+    next_url = url_for(endpoint, cursor=posts.next_cursor, **values) \
+        if posts.has_next else None
+    prev_url = url_for(endpoint, cursor=posts.prev_cursor, **values) \
+        if posts.has_prev else None
+    return posts.items, next_url, prev_url
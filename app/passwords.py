@@ -0,0 +1,156 @@
+import atexit
+import hashlib
+import hmac
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.security import check_password_hash, gen_salt, \
+    generate_password_hash
+from app import app
+
+
+## Password hashing off the request thread. Hashes are computed in a small
+## per-worker process pool, so a login spike costs pool time rather than
+## holding the web worker's CPU; a request waits for at most
+## PASSWORD_HASH_TIMEOUT seconds for one of PASSWORD_HASH_QUEUE_SIZE slots,
+## and as long again for its hash, then gets a 503. A pool broken by a dead
+## child process is replaced on the spot. PASSWORD_HASH_ALGORITHM is 'pbkdf2:<digest>' with
+## PASSWORD_HASH_COST iterations, or 'scrypt' with PASSWORD_HASH_COST as N;
+## an unset cost takes the algorithm's default. Hashes stored with other
+## parameters verify as before and are replaced on the next successful login.
+
+SCRYPT_R = 8
+SCRYPT_P = 1
+DEFAULT_COSTS = {'pbkdf2': 260000, 'scrypt': 2 ** 15}
+
+
+def method(algorithm, cost):
+    ## The method prefix stored before the first '$' of a hash
+    if algorithm == 'scrypt':
+        return 'scrypt:{}:{}:{}'.format(cost, SCRYPT_R, SCRYPT_P)
+    return '{}:{}'.format(algorithm, cost)
+
+
+def configured(config):
+    """(algorithm, cost) from the config; raises ValueError for settings
+    that hashing would reject."""
+    algorithm = config['PASSWORD_HASH_ALGORITHM']
+    kind, _, digest = algorithm.partition(':')
+    if kind == 'pbkdf2':
+        try:
+            hashlib.pbkdf2_hmac(digest, b'', b'', 1)
+        except ValueError:
+            raise ValueError('Unsupported PASSWORD_HASH_ALGORITHM digest '
+                             '{!r}'.format(digest))
+    elif algorithm != 'scrypt':
+        raise ValueError('Unknown PASSWORD_HASH_ALGORITHM {!r}'.format(
+            algorithm))
+    cost = config['PASSWORD_HASH_COST'] or DEFAULT_COSTS[kind]
+    if cost < 1 or kind == 'scrypt' and (cost < 2 or cost & (cost - 1)):
+        raise ValueError('Invalid PASSWORD_HASH_COST {} for {}; scrypt needs '
+                         'a power of 2'.format(cost, algorithm))
+    return algorithm, cost
+
+
+def scrypt(password, salt, n, r, p):
+    return hashlib.scrypt(password.encode('utf-8'), salt=salt.encode('utf-8'),
+                          n=n, r=r, p=p,
+                          maxmem=128 * r * (n + p + 2) + (1 << 20)).hex()
+
+
+def hash_password(password, algorithm, cost, salt_length):
+    if algorithm == 'scrypt':
+        salt = gen_salt(salt_length)
+        return '{}${}${}'.format(method(algorithm, cost), salt, scrypt(
+            password, salt, cost, SCRYPT_R, SCRYPT_P))
+    return generate_password_hash(password, method(algorithm, cost),
+                                  salt_length)
+
+
+def verify_password(stored, password, algorithm, cost, salt_length):
+    """(matches, new hash or None if the stored one is current); run in
+    the pool so an upgrade costs no extra round trip."""
+    if stored.startswith('scrypt:'):
+        prefix, salt, expected = stored.split('$', 2)
+        n, r, p = (int(part) for part in prefix.split(':')[1:])
+        matches = hmac.compare_digest(scrypt(password, salt, n, r, p),
+                                      expected)
+    else:
+        matches = check_password_hash(stored, password)
+    if matches and stored.split('$', 1)[0] != method(algorithm, cost):
+        return True, hash_password(password, algorithm, cost, salt_length)
+    return matches, None
+
+
+class PasswordHasher(object):
+    def __init__(self):
+        self.executor = None
+        self.slots = None
+        self.lock = threading.Lock()
+
+    def settings(self):
+        return configured(app.config) + (app.config['PASSWORD_SALT_LENGTH'],)
+
+    def hash(self, password):
+        return self.run(hash_password, password, *self.settings())
+
+    def verify(self, stored, password):
+        """(matches, upgraded hash or None) for a stored hash."""
+        if not stored:
+            return False, None
+        return self.run(verify_password, stored, password, *self.settings())
+
+    def pool(self):
+        workers = app.config['PASSWORD_HASH_WORKERS']
+        with self.lock:
+            if self.executor is None:
+                ## Created lazily so each forked worker gets its own pool
+                self.executor = ProcessPoolExecutor(workers)
+            if self.slots is None:
+                self.slots = threading.BoundedSemaphore(
+                    app.config['PASSWORD_HASH_QUEUE_SIZE'])
+            return self.executor
+
+    def discard(self, executor):
+        ## Drop a broken pool so the next call starts a new one
+        with self.lock:
+            if self.executor is executor:
+                self.executor = None
+        executor.shutdown(wait=False)
+
+    def run(self, fn, *args):
+        if not app.config['PASSWORD_HASH_WORKERS']:
+            return fn(*args)
+        executor = self.pool()
+        timeout = app.config['PASSWORD_HASH_TIMEOUT']
+        if not self.slots.acquire(timeout=timeout):
+            app.logger.warning('Password hashing queue full')
+            raise ServiceUnavailable()
+        try:
+            for attempt in range(2):
+                try:
+                    return executor.submit(fn, *args).result(timeout)
+                except BrokenProcessPool:
+                    app.logger.warning('Password hashing pool broken, '
+                                       'starting a new one')
+                    self.discard(executor)
+                    if attempt:
+                        raise ServiceUnavailable()
+                    executor = self.pool()
+                except TimeoutError:
+                    app.logger.warning('Password hashing timed out')
+                    raise ServiceUnavailable()
+        finally:
+            self.slots.release()
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+
+hasher = PasswordHasher()
+atexit.register(hasher.shutdown)
+
+## A bad setting fails here, at startup, rather than on the first login
+configured(app.config)
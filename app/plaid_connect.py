@@ -1,13 +1,20 @@
+import os
+import threading
+from collections import Counter
+from datetime import datetime, timedelta
+from time import perf_counter, sleep
 import requests
 from flask import current_app, jsonify, flash
 from flask_babel import _
 from flask_login import current_user
+from app import app, db
 import plaid
 import json
 from plaid.model.products import Products
 from plaid.api import plaid_api
 from plaid.model.country_code import CountryCode
 from plaid.model.accounts_get_request import AccountsGetRequest
+from plaid.model.accounts_balance_get_request import AccountsBalanceGetRequest
 from plaid.model.transfer_authorization_create_request import TransferAuthorizationCreateRequest
 from plaid.model.transfer_type import TransferType
 from plaid.model.transfer_network import TransferNetwork
@@ -17,6 +24,25 @@ from plaid.model.transfer_user_address_in_request import TransferUserAddressInRe
 from plaid.model.transfer_create_request import TransferCreateRequest
 from plaid.model.transfer_create_idempotency_key import TransferCreateIdempotencyKey
 from plaid.model.institutions_get_by_id_request import InstitutionsGetByIdRequest
+from plaid.model.transactions_sync_request import TransactionsSyncRequest
+from app import analytics
+from app.jobs import job
+from app.models import Item, Account, Group, Institution, Transaction, User, \
+    purge_item
+from app.bulk import upsert
+from app.cache import TTLCache
+
+
+## One PlaidApi client per worker process, so every call reuses the same
+## urllib3 connection pool instead of opening fresh connections
+_client = None
+_client_key = None
+_client_lock = threading.Lock()
+
+## Shared by request threads and job worker threads
+institution_cache = None
+institution_stats = Counter()
+_institution_lock = threading.Lock()
 
 
 def configure():
@@ -24,7 +50,21 @@ def configure():
     not current_app.config['PLAID_CLIENT_ID'] or \
       not current_app.config['PLAID_SECRET'] :
       return _('Error: The plaid service is not configured')
-  
+
+  global _client, _client_key
+  # Rebuilt after a fork or a configuration change
+  key = (os.getpid(), current_app.config['PLAID_ENV'],
+         current_app.config['PLAID_CLIENT_ID'],
+         current_app.config['PLAID_SECRET'],
+         current_app.config['PLAID_POOL_SIZE'],
+         current_app.config['PLAID_HOST'])
+  with _client_lock:
+    if _client is None or _client_key != key:
+      _client = create_client()
+      _client_key = key
+  return _client
+
+def create_client():
   # Configure Plaid host
   if current_app.config['PLAID_ENV'] == 'sandbox':
     host = plaid.Environment.Sandbox
@@ -32,9 +72,11 @@ def configure():
     host = plaid.Environment.Development
   if current_app.config['PLAID_ENV'] == 'production':
     host = plaid.Environment.Production
+  # A local stand-in server for tests and benchmarks
+  if current_app.config['PLAID_HOST']:
+    host = current_app.config['PLAID_HOST']
 
   # Set plaid client using .env credentials
-  configuration = None
   configuration = plaid.Configuration(
     host=host,
     api_key={
@@ -43,9 +85,9 @@ def configure():
       'plaidVersion': '2020-09-14'
       }
       )
+  configuration.connection_pool_maxsize = current_app.config['PLAID_POOL_SIZE']
   api_client = plaid.ApiClient(configuration)
-  client = plaid_api.PlaidApi(api_client)
-  return client
+  return plaid_api.PlaidApi(api_client)
 
 def get_products():
   products = []
@@ -67,20 +109,186 @@ def check_institution(ins_id):
       existing_institution = "exists"
   return existing_institution
 
+def get_institution_data(ins_id):
+    ## Institution metadata through two cache tiers: an in-process LRU with a
+    ## TTL, then the institution table, and only then the Plaid API
+    global institution_cache
+    with _institution_lock:
+        if institution_cache is None:
+            institution_cache = TTLCache(current_app.config['INSTITUTION_CACHE_SIZE'],
+                                         current_app.config['INSTITUTION_CACHE_TTL'])
+    data = institution_cache.get(ins_id)
+    if data is not None:
+        count_institution('memory_hits', 'api_calls_saved')
+        return data
+
+    fresh_after = datetime.utcnow() - timedelta(
+        seconds=current_app.config['INSTITUTION_DB_TTL'])
+    row = Institution.query.get(ins_id)
+    if row is not None and row.updated_at > fresh_after:
+        count_institution('db_hits', 'api_calls_saved')
+        data = json.loads(row.data)
+    else:
+        count_institution('misses')
+        client = configure()
+        request = InstitutionsGetByIdRequest(
+            institution_id=ins_id,
+            country_codes=list(map(lambda x: CountryCode(x), current_app.config['PLAID_COUNTRY_CODES'])),
+        )
+        response = client.institutions_get_by_id(request)
+        count_institution('api_calls')
+        data = json.loads(json.dumps(response.to_dict()['institution'], default=str))
+        upsert(Institution.__table__,
+               [{'id': ins_id, 'name': data['name'], 'data': json.dumps(data),
+                 'updated_at': datetime.utcnow()}],
+               ['id'], ['name', 'data', 'updated_at'])
+        db.session.commit()
+    institution_cache.set(ins_id, data)
+    return data
+
+def count_institution(*names):
+    with _institution_lock:
+        for name in names:
+            institution_stats[name] += 1
+
+def institution_cache_stats():
+    with _institution_lock:
+        stats = dict(institution_stats)
+    if institution_cache is not None:
+        stats['memory_entries'] = len(institution_cache)
+    return stats
+
+def link_item(user, item_id, access_token):
+    ## Persist a freshly exchanged Item and its accounts for `user`, in the
+    ## request that exchanged the public token, so nothing about the Link
+    ## flow lives in process memory. Relinking an Item updates its token.
+    client = configure()
+    response = client.accounts_balance_get(
+        AccountsBalanceGetRequest(access_token=access_token))
+    ins_id = response['item']['institution_id']
+    item = Item.query.get(item_id)
+    if item is None:
+        item = Item(id=item_id, user_id=user.id)
+        db.session.add(item)
+    item.access_token = access_token
+    item.ins_id = ins_id
+    item.ins_name = get_institution_data(ins_id)['name'] if ins_id else None
+    item.deleted_at = None
+    item.balances_updated_at = datetime.utcnow()
+    group = Group.query.filter(Group.user_id == user.id,
+                               Group.name.like('Uncategorized')).first()
+    upsert(Account.__table__,
+           [{'id': a['account_id'], 'name': a['name'], 'item_id': item_id,
+             'current_balance': a['balances']['current'],
+             'type': str(a['subtype']),
+             'group_id': group.id if group is not None else None}
+            for a in response['accounts']],
+           ['id'], ['name', 'item_id', 'current_balance', 'type'])
+    db.session.commit()
+    return response
+
 def get_institution(ins_id):
-  client = configure()
   try:
-      request = InstitutionsGetByIdRequest(
-          institution_id=ins_id,
-          country_codes=list(map(lambda x: CountryCode(x), current_app.config['PLAID_COUNTRY_CODES'])),
-      )
-      response = client.institutions_get_by_id(request)
-      return response['institution']['name']
+      return get_institution_data(ins_id)['name']
 
   except plaid.ApiException as e:
       error_response = format_error(e)
       return jsonify(error_response)
 
+
+@job('sync_transactions')
+def sync_item(item_id):
+    ## Stream transaction updates for an item one page at a time. Each page
+    ## is stored in the same DB transaction that advances item.cursor, so a
+    ## failed sync resumes from the last stored page and memory stays flat.
+    ## Overlapping syncs of one item (a webhook's job next to a manual sync,
+    ## or a re-leased job) never apply the same page twice: see below.
+    client = configure()
+    item = Item.query.filter_by(id=item_id).first()
+    if item is None or item.deleted_at is not None:
+        return {'pages': [], 'added': 0, 'modified': 0, 'removed': 0}
+    user = User.query.get(item.user_id)
+    renames = Transaction.rename_map(user)
+    start_cursor = Item.get_latest_cursor_or_none(item_id)
+    result = {'pages': [], 'added': 0, 'modified': 0, 'removed': 0}
+    restarts = 0
+    has_more = True
+
+    while has_more:
+        started = perf_counter()
+        cursor = Item.get_latest_cursor_or_none(item_id)
+        request = TransactionsSyncRequest(
+            access_token=item.access_token,
+            cursor=cursor,
+        )
+        try:
+            response = client.transactions_sync(request).to_dict()
+        except plaid.ApiException as e:
+            if sync_error_code(e) != 'TRANSACTIONS_SYNC_MUTATION_DURING_PAGINATION':
+                raise
+            # Plaid wants the loop restarted from its first cursor; pages
+            # already stored are replayed harmlessly by the upserts. An item
+            # that keeps changing is left to the job's own retry backoff.
+            restarts += 1
+            if restarts > current_app.config['SYNC_MAX_RESTARTS']:
+                raise RuntimeError('Item {} kept changing during sync, '
+                                   'gave up after {} restarts'.format(
+                                       item_id, restarts - 1))
+            app.logger.info('Restarting sync for item %s', item_id)
+            item.cursor = start_cursor
+            db.session.commit()
+            sleep(current_app.config['SYNC_RESTART_BACKOFF'] *
+                  2 ** (restarts - 1))
+            continue
+        fetched = perf_counter()
+
+        ## Advance the cursor first: the conditional UPDATE locks the item
+        ## row until the commit below, so the rollups' read of the previous
+        ## rows can't interleave with another sync's, and it matches nothing
+        ## if another sync has moved the cursor since this page was fetched.
+        ## Such a page is dropped and fetched again from the new cursor.
+        advanced = Item.query.filter(
+            Item.id == item_id,
+            db.func.coalesce(Item.cursor, '') == cursor).update(
+                {Item.cursor: response['next_cursor']},
+                synchronize_session=False)
+        if not advanced:
+            db.session.rollback()
+            app.logger.info('Item %s synced elsewhere, refetching', item_id)
+            continue
+        stats = Transaction.handle_db_transactions(
+            response['added'], response['modified'], response['removed'],
+            user, renames=renames, commit=False)
+        db.session.commit()
+        ## Other workers notice the new cursor in analytics.stamp()
+        analytics.invalidate(user.id)
+        has_more = response['has_more']
+
+        page = {'page': len(result['pages']) + 1, 'added': stats['added'],
+                'modified': stats['modified'], 'removed': stats['removed'],
+                'fetch_time': fetched - started,
+                'apply_time': perf_counter() - fetched}
+        result['pages'].append(page)
+        for key in ('added', 'modified', 'removed'):
+            result[key] += page[key]
+        app.logger.info(
+            'Synced item %s page %d: %d added, %d modified, %d removed '
+            '(fetch %.3fs, apply %.3fs)', item_id, page['page'],
+            page['added'], page['modified'], page['removed'],
+            page['fetch_time'], page['apply_time'])
+
+    return result
+
+@job('purge_item')
+def purge_deleted_item(item_id):
+    return purge_item(item_id)
+
+def sync_error_code(e):
+    try:
+        return json.loads(e.body)['error_code']
+    except (TypeError, ValueError, KeyError):
+        return None
+
     
 def authorize_and_create_transfer(access_token):
     client = configure()
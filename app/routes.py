@@ -1,34 +1,41 @@
-from datetime import datetime
-from flask import render_template, flash, redirect, url_for, request, g
+from flask import render_template, flash, redirect, url_for, request, g, \
+    jsonify, current_app, abort
 from flask_login import login_user, logout_user, current_user, login_required
 from werkzeug.urls import url_parse
 from flask_babel import _, get_locale
 from app import app, db
 from app.forms import LoginForm, RegistrationForm, EditProfileForm, \
     EmptyForm, PostForm, ResetPasswordRequestForm, ResetPasswordForm
-from app.models import User, Post
+from app.models import User, Post, invalidate_user
 from app.email import send_password_reset_email
+from app.pagination import feed_page
+from app import activity, analytics, fragments, language, metrics, \
+    translation
+from app.balances import store_balances
+from app.database import use_primary
+import hmac
 import json
-from app.models import Item, Account, Transaction
+from app.models import Item, Account, Transaction, Group, RenameRule, \
+    monthly_totals, category_totals, purge_item
+from datetime import datetime
+import time
 import plaid
-from app.plaid_connect import authorize_and_create_transfer, get_institution, pretty_print_response, format_error, configure, get_products, check_institution, get_institution
+from app.plaid_connect import authorize_and_create_transfer, get_institution, pretty_print_response, format_error, configure, get_products, check_institution, get_institution, sync_item, get_institution_data, link_item
+from app.jobs import enqueue
 from sqlalchemy import and_
 from plaid.model.country_code import CountryCode
 from plaid.model.link_token_create_request import LinkTokenCreateRequest
 from plaid.model.link_token_create_request_user import LinkTokenCreateRequestUser
 from plaid.model.item_public_token_exchange_request import ItemPublicTokenExchangeRequest
 from plaid.model.accounts_balance_get_request import AccountsBalanceGetRequest
-from plaid.model.institutions_get_by_id_request import InstitutionsGetByIdRequest
 from plaid.model.item_remove_request import ItemRemoveRequest
-from plaid.model.transactions_sync_request import TransactionsSyncRequest
 from plaid.api import plaid_api
 
 
 @app.before_request
 def before_request():
-    if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
+    if current_user.is_authenticated and request.endpoint != 'static':
+        activity.tracker.touch(current_user.id)
     g.locale = str(get_locale())
 
 
@@ -43,30 +50,21 @@ def index():
         db.session.commit()
         flash(_('Your post is now live!'))
         return redirect(url_for('index'))
-    page = request.args.get('page', 1, type=int)
-    posts = current_user.followed_posts().paginate(
-        page=page, per_page=app.config['POSTS_PER_PAGE'], error_out=False)
-    next_url = url_for('index', page=posts.next_num) \
-        if posts.has_next else None
-    prev_url = url_for('index', page=posts.prev_num) \
-        if posts.has_prev else None
+    posts, next_url, prev_url = feed_page(
+        current_user.home_posts(), current_user.home_feed_keys(), 'index')
     return render_template('index.html', title=_('Home'), form=form,
-                           posts=posts.items, next_url=next_url,
+                           posts=posts, next_url=next_url,
                            prev_url=prev_url)
 
 
 @app.route('/explore')
 @login_required
 def explore():
-    page = request.args.get('page', 1, type=int)
-    posts = Post.query.order_by(Post.timestamp.desc()).paginate(
-        page=page, per_page=app.config['POSTS_PER_PAGE'], error_out=False)
-    next_url = url_for('explore', page=posts.next_num) \
-        if posts.has_next else None
-    prev_url = url_for('explore', page=posts.prev_num) \
-        if posts.has_prev else None
+    posts, next_url, prev_url = feed_page(
+        Post.query.order_by(Post.timestamp.desc()), (Post.timestamp, Post.id),
+        'explore')
     return render_template('index.html', title=_('Explore'),
-                           posts=posts.items, next_url=next_url,
+                           posts=posts, next_url=next_url,
                            prev_url=prev_url)
 
 
@@ -80,6 +78,9 @@ def login():
         if user is None or not user.check_password(form.password.data):
             flash(_('Invalid username or password'))
             return redirect(url_for('login'))
+        if db.session.is_modified(user):
+            db.session.commit()
+            invalidate_user(user.id)
         login_user(user, remember=form.remember_me.data)
         next_page = request.args.get('next')
         if not next_page or url_parse(next_page).netloc != '':
@@ -136,6 +137,7 @@ def reset_password(token):
     if form.validate_on_submit():
         user.set_password(form.password.data)
         db.session.commit()
+        invalidate_user(user.id)
         flash(_('Your password has been reset.'))
         return redirect(url_for('login'))
     return render_template('reset_password.html', form=form)
@@ -145,16 +147,14 @@ def reset_password(token):
 @login_required
 def user(username):
     user = User.query.filter_by(username=username).first_or_404()
-    page = request.args.get('page', 1, type=int)
-    posts = user.posts.order_by(Post.timestamp.desc()).paginate(
-        page=page, per_page=app.config['POSTS_PER_PAGE'], error_out=False)
-    next_url = url_for('user', username=user.username, page=posts.next_num) \
-        if posts.has_next else None
-    prev_url = url_for('user', username=user.username, page=posts.prev_num) \
-        if posts.has_prev else None
+    posts, next_url, prev_url = feed_page(
+        user.posts.order_by(Post.timestamp.desc()), (Post.timestamp, Post.id),
+        'user', username=user.username)
     form = EmptyForm()
-    return render_template('user.html', user=user, posts=posts.items,
-                           next_url=next_url, prev_url=prev_url, form=form)
+    is_following = user.id in current_user.followed_among([user])
+    return render_template('user.html', user=user, posts=posts,
+                           next_url=next_url, prev_url=prev_url, form=form,
+                           is_following=is_following)
 
 
 @app.route('/edit_profile', methods=['GET', 'POST'])
@@ -165,6 +165,7 @@ def edit_profile():
         current_user.username = form.username.data
         current_user.about_me = form.about_me.data
         db.session.commit()
+        invalidate_user(current_user.id)
         flash(_('Your changes have been saved.'))
         return redirect(url_for('edit_profile'))
     elif request.method == 'GET':
@@ -188,6 +189,7 @@ def follow(username):
             return redirect(url_for('user', username=username))
         current_user.follow(user)
         db.session.commit()
+        invalidate_user(current_user.id, user.id)
         flash(_('You are following %(username)s!', username=username))
         return redirect(url_for('user', username=username))
     else:
@@ -208,12 +210,44 @@ def unfollow(username):
             return redirect(url_for('user', username=username))
         current_user.unfollow(user)
         db.session.commit()
+        invalidate_user(current_user.id, user.id)
         flash(_('You are not following %(username)s.', username=username))
         return redirect(url_for('user', username=username))
     else:
         return redirect(url_for('index'))
 
-access_token = None
+
+@app.route('/translate', methods=['POST'])
+@login_required
+def translate_text():
+    ## One text from form fields, or every post in a JSON `post_ids` list
+    ## translated into dest_language with one backend call per source
+    data = request.get_json(silent=True) or request.form
+    dest = data.get('dest_language') or g.locale
+    if 'post_ids' in data:
+        try:
+            ids = [int(id) for id in data['post_ids']]
+        except (TypeError, ValueError):
+            abort(400)
+        if len(ids) > app.config['TRANSLATE_BATCH_SIZE']:
+            abort(400)
+        posts = Post.query.filter(Post.id.in_(ids), Post.language != '',
+                                  Post.language != dest).all()
+        texts = [(post.body, post.language) for post in posts]
+    elif data.get('text') and data.get('source_language'):
+        posts, texts = None, [(data['text'], data['source_language'])]
+    else:
+        abort(400)
+    try:
+        translated = translation.translations.translate(texts, dest)
+    except Exception:
+        app.logger.exception('Translation failed')
+        return jsonify(
+            {'error': _('Error: the translation service failed.')}), 502
+    if posts is None:
+        return jsonify({'text': translated[0]})
+    return jsonify({'translations': {str(post.id): text
+                                     for post, text in zip(posts, translated)}})
 
 ## Get transactions by group
 @app.route('/transactions/<group_id>', methods=['GET'])
@@ -223,18 +257,61 @@ def get_transactions(group_id):
 
 ## Update transaction metadata
 @app.route('/transaction/update', methods=['POST'])
+@login_required
 def update_transaction():
-    print(request.json)
-    ## Query old and new name matches for first time updates or a new_name switch
-    transactions = Transaction.query.filter( (Transaction.original_name.like(request.json['old_name'])) |
-        (Transaction.new_name.like(request.json['old_name'])) ).all()
-    ##TODO: Update all transactions with a similar name
-    for t in transactions:
-        t.new_name = request.json['new_name']
-        print(t.original_name)
-    db.session.commit()
+    ## Store a rename rule and apply it to this user's matching transactions
+    RenameRule.rename(current_user, request.json['old_name'],
+                      request.json['new_name'])
     return redirect(url_for('cash.dashboard'))
 
+## Dashboard totals, read from the spending rollups
+@app.route('/spending/summary', methods=['GET'])
+@login_required
+def spending_summary():
+    start, end = (datetime.strptime(request.args[k], '%Y-%m-%d').date()
+                  if request.args.get(k) else None for k in ('start', 'end'))
+    return jsonify({
+        'months': [{'month': month.isoformat(), 'total': total,
+                    'count': count}
+                   for month, total, count in
+                   monthly_totals(current_user, start, end)],
+        'categories': [{'category': category, 'total': total,
+                        'count': count}
+                       for category, total, count in
+                       category_totals(current_user, start, end)]})
+
+## Prometheus metrics, for scrapers holding METRICS_TOKEN; without a token
+## configured the endpoint doesn't exist
+@app.route('/metrics')
+def prometheus_metrics():
+    token = app.config['METRICS_TOKEN']
+    if not token:
+        abort(404)
+    if not hmac.compare_digest(request.headers.get('Authorization', ''),
+                               'Bearer ' + token):
+        abort(403)
+    return metrics.registry.render(), 200, {
+        'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+## Spending analytics computed over the user's full transaction history
+@app.route('/spending/analytics', methods=['GET'])
+@login_required
+def spending_analytics():
+    frame = analytics.frame_for(current_user)
+    months, categories, by_category = frame.monthly_spend_by_category()
+    totals, deltas, ratios = frame.month_over_month()[1:]
+    return jsonify({
+        'months': [{'month': str(month), 'total': float(total),
+                    'delta': None if delta != delta else float(delta),
+                    'ratio': None if ratio != ratio else float(ratio),
+                    'categories': dict(zip(categories, row.tolist()))}
+                   for month, total, delta, ratio, row in
+                   zip(months, totals, deltas, ratios, by_category)],
+        'top_merchants': [{'merchant': merchant, 'total': total,
+                           'count': count}
+                          for merchant, total, count in
+                          frame.top_merchants()]})
+
 ## Dedupe linked institutions
 @app.route('/user/institution/<ins_id>', methods=['GET'])
 def dedupe_instution(ins_id):
@@ -248,9 +325,13 @@ def oauth():
     return render_template('cash/oauth.html', title=_('OAuth'))
 
 @app.route('/b_testing', methods=['GET'])
+@login_required
 def b_testing():
-    return render_template('index.html', title=_('B testing'), form=form,
-                           posts=posts.items, next_url=next_url,
+    posts, next_url, prev_url = feed_page(
+        Post.query.order_by(Post.timestamp.desc()), (Post.timestamp, Post.id),
+        'b_testing')
+    return render_template('index.html', title=_('B testing'),
+                           posts=posts, next_url=next_url,
                            prev_url=prev_url)
 
 ## Create link token for Plaid Link
@@ -286,8 +367,9 @@ def event():
     webhook_code = request.json['webhook_code']
     if webhook_code == "SYNC_UPDATES_AVAILABLE" or webhook_code == "TRANSACTIONS_REMOVED" or webhook_code == "DEFAULT_UPDATE":
         item_id = request.json['item_id']
-        # Fire the transaction endpoint and get new data
-        sync_transactions(item_id)
+        # Queue a sync; webhooks already waiting for this item collapse
+        job = enqueue('sync_transactions', key=item_id, item_id=item_id)
+        return {'success': True, 'job_id': job.id}
         # Update balances for accounts within the item
         # update_balance(item_id)/Applications/Visual Studio Code.app/Contents/Resources/app/out/vs/code/electron-browser/workbench/workbench.html
     return {'success': True}
@@ -307,33 +389,50 @@ def item_event():
         print('notify to add new accounts')
     return {'success': True}
 
-## Set item access token in Plaid Link process
+## Exchange the Link public token and store the new item in one request
 @app.route('/set_access_token', methods=['POST'])
+@login_required
 def set_access_token():
     client = configure()
-
-    global access_token
-    global item_id
-    global transfer_id
-
     public_token = request.get_json()['public_token']
     try:
         exchange_request = ItemPublicTokenExchangeRequest(
             public_token=public_token)
         exchange_response = client.item_public_token_exchange(exchange_request)
-        access_token = exchange_response['access_token']
-        item_id = exchange_response['item_id']
-        #pretty_print_response(exchange_response.to_dict())
+    except plaid.ApiException as e:
+        return json.loads(e.body)
+    access_token = exchange_response['access_token']
+    item_id = exchange_response['item_id']
+    item = Item.query.get(item_id)
+    if item is not None and item.user_id != current_user.id:
+        ## The exchange already minted a token; don't leave it live
+        try:
+            client.item_remove(ItemRemoveRequest(access_token=access_token))
+        except plaid.ApiException:
+            app.logger.exception('Could not remove item %s', item_id)
+        abort(403)
+    try:
+        link_item(current_user, item_id, access_token)
+        result = {'item_id': item_id}
         if 'transfer' in current_app.config['PLAID_PRODUCTS']:
-            transfer_id = authorize_and_create_transfer(access_token)
-        return jsonify(exchange_response.to_dict())
+            result['transfer_id'] = authorize_and_create_transfer(
+                access_token)
+        return jsonify(result)
     except plaid.ApiException as e:
         return json.loads(e.body)
 
+
+def owned_item(item_id):
+    ## The current user's item, looked up per request
+    return Item.query.filter_by(id=item_id, user_id=current_user.id,
+                                deleted_at=None).first_or_404()
+
 ## Update current balances for an item
 @app.route('/balance/<item_id>/update', methods=['GET'])
+@login_required
+@use_primary
 def update_balance(item_id):
-    access_token = Item.query.filter_by(id=item_id).first().access_token
+    access_token = owned_item(item_id).access_token
     client = configure()
 
     try:
@@ -341,62 +440,33 @@ def update_balance(item_id):
             access_token=access_token
         )
         response = client.accounts_balance_get(request)
-        accounts = response['accounts']
-        for a in accounts:
-            id = a['account_id']
-            balance = a['balances']['current']
-            account = Account.query.filter_by(id=id).first()
-            account.current_balance = balance
-            db.session.commit()
+        store_balances(item_id, response['accounts'])
+        db.session.commit()
         return jsonify(response.to_dict()) 
     except plaid.ApiException as e:
         error_response = format_error(e)
         return jsonify(error_response)
     
-## Get balances & add new item & accounts to db
+## Get the balances set_access_token just stored for an item, from the
+## database rather than another call to Plaid
 @app.route('/balance/get', methods=['GET'])
+@login_required
+@use_primary
 def get_balance():
-    client = configure()
-
-    try:
-        request = AccountsBalanceGetRequest(
-            access_token=access_token
-        )
-        response = client.accounts_balance_get(request)
-        ins_id = response['item']['institution_id']
-        ins_name = get_institution(ins_id)
-        item = Item(id=response['item']['item_id'], access_token=access_token, owner=current_user, ins_id=ins_id, ins_name=ins_name)
-        db.session.add(item)
-        db.session.commit()
-        group = Group.query.filter(Group.user_id==item.user_id, Group.name.like("Uncategorized")).first()
-        accounts = response['accounts']
-        for a in accounts:
-            id = a['account_id']
-            name = a['name']
-            item = response['item']['item_id']
-            balance = a['balances']['current']
-            account_type = str(a['subtype'])
-            account = Account(id=id, name=name, item_id=item, current_balance=balance, type=account_type, group_id=group.id)
-            db.session.add(account)
-            db.session.commit()
-        return jsonify(response.to_dict())
-    except plaid.ApiException as e:
-        error_response = format_error(e)
-        return jsonify(error_response)
+    item = owned_item(request.args.get('item_id') or abort(400))
+    accounts = Account.query.filter_by(item_id=item.id).order_by(Account.id)
+    return jsonify({'item': {'item_id': item.id},
+                    'accounts': [{'account_id': account.id,
+                                  'name': account.name, 'type': account.type,
+                                  'balances': {
+                                      'current': account.current_balance}}
+                                 for account in accounts]})
 
 ## Get institution name for db storage
 @app.route('/institution/<ins_id>', methods=['GET'])
 def institution(ins_id):
-    client = configure()
-
     try:
-        request = InstitutionsGetByIdRequest(
-            institution_id=ins_id,
-            country_codes=list(map(lambda x: CountryCode(x), current_app.config['PLAID_COUNTRY_CODES'])),
-        )
-        response = client.institutions_get_by_id(request)
-        print(response['institution']['name'])
-        return jsonify(response.to_dict())
+        return jsonify({'institution': get_institution_data(ins_id)})
 
     except plaid.ApiException as e:
         error_response = format_error(e)
@@ -404,25 +474,22 @@ def institution(ins_id):
 
 ## Remove item, associated accounts & transactions from the db
 @app.route('/item/<item_id>/delete')
+@login_required
+@use_primary
 def delete_item(item_id):
     client = configure()
-    item = Item.query.filter_by(id=item_id).first()
+    item = owned_item(item_id)
 
     try:
         request = ItemRemoveRequest(access_token=item.access_token)
         response = client.item_remove(request)
-        ## Remove associated Accounts
-        accounts = Account.query.filter_by(item_id=item.id)
-        account_list = []
-        for a in accounts:
-            account_list.append(a.id)
-        account_list = tuple(account_list)
-        ## Remove associated Transactions
-        transactions = db.session.query(Transaction).filter(Transaction.account_id.in_(account_list))
-        accounts.delete()
-        transactions.delete()
-        db.session.delete(item)
-        db.session.commit()
+        if app.config['ITEM_DELETE_ASYNC']:
+            ## Hide the item now and purge its history from a job worker
+            item.deleted_at = datetime.utcnow()
+            db.session.commit()
+            enqueue('purge_item', key=item_id, item_id=item_id)
+        else:
+            purge_item(item_id)
         return jsonify(response.to_dict())
     except plaid.ApiException as e:
         error_response = format_error(e)
@@ -430,42 +497,14 @@ def delete_item(item_id):
 
 ## Sync transactions after webhook event
 @app.route('/item/<item_id>/transactions', methods=['GET'])
+@login_required
+@use_primary
 def sync_transactions(item_id):
-    print(item_id)
-    client = configure()
-    item = Item.query.filter_by(id=item_id).first()
-    access_token = item.access_token
-
-    # New transaction updates since "cursor"
-    added = []
-    modified = []
-    removed = [] # Removed transaction ids
-    has_more = True
-
+    owned_item(item_id)
     try:
-        # Iterate through each page of new transaction updates for item
-        while has_more:
-            cursor = Item.get_latest_cursor_or_none(item_id)
-            request = TransactionsSyncRequest(
-                access_token=access_token,
-                cursor=cursor,
-            )
-            response = client.transactions_sync(request).to_dict()
-            # Add this page of results
-            added.extend(response['added'])
-            modified.extend(response['modified'])
-            removed.extend(response['removed'])
-            has_more = response['has_more']
-            # Update cursor to the next cursor
-            cursor = response['next_cursor']
-            item.cursor = cursor
-            db.session.commit()
-
-        Transaction.handle_db_transactions(added, modified, removed, current_user) 
-        return jsonify({'added': added})
-        
+        return jsonify(sync_item(item_id))
     except plaid.ApiException as e:
-        error_response = e
+        error_response = format_error(e)
         return jsonify(error_response)
 
 ## TODO: https for oauth
@@ -30,14 +30,15 @@
                 window.location.reload(); 
                 return;
             }
-            await fetch("/cash/set_access_token", {
+            const exchange = await fetch("/cash/set_access_token", {
                 method: "POST",
                 body: JSON.stringify({ public_token: publicToken }),
                 headers: {
                     "Content-Type": "application/json",
                 },
             });
-            const item_id = await getBalance();
+            const { item_id } = await exchange.json();
+            await getBalance(item_id);
             syncTransactions(item_id);
         },
         onEvent: (eventName, metadata) => {
@@ -65,14 +66,13 @@
 })(jQuery);
 
 // Retrieves balance information
-const getBalance = async function () {
+const getBalance = async function (item_id) {
     // const loader = document.querySelector('#loader');
     // loader.style.display = 'block';
-    const response = await fetch("/cash/balance/get", {
+    const response = await fetch(`/cash/balance/get?item_id=${item_id}`, {
         method: "GET",
     });
-    const data = await response.json();
-    const item_id = data.item.item_id;
+    await response.json();
     loader.style.display = 'none';
     location.reload();
     return item_id;
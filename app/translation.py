@@ -0,0 +1,166 @@
+import hashlib
+import threading
+from collections import Counter, defaultdict
+from concurrent.futures import Future
+from datetime import datetime
+import requests
+from werkzeug.utils import import_string
+from app import app, db
+from app.bulk import chunks, upsert
+from app.cache import TTLCache
+from app.models import Translation
+
+
+## Post translation behind two cache tiers: an in-process LRU, then the
+## translation table, both keyed by (sha1 of the text, source, dest). Misses
+## go to the TRANSLATOR backend in one call per source language. A text this
+## process is already translating is waited for instead of sent again, so a
+## burst of clicks on the same post costs one backend call.
+
+class StandInTranslator(object):
+    ## Local stand-in and the default: tags each text with the language pair
+    ## instead of translating it, so nothing leaves the process
+    def __init__(self, config):
+        self.calls = 0
+
+    def translate(self, texts, source, dest):
+        self.calls += 1
+        return ['[{}->{}] {}'.format(source, dest, text) for text in texts]
+
+
+class MicrosoftTranslator(object):
+    ## Azure Translator v3, which takes up to 100 texts per call
+    URL = 'https://api.cognitive.microsofttranslator.com/translate'
+    BATCH_SIZE = 100
+
+    def __init__(self, config):
+        self.session = requests.Session()
+        self.session.headers['Ocp-Apim-Subscription-Key'] = \
+            config['MS_TRANSLATOR_KEY']
+        if config['MS_TRANSLATOR_REGION']:
+            self.session.headers['Ocp-Apim-Subscription-Region'] = \
+                config['MS_TRANSLATOR_REGION']
+        self.timeout = config['TRANSLATE_TIMEOUT']
+
+    def translate(self, texts, source, dest):
+        translated = []
+        for batch in chunks(texts, self.BATCH_SIZE):
+            response = self.session.post(
+                self.URL, params={'api-version': '3.0', 'from': source,
+                                  'to': dest},
+                json=[{'Text': text} for text in batch], timeout=self.timeout)
+            response.raise_for_status()
+            translated += [entry['translations'][0]['text']
+                           for entry in response.json()]
+        return translated
+
+
+BACKENDS = {'stand-in': StandInTranslator, 'microsoft': MicrosoftTranslator}
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class Translations(object):
+    def __init__(self):
+        self.cache = None
+        self.translator = None
+        self.inflight = {}
+        self.lock = threading.Lock()
+        self.stats = Counter()
+
+    def backend(self):
+        ## Any TRANSLATOR that is not a built-in name is imported as
+        ## 'package.module:Class'
+        if self.translator is None:
+            name = app.config['TRANSLATOR']
+            cls = BACKENDS.get(name) or import_string(name)
+            self.translator = cls(app.config)
+        return self.translator
+
+    def translate(self, texts, dest):
+        """Translations into `dest` of [(text, source)], in order."""
+        if self.cache is None:
+            self.cache = TTLCache(app.config['TRANSLATION_CACHE_SIZE'],
+                                  app.config['TRANSLATION_CACHE_TTL'])
+        keys = [(text_hash(text), source, dest) for text, source in texts]
+        pending = dict(zip(keys, (text for text, _ in texts)))
+        found = {}
+        for key in pending:
+            text = self.cache.get(key)
+            if text is not None:
+                found[key] = text
+                self.stats['memory_hits'] += 1
+        mine, theirs = self.claim([k for k in pending if k not in found])
+        if mine:
+            try:
+                results = self.fill({key: pending[key] for key in mine}, dest)
+            except Exception as e:
+                self.resolve(mine, error=e)
+                raise
+            self.resolve(mine, results)
+            found.update(results)
+        for key, future in theirs.items():
+            found[key] = future.result(app.config['TRANSLATE_TIMEOUT'])
+            self.stats['coalesced'] += 1
+        return [found[key] for key in keys]
+
+    def claim(self, keys):
+        ## Split keys into those this call translates and those another
+        ## thread is already translating
+        mine, theirs = {}, {}
+        with self.lock:
+            for key in keys:
+                if key in self.inflight:
+                    theirs[key] = self.inflight[key]
+                else:
+                    mine[key] = self.inflight[key] = Future()
+        return mine, theirs
+
+    def resolve(self, futures, results=None, error=None):
+        with self.lock:
+            for key in futures:
+                del self.inflight[key]
+        for key, future in futures.items():
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(results[key])
+
+    def fill(self, pending, dest):
+        ## Translation table first, then the backend for whatever is left
+        results = {}
+        rows = Translation.query.filter(
+            Translation.body_hash.in_({key[0] for key in pending}),
+            Translation.dest == dest)
+        for row in rows:
+            key = (row.body_hash, row.source, row.dest)
+            if key in pending:
+                results[key] = row.text
+                self.stats['db_hits'] += 1
+        by_source = defaultdict(list)
+        for key in pending:
+            if key not in results:
+                by_source[key[1]].append(key)
+        rows = []
+        for source, keys in by_source.items():
+            translated = self.backend().translate(
+                [pending[key] for key in keys], source, dest)
+            self.stats['backend_calls'] += 1
+            for key, text in zip(keys, translated):
+                results[key] = text
+                rows.append({'body_hash': key[0], 'source': source,
+                             'dest': dest, 'text': text,
+                             'created_at': datetime.utcnow()})
+        if rows:
+            for batch in chunks(rows):
+                upsert(Translation.__table__, batch,
+                       ['body_hash', 'source', 'dest'], ['text'])
+            db.session.commit()
+        for key, text in results.items():
+            self.cache.set(key, text)
+        return results
+
+
+translations = Translations()
@@ -0,0 +1,112 @@
+"""Analytics benchmark: NumPy frame against a plain ORM loop.
+
+Seeds one user with a large transaction history, then times computing
+monthly spend by category, month-over-month deltas, running balances and
+top merchants by iterating ORM objects, by loading a columnar frame (cold)
+and by reusing the cached frame (warm).
+
+    python -m benchmarks.analytics --transactions 1000000
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+from collections import Counter, defaultdict
+from benchmarks import synthetic
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--transactions', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=42)
+    return parser.parse_args(argv)
+
+
+def orm_loop(user):
+    from app.models import Item, Account, Transaction
+    transactions = Transaction.query.join(Account).join(Item).filter(
+        Item.user_id == user.id, Transaction.date.isnot(None)).order_by(
+            Transaction.date).all()
+    by_category = defaultdict(float)
+    monthly = defaultdict(float)
+    merchants = Counter()
+    flows = defaultdict(list)
+    for t in transactions:
+        month = t.date.strftime('%Y-%m')
+        flows[t.account_id].append((t.date, t.amount))
+        if t.amount > 0:
+            by_category[(month, t.category_name)] += t.amount
+            monthly[month] += t.amount
+            merchants[t.new_name or t.original_name] += t.amount
+    months = sorted(monthly)
+    deltas = [monthly[b] - monthly[a] for a, b in zip(months, months[1:])]
+    balances = {}
+    for account_id, rows in flows.items():
+        balance = Account.query.get(account_id).current_balance or 0.0
+        running = []
+        for date, amount in reversed(rows):
+            running.append((date, balance))
+            balance += amount
+        balances[account_id] = running[::-1]
+    return by_category, deltas, balances, merchants.most_common(10)
+
+
+def numpy_frame(frame):
+    frame.monthly_spend_by_category()
+    frame.month_over_month()
+    frame.running_balances()
+    frame.top_merchants()
+
+
+def timed(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    rng = random.Random(args.seed)
+    if 'DATABASE_URL' not in os.environ:
+        os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(
+            tempfile.mkdtemp(), 'analytics-bench.db')
+    from app import app, db, analytics
+    from app.models import User
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        ids = synthetic.seed_users(db, 1)
+        synthetic.seed_finance(db, rng, ids, 1, args.transactions)
+        db.session.commit()
+        user = User.query.get(ids[0])
+
+        def orm():
+            orm_loop(user)
+            db.session.expire_all()
+
+        def cold():
+            analytics.invalidate(user.id)
+            numpy_frame(analytics.frame_for(user))
+
+        def warm():
+            numpy_frame(analytics.frame_for(user))
+
+        results = [('orm loop', timed(orm, args.repeat)),
+                   ('numpy cold', timed(cold, args.repeat)),
+                   ('numpy warm', timed(warm, args.repeat))]
+
+    print('{} transactions'.format(args.transactions))
+    for name, seconds in results:
+        print('{:<12} {:10.3f} ms {:8.1f}x'.format(
+            name, seconds * 1000, results[0][1] / seconds))
+
+
+if __name__ == '__main__':
+    main()
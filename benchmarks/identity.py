@@ -0,0 +1,88 @@
+"""Identity cache benchmark: authenticated requests with and without it.
+
+Seeds users, logs a test client in as each of a sample of them, then times
+the same round of GET requests with load_user reading the user table on
+every request and with the identity cache in front of it.
+
+    python -m benchmarks.identity --users 10000 --requests 5000
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+from benchmarks import synthetic
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--clients', type=int, default=200,
+                        help='logged-in users making the requests')
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--path', default='/edit_profile')
+    parser.add_argument('--seed', type=int, default=42)
+    return parser.parse_args(argv)
+
+
+def run(app, clients, path, requests, rng):
+    from sqlalchemy import event
+    from app import db
+    statements = []
+
+    def count(*args):
+        statements.append(1)
+
+    event.listen(db.engine, 'before_cursor_execute', count)
+    try:
+        start = time.perf_counter()
+        for _ in range(requests):
+            response = rng.choice(clients).get(path)
+            assert response.status_code == 200, response.status_code
+        elapsed = time.perf_counter() - start
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count)
+    return requests / elapsed, len(statements) / requests
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if 'DATABASE_URL' not in os.environ:
+        os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(
+            tempfile.mkdtemp(), 'identity-bench.db')
+    from app import app, db, models
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        ids = synthetic.seed_users(db, args.users)
+        db.session.commit()
+        clients = []
+        for user_id in random.Random(args.seed).sample(
+                ids, min(args.clients, len(ids))):
+            client = app.test_client()
+            with client.session_transaction() as session:
+                session['_user_id'] = str(user_id)
+                session['_fresh'] = True
+            clients.append(client)
+
+        results = []
+        for name, size in (('no cache', 0),
+                           ('identity cache', args.users)):
+            app.config['IDENTITY_CACHE_SIZE'] = size
+            models.identity_cache = None
+            rate, queries = run(app, clients, args.path, args.requests,
+                                random.Random(args.seed))
+            results.append((name, rate, queries))
+        hit_rate = models.identity_cache_stats()['hit_rate']
+
+    print('{} requests to {} from {} users'.format(
+        args.requests, args.path, len(clients)))
+    for name, rate, queries in results:
+        print('{:<16} {:9.1f} req/s {:6.2f} queries/request {:6.2f}x'.format(
+            name, rate, queries, rate / results[0][1]))
+    print('identity cache hit rate {:.1%}'.format(hit_rate))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""Email delivery benchmark against a local debugging SMTP server.
+
+Starts an in-process SMTP sink that accepts and discards every message,
+points the app's mail settings at it, then times a burst of messages
+through the delivery pool and reports messages per second.
+
+    python -m benchmarks.mail --messages 2000 --workers 4
+"""
+import argparse
+import os
+import socketserver
+import tempfile
+import threading
+import time
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    ## Just enough SMTP for smtplib: every command is accepted, message
+    ## bodies are counted and discarded
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply('220 localhost sink')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line[:4].upper()
+            if command == b'EHLO':
+                self.reply('250-localhost')
+                self.reply('250 8BITMIME')
+            elif command == b'DATA':
+                self.reply('354 end with .')
+                while self.rfile.readline() not in (b'.\r\n', b''):
+                    pass
+                with self.server.lock:
+                    self.server.messages += 1
+                self.reply('250 queued')
+            elif command == b'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 ok')
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 0)):
+        super().__init__(address, SMTPHandler)
+        self.lock = threading.Lock()
+        self.messages = 0
+        self.connections = 0
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--batch', type=int, default=50)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if 'DATABASE_URL' not in os.environ:
+        os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(
+            tempfile.mkdtemp(), 'mail-bench.db')
+    from app import app, mail
+    from app.email import MailPool
+    from flask_mail import Message
+
+    sink = SMTPSink().start()
+    app.config.update(MAIL_SERVER='127.0.0.1',
+                      MAIL_PORT=sink.server_address[1], MAIL_USE_TLS=False,
+                      MAIL_USERNAME=None, MAIL_PASSWORD=None,
+                      MAIL_WORKERS=args.workers, MAIL_BATCH_SIZE=args.batch,
+                      MAIL_QUEUE_SIZE=args.messages)
+    mail.init_app(app)
+
+    with app.app_context():
+        pool = MailPool()
+        start = time.perf_counter()
+        for n in range(args.messages):
+            msg = Message('Benchmark {}'.format(n), sender='bench@localhost',
+                          recipients=['user{}@localhost'.format(n)])
+            msg.body = 'Hello'
+            pool.submit(msg)
+        pool.shutdown(timeout=600)
+        elapsed = time.perf_counter() - start
+    sink.stop()
+
+    print('{} messages over {} connections in {:.3f}s: {:.1f} msg/s'.format(
+        sink.messages, sink.connections, elapsed, sink.messages / elapsed))
+
+
+if __name__ == '__main__':
+    main()
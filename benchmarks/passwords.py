@@ -0,0 +1,102 @@
+"""Login throughput benchmark: inline password hashing against the pool.
+
+Seeds users with hashed passwords, then has concurrent threads, each with
+its own test client, POST /login as fast as they can, first hashing inline
+on the request thread and then through the password hashing process pool.
+
+    python -m benchmarks.passwords --concurrency 1 4 16 --logins 200
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import threading
+import time
+from benchmarks import synthetic
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, nargs='+',
+                        default=[1, 4, 16])
+    parser.add_argument('--logins', type=int, default=200,
+                        help='logins per concurrency level')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='PASSWORD_HASH_WORKERS for the pooled runs')
+    parser.add_argument('--cost', type=int, default=None,
+                        help='PASSWORD_HASH_COST (defaults to the config)')
+    return parser.parse_args(argv)
+
+
+def run(app, concurrency, logins, users):
+    ## Threads share one counter of logins left; returns logins per second
+    ## and the p95 login latency in milliseconds
+    remaining = iter(range(logins))
+    lock = threading.Lock()
+    latencies = []
+
+    def login():
+        client = app.test_client()
+        while True:
+            with lock:
+                n = next(remaining, None)
+            if n is None:
+                return
+            start = time.perf_counter()
+            response = client.post('/login', data={
+                'username': 'user{}'.format(n % users + 1),
+                'password': 'password'})
+            latencies.append(time.perf_counter() - start)
+            assert response.status_code == 302, response.status_code
+            client.get('/logout')
+
+    threads = [threading.Thread(target=login) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    p95 = statistics.quantiles(latencies, n=20)[-1] if len(latencies) > 1 \
+        else latencies[0]
+    return logins / elapsed, p95 * 1000
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if 'DATABASE_URL' not in os.environ:
+        os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(
+            tempfile.mkdtemp(), 'passwords-bench.db')
+    from app import app, db
+    from app.models import User
+    from app.passwords import configured, hasher
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    if args.cost:
+        app.config['PASSWORD_HASH_COST'] = args.cost
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        synthetic.seed_users(db, args.users)
+        ## One hash for everyone: seeding isn't what's being measured
+        User.query.update({User.password_hash: hasher.hash('password')})
+        db.session.commit()
+
+    results = []
+    for name, workers in (('inline', 0), ('pool', args.workers)):
+        app.config['PASSWORD_HASH_WORKERS'] = workers
+        for concurrency in args.concurrency:
+            rate, p95 = run(app, concurrency, args.logins, args.users)
+            results.append((name, concurrency, rate, p95))
+    hasher.shutdown()
+
+    print('{} logins per level, {} hash workers, {} {}'.format(
+        args.logins, args.workers, *configured(app.config)))
+    for name, concurrency, rate, p95 in results:
+        print('{:<7} concurrency {:3d} {:8.1f} logins/s   p95 {:8.1f} ms'
+              .format(name, concurrency, rate, p95))
+
+
+if __name__ == '__main__':
+    main()
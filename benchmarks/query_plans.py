@@ -0,0 +1,177 @@
+"""Query plans and timings for the route queries, with and without indexes.
+
+Seeds users, a follow graph, posts, Items, Accounts and Transactions, then for
+every query a route issues records the database's plan (EXPLAIN QUERY PLAN on
+SQLite, EXPLAIN ANALYZE on Postgres) and the median of several runs. The
+indexes and keys from migration e1f06b3c8a52 are then dropped and everything
+is measured again, giving before/after numbers from one dataset.
+
+    python -m benchmarks.query_plans --output plans.json
+    DATABASE_URL=postgresql://localhost/annex_bench python -m benchmarks.query_plans
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+from benchmarks import synthetic
+
+
+## Secondary indexes added by the migration; `followers` also lost its key
+MIGRATION_INDEXES = [
+    'ix_followers_followed_id', 'ix_post_user_id_timestamp',
+    'ix_group_user_id', 'ix_item_user_id', 'ix_account_item_id',
+    'ix_account_group_id', 'ix_transaction_account_id_date',
+    'ix_transaction_original_name',
+    'ix_transaction_account_id_merchant_key']
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--follows', type=int, default=20)
+    parser.add_argument('--posts', type=int, default=200000)
+    parser.add_argument('--linked-users', type=int, default=2000,
+                        help='users with Plaid Items')
+    parser.add_argument('--transactions', type=int, default=500000)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='write results as JSON here')
+    return parser.parse_args(argv)
+
+
+def route_queries(user, other, item, accounts):
+    ## (route, description, query) for every query the hot routes issue
+    from sqlalchemy import select
+    from app.models import Post, Item, Account, Transaction, merchant_key
+    per_page = 25
+    name = Transaction.query.filter(
+        Transaction.account_id == accounts[0]).first().original_name
+    return [
+        ('index', 'home feed (UNION)',
+         user.followed_posts().limit(per_page)),
+        ('index', 'home feed (timeline)',
+         user.timeline_posts().limit(per_page)),
+        ('explore', 'all posts',
+         Post.query.order_by(Post.timestamp.desc(), Post.id.desc())
+         .limit(per_page)),
+        ('user', 'profile posts',
+         other.posts.order_by(Post.timestamp.desc(), Post.id.desc())
+         .limit(per_page)),
+        ('user', 'is following',
+         user.followed.filter_by(id=other.id)),
+        ('event', 'item lookup', Item.query.filter_by(id=item)),
+        ('event', 'rename map',
+         Transaction.query.join(Account).join(Item).filter(
+             Item.user_id == user.id, Transaction.new_name.isnot(None))),
+        ('cash', 'linked items', Item.query.filter_by(user_id=user.id)),
+        ('cash', 'transactions for accounts',
+         Transaction.query.filter(Transaction.account_id.in_(accounts))
+         .order_by(Transaction.date.desc())),
+        ('update_transaction', 'rename matches',
+         Transaction.query.filter(
+             Transaction.account_id.in_(
+                 select(Account.id).join(Item).where(
+                     Item.user_id == user.id)),
+             Transaction.merchant_key.in_([merchant_key(name)]))),
+        ('delete_item', 'item accounts',
+         Account.query.filter_by(item_id=item)),
+    ]
+
+
+def explain(db, query):
+    dialect = db.engine.dialect.name
+    sql = str(query.statement.compile(
+        dialect=db.engine.dialect, compile_kwargs={'literal_binds': True}))
+    prefix = {'sqlite': 'EXPLAIN QUERY PLAN ',
+              'postgresql': 'EXPLAIN ANALYZE '}.get(dialect, 'EXPLAIN ')
+    rows = db.session.execute(db.text(prefix + sql)).fetchall()
+    if dialect == 'sqlite':
+        return [row[-1] for row in rows]
+    return [' | '.join(str(c) for c in row) for row in rows]
+
+
+def measure(db, queries, repeat):
+    results = []
+    for route, description, query in queries:
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            query.all()
+            timings.append(time.perf_counter() - start)
+        results.append({'route': route, 'query': description,
+                        'median_ms': statistics.median(timings) * 1000,
+                        'plan': explain(db, query)})
+    return results
+
+
+def drop_migration_indexes(db):
+    from sqlalchemy.schema import DropIndex, DropTable
+    from app.models import followers
+    for table in db.metadata.tables.values():
+        for index in table.indexes:
+            if index.name in MIGRATION_INDEXES:
+                db.session.execute(DropIndex(index))
+    ## Recreate followers as the old unkeyed table
+    db.session.execute(db.text(
+        'CREATE TABLE followers_unkeyed AS SELECT * FROM followers'))
+    db.session.execute(DropTable(followers))
+    db.session.execute(db.text(
+        'ALTER TABLE followers_unkeyed RENAME TO followers'))
+    db.session.commit()
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    rng = random.Random(args.seed)
+    if 'DATABASE_URL' not in os.environ:
+        os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(
+            tempfile.mkdtemp(), 'query-plans.db')
+    from app import app, db
+    from app.models import User, rebuild_timelines
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        ids = synthetic.seed_users(db, args.users)
+        synthetic.seed_follows(db, rng, ids, args.follows)
+        synthetic.seed_posts(db, rng, ids, args.posts)
+        items, accounts = synthetic.seed_finance(
+            db, rng, ids, args.linked_users, args.transactions)
+        db.session.commit()
+        rebuild_timelines()
+        if db.engine.dialect.name == 'postgresql':
+            db.session.execute(db.text('ANALYZE'))
+            db.session.commit()
+
+        user = User.query.get(items[0]['user_id'])
+        other = User.query.get(1)
+        item = items[0]['id']
+        item_accounts = [a for a in accounts if a.startswith(item + '-')]
+        queries = route_queries(user, other, item, item_accounts)
+
+        after = measure(db, queries, args.repeat)
+        drop_migration_indexes(db)
+        before = measure(db, queries, args.repeat)
+
+    report = {'dialect': db.engine.dialect.name, 'args': vars(args),
+              'queries': [{'route': b['route'], 'query': b['query'],
+                           'before_ms': b['median_ms'],
+                           'after_ms': a['median_ms'],
+                           'before_plan': b['plan'],
+                           'after_plan': a['plan']}
+                          for b, a in zip(before, after)]}
+    for q in report['queries']:
+        print('{:<20} {:<28} {:9.3f} ms -> {:9.3f} ms'.format(
+            q['route'], q['query'], q['before_ms'], q['after_ms']))
+        for line in q['after_plan']:
+            print('    ' + line)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""Render benchmark for one 25-post feed page.
+
+Times rendering the post rows of a page with the fragment cache disabled,
+cold and warm, for each cache backend.
+
+    python -m benchmarks.render --repeat 200
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+from benchmarks import synthetic
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--authors', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=42)
+    return parser.parse_args(argv)
+
+
+def time_page(render, posts, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        render(posts)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    rng = random.Random(args.seed)
+    if 'DATABASE_URL' not in os.environ:
+        os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(
+            tempfile.mkdtemp(), 'render-bench.db')
+    from flask import g
+    from app import app, db, fragments
+    from app.models import Post
+
+    with app.test_request_context():
+        g.locale = 'en'
+        db.drop_all()
+        db.create_all()
+        ids = synthetic.seed_users(db, args.authors)
+        synthetic.seed_posts(db, rng, ids, app.config['POSTS_PER_PAGE'])
+        db.session.commit()
+        posts = Post.query.order_by(Post.timestamp.desc()).all()
+
+        app.config['FRAGMENT_CACHE'] = 'null'
+        print('{:<16} {:8.3f} ms'.format(
+            'no cache', time_page(fragments.render_posts, posts,
+                                  args.repeat)))
+        for name in ('memory', 'file'):
+            app.config['FRAGMENT_CACHE'] = name
+            app.config['FRAGMENT_CACHE_DIR'] = tempfile.mkdtemp()
+            fragments._backend = None
+            cold = time_page(fragments.render_posts, posts, 1)
+            warm = time_page(fragments.render_posts, posts, args.repeat)
+            print('{:<16} {:8.3f} ms cold {:8.3f} ms warm'.format(
+                name, cold, warm))
+
+
+if __name__ == '__main__':
+    main()
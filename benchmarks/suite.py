@@ -0,0 +1,249 @@
+"""End-to-end benchmark suite with machine-readable results.
+
+Seeds one production-shaped dataset (users, a power-law follow graph, posts,
+Items, Accounts and millions of Transactions), then times:
+
+  * the index, explore and user feeds through the Flask test client, first
+    page and the page after it
+  * Transaction.handle_db_transactions ingesting a sync of added, modified
+    and removed transactions
+  * RenameRule.rename propagating a rename over a user's history
+  * purge_item, the database side of delete_item, on a populated Item
+
+Results are written as JSON. Pass --compare with an earlier run to print the
+change in every median and exit non-zero if any regressed past --tolerance.
+
+    python -m benchmarks.suite --transactions 2000000 --output run.json
+    python -m benchmarks.suite --compare run.json
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from benchmarks import synthetic
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--follows', type=int, default=20,
+                        help='average follows per user')
+    parser.add_argument('--posts', type=int, default=200000)
+    parser.add_argument('--linked-users', type=int, default=1000,
+                        help='users with Plaid Items')
+    parser.add_argument('--transactions', type=int, default=2000000)
+    parser.add_argument('--ingest', type=int, default=500,
+                        help='transactions per sync in the ingest benchmark')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='write results as JSON here')
+    parser.add_argument('--compare', help='earlier JSON results to diff')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed slowdown before --compare fails')
+    return parser.parse_args(argv)
+
+
+def summary(name, timings, **extra):
+    timings = sorted(timings)
+    result = {'name': name, 'unit': 'ms', 'runs': len(timings),
+              'median': statistics.median(timings) * 1000,
+              'mean': statistics.mean(timings) * 1000,
+              'p95': timings[math.ceil(0.95 * len(timings)) - 1] * 1000,
+              'min': timings[0] * 1000}
+    result.update(extra)
+    print('{:<34} median {:9.3f} ms   p95 {:9.3f} ms'.format(
+        name, result['median'], result['p95']))
+    return result
+
+
+def seed(db, args, rng):
+    from app.models import User, rebuild_timelines, rebuild_spend_rollups
+    started = time.perf_counter()
+    ids = synthetic.seed_users(db, args.users)
+    synthetic.seed_follows(db, rng, ids, args.follows)
+    synthetic.seed_posts(db, rng, ids, args.posts)
+    items, accounts = synthetic.seed_finance(
+        db, rng, ids, args.linked_users, args.transactions)
+    db.session.commit()
+    User.repair_follow_counts()
+    rebuild_timelines()
+    rebuild_spend_rollups()
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(db.text('ANALYZE'))
+        db.session.commit()
+    return ids, items, accounts, time.perf_counter() - started
+
+
+def bench_feeds(app, ids, repeat, rng):
+    ## Each sampled user reads the first page of a feed and then follows its
+    ## next link, as a browser would
+    from app.models import User
+    client = app.test_client()
+    sample = rng.sample(ids, min(repeat, len(ids)))
+    results = []
+    for name, path in (('index', lambda u: '/index'),
+                       ('explore', lambda u: '/explore'),
+                       ('user', lambda u: '/user/' + u.username)):
+        first, second = [], []
+        for user_id in sample:
+            user = User.query.get(user_id)
+            with client.session_transaction() as session:
+                session['_user_id'] = str(user_id)
+                session['_fresh'] = True
+            start = time.perf_counter()
+            response = client.get(path(user))
+            first.append(time.perf_counter() - start)
+            assert response.status_code == 200, response.status_code
+            next_url = page_link(response.get_data(as_text=True))
+            if next_url:
+                start = time.perf_counter()
+                client.get(next_url)
+                second.append(time.perf_counter() - start)
+        results.append(summary('feed.{}.first_page'.format(name), first))
+        if second:
+            results.append(summary('feed.{}.next_page'.format(name), second))
+    return results
+
+
+def page_link(html):
+    ## The "older posts" cursor link from a rendered feed page
+    marker = 'cursor='
+    at = html.find(marker)
+    if at < 0:
+        return None
+    start = html.rfind('"', 0, at) + 1
+    return html[start:html.find('"', at)].replace('&amp;', '&')
+
+
+def bench_ingest(db, items, accounts, batch, repeat, rng):
+    from app.models import User, Transaction
+    user = User.query.get(items[0]['user_id'])
+    own = [a for a in accounts if a.startswith(items[0]['id'] + '-')]
+    merchants = ['{} #{}'.format(m, n) for m in synthetic.MERCHANTS
+                 for n in range(200)]
+    timings, phases = [], {}
+    for run in range(repeat):
+        added = [synthetic.plaid_transaction(
+            rng, 'sync-{}-{}'.format(run, n), rng.choice(own), merchants)
+            for n in range(batch)]
+        ## Modify and remove some of the previous sync's transactions
+        previous = [synthetic.plaid_transaction(
+            rng, 'sync-{}-{}'.format(run - 1, n), rng.choice(own),
+            merchants) for n in range(batch // 5)] if run else []
+        removed = [{'transaction_id': 'sync-{}-{}'.format(run - 1, n)}
+                   for n in range(batch // 5, batch // 4)] if run else []
+        start = time.perf_counter()
+        stats = Transaction.handle_db_transactions(added, previous, removed,
+                                                   user)
+        timings.append(time.perf_counter() - start)
+        for phase, seconds in stats['timings'].items():
+            phases.setdefault(phase, []).append(seconds * 1000)
+    return [summary('ingest.handle_db_transactions', timings,
+                    transactions=batch,
+                    phases={p: statistics.median(t)
+                            for p, t in phases.items()})]
+
+
+def bench_rename(db, items, repeat):
+    from app.models import User, Transaction, Account, RenameRule
+    user = User.query.get(items[0]['user_id'])
+    names = [name for (name,) in db.session.query(
+        Transaction.original_name).join(Account).filter(
+            Account.item_id == items[0]['id']).distinct().limit(repeat)]
+    timings, renamed = [], 0
+    for n, name in enumerate(names):
+        start = time.perf_counter()
+        renamed += RenameRule.rename(user, name, 'Renamed {}'.format(n))
+        timings.append(time.perf_counter() - start)
+    return [summary('rename.propagate', timings,
+                    transactions_per_rename=renamed / max(1, len(names)))]
+
+
+def bench_delete(db, items, repeat):
+    ## Item removal minus the Plaid call, on Items owned by other users so
+    ## the ingest and rename benchmarks are unaffected
+    from app.models import purge_item
+    others = [i for i in items if i['user_id'] != items[0]['user_id']]
+    timings, removed = [], 0
+    for item in others[-repeat:]:
+        start = time.perf_counter()
+        removed += purge_item(item['id'])
+        timings.append(time.perf_counter() - start)
+    return [summary('delete_item.purge', timings,
+                    transactions_per_item=removed / max(1, len(timings)))]
+
+
+def compare(results, path, tolerance):
+    with open(path) as f:
+        baseline = {r['name']: r for r in json.load(f)['results']}
+    regressed = []
+    print('\ncompared with {}'.format(path))
+    for result in results:
+        before = baseline.get(result['name'])
+        if before is None:
+            continue
+        change = result['median'] / before['median'] - 1 \
+            if before['median'] else 0.0
+        print('{:<34} {:9.3f} ms -> {:9.3f} ms {:+7.1%}'.format(
+            result['name'], before['median'], result['median'], change))
+        if change > tolerance:
+            regressed.append(result['name'])
+    return regressed
+
+
+def revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    rng = random.Random(args.seed)
+    if 'DATABASE_URL' not in os.environ:
+        os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(
+            tempfile.mkdtemp(), 'suite-bench.db')
+    from app import app, db
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        ids, items, accounts, seconds = seed(db, args, rng)
+        print('seeded {} users, {} posts, {} items, {} transactions in '
+              '{:.1f}s'.format(args.users, args.posts, len(items),
+                               args.transactions, seconds))
+        results = bench_feeds(app, ids, args.repeat, rng)
+        results += bench_ingest(db, items, accounts, args.ingest,
+                                args.repeat, rng)
+        results += bench_rename(db, items, args.repeat)
+        results += bench_delete(db, items, args.repeat)
+        dialect = db.engine.dialect.name
+
+    report = {'created': datetime.utcnow().isoformat(),
+              'revision': revision(), 'dialect': dialect,
+              'python': platform.python_version(), 'args': vars(args),
+              'seed_seconds': seconds, 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        regressed = compare(results, args.compare, args.tolerance)
+        if regressed:
+            print('regressed: ' + ', '.join(regressed))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""Seeded synthetic data for the benchmarks.
+
+Every generator takes a `random.Random` so runs are reproducible, and writes
+with Core executemany batches rather than ORM objects. Rows are generated
+lazily and inserted a batch at a time, so millions of transactions never sit
+in memory at once.
+"""
+from datetime import datetime, timedelta
+from itertools import accumulate, islice
+
+
+MERCHANTS = ['AMAZON', 'STARBUCKS', 'UBER', 'SHELL', 'WHOLE FOODS', 'NETFLIX',
+             'SPOTIFY', 'TARGET', 'COSTCO', 'CHIPOTLE', 'LYFT', 'WALGREENS']
+CATEGORIES = ['Food and Drink', 'Travel', 'Shops', 'Transfer', 'Payment',
+              'Recreation', 'Service', 'Healthcare']
+
+
+def chunked(rows, size=10000):
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+def insert(db, table, rows):
+    for batch in chunked(rows):
+        db.session.execute(table.insert(), batch)
+
+
+def zipf_weights(n, exponent=1.1):
+    return [1.0 / rank ** exponent for rank in range(1, n + 1)]
+
+
+def seed_users(db, users):
+    from app.models import User
+    insert(db, User.__table__,
+           [{'id': i, 'username': 'user{}'.format(i),
+             'email': 'user{}@example.com'.format(i)}
+            for i in range(1, users + 1)])
+    return list(range(1, users + 1))
+
+
+def seed_follows(db, rng, ids, follows):
+    ## Follow targets drawn from a power law: a few accounts get most follows
+    from app.models import followers
+    ## Cumulative weights once, not per follower: choices() would otherwise
+    ## re-accumulate all n weights on every call
+    cum_weights = list(accumulate(zipf_weights(len(ids))))
+    edges = set()
+    for follower in ids:
+        for followed in rng.choices(ids, cum_weights=cum_weights, k=follows):
+            if followed != follower:
+                edges.add((follower, followed))
+    insert(db, followers, [{'follower_id': a, 'followed_id': b}
+                           for a, b in edges])
+    return len(edges)
+
+
+def seed_posts(db, rng, ids, posts):
+    from app.models import Post
+    start = datetime.utcnow() - timedelta(days=365)
+    insert(db, Post.__table__,
+           ({'body': 'post {}'.format(n), 'user_id': rng.choice(ids),
+             'timestamp': start + timedelta(seconds=n * 7)}
+            for n in range(posts)))
+
+
+def seed_finance(db, rng, ids, linked_users, transactions,
+                 items_per_user=2, accounts_per_item=3):
+    ## Items and accounts for the first `linked_users` users, then
+    ## `transactions` rows spread over their accounts
+    from app.models import Item, Account, Transaction
+    items, accounts = [], []
+    for user_id in ids[:linked_users]:
+        for i in range(items_per_user):
+            item_id = 'item-{}-{}'.format(user_id, i)
+            items.append({'id': item_id, 'user_id': user_id,
+                          'access_token': 'access-' + item_id,
+                          'ins_id': 'ins_{}'.format(rng.randint(1, 50)),
+                          'ins_name': 'Bank {}'.format(i)})
+            for a in range(accounts_per_item):
+                accounts.append({'id': '{}-acc{}'.format(item_id, a),
+                                 'item_id': item_id,
+                                 'name': 'Account {}'.format(a),
+                                 'type': 'checking', 'current_balance': 0.0})
+    insert(db, Item.__table__, items)
+    insert(db, Account.__table__, accounts)
+    account_ids = [a['id'] for a in accounts]
+    merchants = ['{} #{}'.format(m, n) for m in MERCHANTS for n in range(200)]
+    start = datetime.utcnow() - timedelta(days=3 * 365)
+    insert(db, Transaction.__table__,
+           (transaction_row(rng, n, rng.choice(account_ids), merchants, start)
+            for n in range(transactions)))
+    return items, account_ids
+
+
+def transaction_row(rng, n, account_id, merchants, start):
+    name = rng.choice(merchants)
+    category = rng.randrange(len(CATEGORIES))
+    return {'id': 'txn-{}'.format(n), 'original_name': name,
+            'merchant_key': name.strip().lower(),
+            'new_name': name.title() if rng.random() < 0.05 else None,
+            'account_id': account_id,
+            'date': start + timedelta(days=rng.randint(0, 3 * 365)),
+            'vendor_name': name, 'amount': round(rng.uniform(-500, 500), 2),
+            'iso_currency_code': 'USD', 'transaction_type': 'online',
+            'category_name': CATEGORIES[category], 'category_id': category}
+
+
+def plaid_transaction(rng, id, account_id, merchants=None):
+    ## A /transactions/sync `added` entry, as handle_db_transactions takes
+    name = rng.choice(merchants or MERCHANTS)
+    category = rng.randrange(len(CATEGORIES))
+    day = datetime.utcnow().date() - timedelta(days=rng.randint(0, 90))
+    return {'transaction_id': id, 'name': name, 'account_id': account_id,
+            'date': day.isoformat(), 'merchant_name': name,
+            'amount': round(rng.uniform(-500, 500), 2),
+            'iso_currency_code': 'USD', 'payment_channel': 'online',
+            'category': [CATEGORIES[category]], 'category_id': category}
@@ -0,0 +1,102 @@
+"""Home feed benchmark: UNION query vs. precomputed timelines.
+
+Seeds a synthetic follow graph (100k users by default, follow targets drawn
+from a power law) and times the first feed page for a sample of users under
+both strategies, plus the write cost of fanning out new posts.
+
+    python -m benchmarks.timeline --users 100000 --follows 20 --posts 200000
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+from benchmarks import synthetic
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--follows', type=int, default=20,
+                        help='average follows per user')
+    parser.add_argument('--posts', type=int, default=200000)
+    parser.add_argument('--samples', type=int, default=200,
+                        help='users whose feed is read per strategy')
+    parser.add_argument('--writes', type=int, default=200,
+                        help='posts created per strategy to time fan-out')
+    parser.add_argument('--seed', type=int, default=42)
+    return parser.parse_args(argv)
+
+
+def seed(db, users, follows, posts, rng):
+    ids = synthetic.seed_users(db, users)
+    edges = synthetic.seed_follows(db, rng, ids, follows)
+    synthetic.seed_posts(db, rng, ids, posts)
+    db.session.commit()
+    return edges
+
+
+def time_reads(app, User, sample, fanout):
+    app.config['TIMELINE_FANOUT'] = fanout
+    per_page = app.config['POSTS_PER_PAGE']
+    timings = []
+    for user_id in sample:
+        user = User.query.get(user_id)
+        start = time.perf_counter()
+        user.home_posts().limit(per_page).all()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def time_writes(app, db, Post, authors, fanout):
+    app.config['TIMELINE_FANOUT'] = fanout
+    start = time.perf_counter()
+    for author in authors:
+        db.session.add(Post(body='benchmark', user_id=author))
+        db.session.commit()
+    return time.perf_counter() - start
+
+
+def summarize(name, timings):
+    timings = sorted(timings)
+    mean = sum(timings) / len(timings)
+    p95 = timings[int(len(timings) * 0.95) - 1]
+    print('{:<10} mean {:8.3f} ms   p95 {:8.3f} ms'.format(
+        name, mean * 1000, p95 * 1000))
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    rng = random.Random(args.seed)
+    if 'DATABASE_URL' not in os.environ:
+        os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(
+            tempfile.mkdtemp(), 'timeline-bench.db')
+    from app import app, db
+    from app.models import User, Post, rebuild_timelines
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        start = time.perf_counter()
+        edges = seed(db, args.users, args.follows, args.posts, rng)
+        print('seeded {} users, {} follows, {} posts in {:.1f}s'.format(
+            args.users, edges, args.posts, time.perf_counter() - start))
+
+        start = time.perf_counter()
+        entries = rebuild_timelines()
+        print('rebuilt {} timeline entries in {:.1f}s'.format(
+            entries, time.perf_counter() - start))
+
+        sample = rng.sample(range(1, args.users + 1), args.samples)
+        summarize('union', time_reads(app, User, sample, False))
+        summarize('timeline', time_reads(app, User, sample, True))
+
+        authors = rng.sample(range(1, args.users + 1), args.writes)
+        for name, fanout in (('union', False), ('timeline', True)):
+            elapsed = time_writes(app, db, Post, authors, fanout)
+            print('{:<10} {:8.3f} ms per post write'.format(
+                name, elapsed / args.writes * 1000))
+
+
+if __name__ == '__main__':
+    main()
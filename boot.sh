@@ -10,4 +10,10 @@ while true; do
     sleep 5
 done
 flask translate compile
-exec gunicorn -b :5000 --access-logfile - --error-logfile - annex:app
\ No newline at end of file
+# Workers add up their request metrics in METRICS_DIR, fresh on each boot
+export METRICS_DIR=${METRICS_DIR:-/tmp/annex-metrics}
+rm -rf "$METRICS_DIR" && mkdir -p "$METRICS_DIR"
+# Any number of workers, or of instances behind a load balancer: per-worker
+# caches either key on the data they hold (post fragments) or poll the
+# database for changes made elsewhere (load_user, see IDENTITY_CACHE_POLL)
+exec gunicorn -b :5000 -w ${WEB_CONCURRENCY:-4} --access-logfile - --error-logfile - annex:app
\ No newline at end of file
@@ -1,21 +1,114 @@
 import os
-import psycopg2
 basedir = os.path.abspath(os.path.dirname(__file__))
 
-DATABASE_URL = os.environ['DATABASE_URL']
-conn = psycopg2.connect(DATABASE_URL, sslmode='require')
+
+def env_int(name):
+    value = os.environ.get(name)
+    return None if value is None else int(value)
+
 
 class Config(object):
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'you-will-never-guess'
-    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL').replace(
-        'postgres://', 'postgresql://') or \
-        'sqlite:///' + os.path.join(basedir, 'app.db')
+    SQLALCHEMY_DATABASE_URI = (os.environ.get('DATABASE_URL') or
+        'sqlite:///' + os.path.join(basedir, 'app.db')).replace(
+        'postgres://', 'postgresql://')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    ## Optional read replica for GET requests (see app/database.py)
+    SQLALCHEMY_BINDS = {'replica': os.environ['DATABASE_REPLICA_URL'].replace(
+        'postgres://', 'postgresql://')} \
+        if os.environ.get('DATABASE_REPLICA_URL') else None
+    DB_REPLICA_MAX_LAG = float(os.environ.get('DB_REPLICA_MAX_LAG') or 5)
+    DB_REPLICA_LAG_INTERVAL = float(os.environ.get('DB_REPLICA_LAG_INTERVAL') or 5)
+    DB_REPLICA_STICKY = float(os.environ.get('DB_REPLICA_STICKY') or 10)
+    ## Pool profile (see app/database.py); each DB_* setting overrides it
+    DB_PROFILE = os.environ.get('DB_PROFILE') or (
+        'development' if os.environ.get('FLASK_ENV') == 'development'
+        else 'production')
+    DB_POOL_SIZE = env_int('DB_POOL_SIZE')
+    DB_MAX_OVERFLOW = env_int('DB_MAX_OVERFLOW')
+    DB_POOL_TIMEOUT = env_int('DB_POOL_TIMEOUT')
+    DB_POOL_RECYCLE = env_int('DB_POOL_RECYCLE')
+    DB_POOL_PRE_PING = None if os.environ.get('DB_POOL_PRE_PING') is None \
+        else os.environ['DB_POOL_PRE_PING'].lower() in ('1', 'true', 'yes')
+    DB_STATEMENT_TIMEOUT = env_int('DB_STATEMENT_TIMEOUT')
+    DB_SSLMODE = os.environ.get('DB_SSLMODE')
+    DB_POOL_SLOW_WAIT = float(os.environ.get('DB_POOL_SLOW_WAIT') or 0.5)
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 25)
     MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS') is not None
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
+    MAIL_WORKERS = int(os.environ.get('MAIL_WORKERS') or 2)
+    MAIL_QUEUE_SIZE = int(os.environ.get('MAIL_QUEUE_SIZE') or 1000)
+    MAIL_QUEUE_TIMEOUT = float(os.environ.get('MAIL_QUEUE_TIMEOUT') or 5)
+    MAIL_BATCH_SIZE = int(os.environ.get('MAIL_BATCH_SIZE') or 50)
+    MAIL_MAX_RETRIES = int(os.environ.get('MAIL_MAX_RETRIES') or 3)
+    MAIL_RETRY_BACKOFF = float(os.environ.get('MAIL_RETRY_BACKOFF') or 1)
+    MAIL_IDLE_TIMEOUT = float(os.environ.get('MAIL_IDLE_TIMEOUT') or 30)
+    MAIL_DRAIN_TIMEOUT = float(os.environ.get('MAIL_DRAIN_TIMEOUT') or 10)
     ADMINS = ['your-email@example.com']
     LANGUAGES = ['en', 'es']
     POSTS_PER_PAGE = 25
+    TIMELINE_FANOUT = os.environ.get('TIMELINE_FANOUT') is not None
+    FRAGMENT_CACHE = os.environ.get('FRAGMENT_CACHE') or 'memory'
+    FRAGMENT_CACHE_SIZE = int(os.environ.get('FRAGMENT_CACHE_SIZE') or 10000)
+    FRAGMENT_CACHE_TTL = int(os.environ.get('FRAGMENT_CACHE_TTL') or 86400)
+    FRAGMENT_CACHE_DIR = os.environ.get('FRAGMENT_CACHE_DIR')
+    FRAGMENT_CACHE_VERSION = os.environ.get('FRAGMENT_CACHE_VERSION')
+    LANGUAGE_DETECT_WORKERS = int(os.environ.get('LANGUAGE_DETECT_WORKERS') or 2)
+    LANGUAGE_QUEUE_SIZE = int(os.environ.get('LANGUAGE_QUEUE_SIZE') or 1000)
+    LANGUAGE_CACHE_SIZE = int(os.environ.get('LANGUAGE_CACHE_SIZE') or 10000)
+    LANGUAGE_BACKFILL_BATCH = int(os.environ.get('LANGUAGE_BACKFILL_BATCH') or 1000)
+    TRANSLATOR = os.environ.get('TRANSLATOR') or 'stand-in'
+    MS_TRANSLATOR_KEY = os.environ.get('MS_TRANSLATOR_KEY')
+    MS_TRANSLATOR_REGION = os.environ.get('MS_TRANSLATOR_REGION')
+    TRANSLATE_TIMEOUT = float(os.environ.get('TRANSLATE_TIMEOUT') or 10)
+    TRANSLATE_BATCH_SIZE = int(os.environ.get('TRANSLATE_BATCH_SIZE') or 100)
+    TRANSLATION_CACHE_SIZE = int(os.environ.get('TRANSLATION_CACHE_SIZE') or 10000)
+    TRANSLATION_CACHE_TTL = int(os.environ.get('TRANSLATION_CACHE_TTL') or 86400)
+    IDENTITY_CACHE_SIZE = int(os.environ.get('IDENTITY_CACHE_SIZE') or 10000)
+    IDENTITY_CACHE_TTL = int(os.environ.get('IDENTITY_CACHE_TTL') or 60)
+    IDENTITY_CACHE_POLL = float(os.environ.get('IDENTITY_CACHE_POLL') or 1)
+    PASSWORD_HASH_ALGORITHM = os.environ.get('PASSWORD_HASH_ALGORITHM') or 'pbkdf2:sha256'
+    PASSWORD_HASH_COST = env_int('PASSWORD_HASH_COST')
+    PASSWORD_SALT_LENGTH = int(os.environ.get('PASSWORD_SALT_LENGTH') or 16)
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS') or 2)
+    PASSWORD_HASH_QUEUE_SIZE = int(os.environ.get('PASSWORD_HASH_QUEUE_SIZE') or 32)
+    PASSWORD_HASH_TIMEOUT = float(os.environ.get('PASSWORD_HASH_TIMEOUT') or 5)
+    LAST_SEEN_RESOLUTION = int(os.environ.get('LAST_SEEN_RESOLUTION') or 60)
+    LAST_SEEN_FLUSH_INTERVAL = int(os.environ.get('LAST_SEEN_FLUSH_INTERVAL') or 30)
+    LAST_SEEN_FLUSH_SIZE = int(os.environ.get('LAST_SEEN_FLUSH_SIZE') or 500)
+    LAST_SEEN_CACHE_SIZE = int(os.environ.get('LAST_SEEN_CACHE_SIZE') or 100000)
+    PLAID_CLIENT_ID = os.environ.get('PLAID_CLIENT_ID')
+    PLAID_SECRET = os.environ.get('PLAID_SECRET')
+    PLAID_ENV = os.environ.get('PLAID_ENV') or 'sandbox'
+    PLAID_PRODUCTS = (os.environ.get('PLAID_PRODUCTS') or 'transactions').split(',')
+    PLAID_COUNTRY_CODES = (os.environ.get('PLAID_COUNTRY_CODES') or 'US').split(',')
+    PLAID_REDIRECT_URI = os.environ.get('PLAID_REDIRECT_URI')
+    PLAID_POOL_SIZE = int(os.environ.get('PLAID_POOL_SIZE') or 10)
+    PLAID_HOST = os.environ.get('PLAID_HOST')
+    SYNC_MAX_RESTARTS = int(os.environ.get('SYNC_MAX_RESTARTS') or 5)
+    SYNC_RESTART_BACKOFF = float(os.environ.get('SYNC_RESTART_BACKOFF') or 1)
+    INSTITUTION_CACHE_SIZE = int(os.environ.get('INSTITUTION_CACHE_SIZE') or 1024)
+    INSTITUTION_CACHE_TTL = int(os.environ.get('INSTITUTION_CACHE_TTL') or 3600)
+    INSTITUTION_DB_TTL = int(os.environ.get('INSTITUTION_DB_TTL') or 7 * 86400)
+    ANALYTICS_CACHE_SIZE = int(os.environ.get('ANALYTICS_CACHE_SIZE') or 256)
+    ANALYTICS_CACHE_TTL = int(os.environ.get('ANALYTICS_CACHE_TTL') or 3600)
+    BALANCE_REFRESH_WORKERS = int(os.environ.get('BALANCE_REFRESH_WORKERS') or 8)
+    BALANCE_REFRESH_RATE = float(os.environ.get('BALANCE_REFRESH_RATE') or 10)
+    BALANCE_REFRESH_MIN_AGE = int(os.environ.get('BALANCE_REFRESH_MIN_AGE') or 3600)
+    BALANCE_REFRESH_INTERVAL = int(os.environ.get('BALANCE_REFRESH_INTERVAL') or 900)
+    ITEM_DELETE_ASYNC = os.environ.get('ITEM_DELETE_ASYNC') is not None
+    ITEM_PURGE_CHUNK_SIZE = int(os.environ.get('ITEM_PURGE_CHUNK_SIZE') or 5000)
+    METRICS_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+    METRICS_SLOW_STATEMENTS = int(os.environ.get('METRICS_SLOW_STATEMENTS') or 10)
+    METRICS_N_PLUS_ONE = int(os.environ.get('METRICS_N_PLUS_ONE') or 5)
+    METRICS_DEBUG_HEADER = os.environ.get('METRICS_DEBUG_HEADER') is not None
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    METRICS_DIR = os.environ.get('METRICS_DIR')
+    JOB_WORKERS = int(os.environ.get('JOB_WORKERS') or 4)
+    JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL') or 1)
+    JOB_VISIBILITY_TIMEOUT = int(os.environ.get('JOB_VISIBILITY_TIMEOUT') or 300)
+    JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS') or 5)
+    JOB_RETRY_BACKOFF = float(os.environ.get('JOB_RETRY_BACKOFF') or 10)
+    JOB_RETRY_BACKOFF_MAX = float(os.environ.get('JOB_RETRY_BACKOFF_MAX') or 900)
@@ -0,0 +1,64 @@
+"""spending rollups
+
+Revision ID: 2b6e9f4c7a81
+Revises: f27b9a0c6d18
+Create Date: 2026-10-17 19:12:44.208316
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2b6e9f4c7a81'
+down_revision = 'f27b9a0c6d18'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('daily_spend',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('account_id', sa.String(length=60), nullable=False),
+    sa.Column('category_name', sa.String(length=128), nullable=False),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('total', sa.Float(), nullable=True),
+    sa.Column('count', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'account_id', 'category_name', 'day')
+    )
+    with op.batch_alter_table('daily_spend', schema=None) as batch_op:
+        batch_op.create_index('ix_daily_spend_user_id_day', ['user_id', 'day'], unique=False)
+
+    op.create_table('monthly_spend',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('month', sa.Date(), nullable=False),
+    sa.Column('total', sa.Float(), nullable=True),
+    sa.Column('count', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'month')
+    )
+
+    # Backfill from existing transactions
+    op.execute('INSERT INTO daily_spend (user_id, account_id, category_name, day, total, count) '
+               "SELECT item.user_id, t.account_id, coalesce(t.category_name, 'Uncategorized'), "
+               'date(t.date), sum(t.amount), count(*) '
+               'FROM "transaction" t JOIN account ON account.id = t.account_id '
+               'JOIN item ON item.id = account.item_id '
+               'WHERE t.date IS NOT NULL AND item.user_id IS NOT NULL '
+               "GROUP BY item.user_id, t.account_id, coalesce(t.category_name, 'Uncategorized'), date(t.date)")
+    if op.get_bind().dialect.name == 'sqlite':
+        month = "date(day, 'start of month')"
+    else:
+        month = "CAST(date_trunc('month', day) AS DATE)"
+    op.execute('INSERT INTO monthly_spend (user_id, month, total, count) '
+               'SELECT user_id, {0}, sum(total), sum(count) FROM daily_spend '
+               'GROUP BY user_id, {0}'.format(month))
+
+
+def downgrade():
+    op.drop_table('monthly_spend')
+    with op.batch_alter_table('daily_spend', schema=None) as batch_op:
+        batch_op.drop_index('ix_daily_spend_user_id_day')
+
+    op.drop_table('daily_spend')
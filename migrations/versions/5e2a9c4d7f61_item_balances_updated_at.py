@@ -0,0 +1,28 @@
+"""item balances_updated_at
+
+Revision ID: 5e2a9c4d7f61
+Revises: 2b6e9f4c7a81
+Create Date: 2026-10-17 20:41:09.731524
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e2a9c4d7f61'
+down_revision = '2b6e9f4c7a81'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('item', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('balances_updated_at', sa.DateTime(), nullable=True))
+        batch_op.create_index(batch_op.f('ix_item_balances_updated_at'), ['balances_updated_at'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('item', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_item_balances_updated_at'))
+        batch_op.drop_column('balances_updated_at')
@@ -0,0 +1,48 @@
+"""item cascade delete
+
+Revision ID: 8a4f1c6e2d93
+Revises: 5e2a9c4d7f61
+Create Date: 2026-10-17 21:26:47.118304
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8a4f1c6e2d93'
+down_revision = '5e2a9c4d7f61'
+branch_labels = None
+depends_on = None
+
+CASCADES = (('account', 'item_id', 'item'),
+            ('transaction', 'account_id', 'account'))
+
+
+def replace_foreign_keys(ondelete):
+    bind = op.get_bind()
+    for table, column, parent in CASCADES:
+        existing = [fk['name'] for fk in
+                    sa.inspect(bind).get_foreign_keys(table)
+                    if fk['constrained_columns'] == [column]]
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            for name in existing:
+                if name:
+                    batch_op.drop_constraint(name, type_='foreignkey')
+            batch_op.create_foreign_key(
+                'fk_{}_{}_{}'.format(table, column, parent), parent,
+                [column], ['id'], ondelete=ondelete)
+
+
+def upgrade():
+    with op.batch_alter_table('item', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('deleted_at', sa.DateTime(), nullable=True))
+
+    replace_foreign_keys('CASCADE')
+
+
+def downgrade():
+    replace_foreign_keys(None)
+
+    with op.batch_alter_table('item', schema=None) as batch_op:
+        batch_op.drop_column('deleted_at')
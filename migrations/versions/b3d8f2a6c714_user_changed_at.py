@@ -0,0 +1,28 @@
+"""user changed_at
+
+Revision ID: b3d8f2a6c714
+Revises: 4c9e1b7d3f05
+Create Date: 2026-10-17 23:05:18.274930
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b3d8f2a6c714'
+down_revision = '4c9e1b7d3f05'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('changed_at', sa.DateTime(), nullable=True))
+        batch_op.create_index(batch_op.f('ix_user_changed_at'), ['changed_at'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_user_changed_at'))
+        batch_op.drop_column('changed_at')
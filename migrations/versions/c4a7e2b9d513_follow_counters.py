@@ -0,0 +1,35 @@
+"""follow counters
+
+Revision ID: c4a7e2b9d513
+Revises: 9d3c5e7a1b24
+Create Date: 2026-10-17 17:02:36.512087
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4a7e2b9d513'
+down_revision = '9d3c5e7a1b24'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('follower_count', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('followed_count', sa.Integer(), server_default='0', nullable=False))
+
+    # Backfill from the existing follow graph
+    op.execute('UPDATE "user" SET '
+               'follower_count = (SELECT count(*) FROM followers '
+               'WHERE followers.followed_id = "user".id), '
+               'followed_count = (SELECT count(*) FROM followers '
+               'WHERE followers.follower_id = "user".id)')
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('followed_count')
+        batch_op.drop_column('follower_count')
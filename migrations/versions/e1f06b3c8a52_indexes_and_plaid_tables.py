@@ -0,0 +1,122 @@
+"""indexes, constraints and plaid tables
+
+Revision ID: e1f06b3c8a52
+Revises: c4a7e2b9d513
+Create Date: 2026-10-17 17:31:52.204417
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e1f06b3c8a52'
+down_revision = 'c4a7e2b9d513'
+branch_labels = None
+depends_on = None
+
+
+def create_index(name, table, columns):
+    ## Tables built by create_all() already carry their model's indexes
+    existing = sa.inspect(op.get_bind()).get_indexes(table)
+    if name not in {index['name'] for index in existing}:
+        op.create_index(name, table, columns, unique=False)
+
+
+def upgrade():
+    bind = op.get_bind()
+    tables = sa.inspect(bind).get_table_names()
+
+    # followers had no key: drop duplicate/NULL rows and key it on the pair
+    op.create_table('followers_new',
+    sa.Column('follower_id', sa.Integer(), nullable=False),
+    sa.Column('followed_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['followed_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['follower_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('follower_id', 'followed_id', name='pk_followers')
+    )
+    op.execute('INSERT INTO followers_new (follower_id, followed_id) '
+               'SELECT DISTINCT follower_id, followed_id FROM followers '
+               'WHERE follower_id IS NOT NULL AND followed_id IS NOT NULL')
+    op.drop_table('followers')
+    op.rename_table('followers_new', 'followers')
+    create_index('ix_followers_followed_id', 'followers', ['followed_id', 'follower_id'])
+
+    create_index('ix_post_user_id_timestamp', 'post', ['user_id', 'timestamp'])
+
+    # Item, Account and Transaction were only ever created with create_all()
+    if 'group' not in tables:
+        op.create_table('group',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.String(length=64), nullable=True),
+        sa.Column('user_id', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+        sa.PrimaryKeyConstraint('id')
+        )
+    create_index('ix_group_user_id', 'group', ['user_id'])
+
+    if 'item' not in tables:
+        op.create_table('item',
+        sa.Column('id', sa.String(length=60), nullable=False),
+        sa.Column('access_token', sa.String(length=60), nullable=True),
+        sa.Column('user_id', sa.Integer(), nullable=True),
+        sa.Column('ins_id', sa.String(length=10), nullable=True),
+        sa.Column('ins_name', sa.String(length=120), nullable=True),
+        sa.Column('cursor', sa.String(length=120), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('access_token')
+        )
+    elif sa.inspect(bind).get_pk_constraint('item')['constrained_columns'] != ['id']:
+        # the old key was (id, access_token); accounts reference id alone
+        with op.batch_alter_table('item', schema=None) as batch_op:
+            if bind.dialect.name == 'postgresql':
+                batch_op.drop_constraint('item_pkey', type_='primary')
+            batch_op.create_primary_key('pk_item', ['id'])
+            batch_op.create_unique_constraint('uq_item_access_token', ['access_token'])
+    create_index('ix_item_user_id', 'item', ['user_id'])
+
+    if 'account' not in tables:
+        op.create_table('account',
+        sa.Column('id', sa.String(length=60), nullable=False),
+        sa.Column('name', sa.String(length=128), nullable=True),
+        sa.Column('item_id', sa.String(length=60), nullable=True),
+        sa.Column('current_balance', sa.Float(), nullable=True),
+        sa.Column('type', sa.String(length=20), nullable=True),
+        sa.Column('group_id', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['group_id'], ['group.id'], ),
+        sa.ForeignKeyConstraint(['item_id'], ['item.id'], ),
+        sa.PrimaryKeyConstraint('id')
+        )
+        create_index('ix_account_name', 'account', ['name'])
+    create_index('ix_account_item_id', 'account', ['item_id'])
+    create_index('ix_account_group_id', 'account', ['group_id'])
+
+    if 'transaction' not in tables:
+        op.create_table('transaction',
+        sa.Column('id', sa.String(length=60), nullable=False),
+        sa.Column('original_name', sa.String(length=140), nullable=True),
+        sa.Column('new_name', sa.String(length=140), nullable=True),
+        sa.Column('account_id', sa.String(length=60), nullable=True),
+        sa.Column('date', sa.DateTime(), nullable=True),
+        sa.Column('vendor_name', sa.String(length=140), nullable=True),
+        sa.Column('vendor_type', sa.String(length=32), nullable=True),
+        sa.Column('amount', sa.Float(), nullable=True),
+        sa.Column('iso_currency_code', sa.String(length=10), nullable=True),
+        sa.Column('transaction_type', sa.String(length=20), nullable=True),
+        sa.Column('category_name', sa.String(length=128), nullable=True),
+        sa.Column('category_id', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['account_id'], ['account.id'], ),
+        sa.PrimaryKeyConstraint('id')
+        )
+    create_index('ix_transaction_account_id_date', 'transaction', ['account_id', 'date'])
+    create_index('ix_transaction_original_name', 'transaction', ['original_name'])
+
+
+def downgrade():
+    op.drop_index('ix_post_user_id_timestamp', table_name='post')
+    op.drop_index('ix_followers_followed_id', table_name='followers')
+    with op.batch_alter_table('followers', schema=None, recreate='always') as batch_op:
+        batch_op.drop_constraint('pk_followers', type_='primary')
+    # The Plaid tables predate migrations, so they are left in place with
+    # their indexes, as the models declare them
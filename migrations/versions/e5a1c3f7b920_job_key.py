@@ -0,0 +1,27 @@
+"""job job_key
+
+Revision ID: e5a1c3f7b920
+Revises: b3d8f2a6c714
+Create Date: 2026-10-17 23:41:07.519324
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5a1c3f7b920'
+down_revision = 'b3d8f2a6c714'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('job', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('job_key', sa.String(length=128), nullable=True))
+    op.execute('UPDATE job SET job_key = dedupe_key')
+
+
+def downgrade():
+    with op.batch_alter_table('job', schema=None) as batch_op:
+        batch_op.drop_column('job_key')
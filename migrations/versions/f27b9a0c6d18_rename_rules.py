@@ -0,0 +1,48 @@
+"""rename rules
+
+Revision ID: f27b9a0c6d18
+Revises: e1f06b3c8a52
+Create Date: 2026-10-17 18:05:19.630772
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f27b9a0c6d18'
+down_revision = 'e1f06b3c8a52'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('rename_rule',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('merchant_key', sa.String(length=140), nullable=False),
+    sa.Column('new_name', sa.String(length=140), nullable=True),
+    sa.Column('updated_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'merchant_key')
+    )
+    with op.batch_alter_table('transaction', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('merchant_key', sa.String(length=140), nullable=True))
+        batch_op.create_index('ix_transaction_account_id_merchant_key', ['account_id', 'merchant_key'], unique=False)
+
+    # Backfill keys, then turn existing renames into rules
+    op.execute('UPDATE "transaction" SET merchant_key = lower(trim(original_name))')
+    op.execute('INSERT INTO rename_rule (user_id, merchant_key, new_name, updated_at) '
+               'SELECT item.user_id, t.merchant_key, max(t.new_name), CURRENT_TIMESTAMP '
+               'FROM "transaction" t JOIN account ON account.id = t.account_id '
+               'JOIN item ON item.id = account.item_id '
+               'WHERE t.new_name IS NOT NULL AND t.merchant_key IS NOT NULL '
+               'AND item.user_id IS NOT NULL '
+               'GROUP BY item.user_id, t.merchant_key')
+
+
+def downgrade():
+    with op.batch_alter_table('transaction', schema=None) as batch_op:
+        batch_op.drop_index('ix_transaction_account_id_merchant_key')
+        batch_op.drop_column('merchant_key')
+
+    op.drop_table('rename_rule')
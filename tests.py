@@ -1,10 +1,203 @@
 import os
 os.environ['DATABASE_URL'] = 'sqlite://'
+# posts get their language, and users their cache, only where a test asks
+os.environ['LANGUAGE_DETECT_WORKERS'] = '0'
+os.environ['IDENTITY_CACHE_SIZE'] = '0'
 
+from concurrent.futures import Future
 from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import smtplib
+import tempfile
+import threading
+import time
 import unittest
-from app import app, db
-from app.models import User, Post
+from app import app, db, models
+from app.models import User, Post, Item, Account, Transaction, \
+    rebuild_timelines
+from app.pagination import keyset_paginate
+from app import activity, analytics, balances, database, fragments, \
+    jobs, language, metrics, passwords, plaid_connect, mail, translation
+from app import email
+from app.email import MailPool
+from benchmarks.mail import SMTPSink
+from flask_mail import Message
+from flask import g, session
+from sqlalchemy import create_engine, exc
+from unittest import mock
+import numpy as np
+import plaid
+from app.models import Institution, Job, RenameRule, DailySpend, MonthlySpend, \
+    check_spend_rollups, rebuild_spend_rollups, monthly_totals, \
+    category_totals, purge_item
+
+class DatabaseSetupCase(unittest.TestCase):
+    def test_engine_options(self):
+        config = {'DB_PROFILE': 'production', 'DB_POOL_SIZE': 3,
+                  'SQLALCHEMY_DATABASE_URI': 'postgresql://db.example/annex'}
+        options = database.engine_options(config)
+        self.assertIs(options['poolclass'], database.InstrumentedPool)
+        self.assertEqual((options['pool_size'], options['max_overflow']),
+                         (3, 10))
+        self.assertEqual(options['connect_args'],
+                         {'options': '-c statement_timeout=30000',
+                          'sslmode': 'require'})
+        config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        self.assertEqual(database.engine_options(config), {})
+
+    def test_pool_stats(self):
+        database.stats.reset()
+        engine = create_engine('sqlite://',
+                               poolclass=database.InstrumentedPool,
+                               pool_size=1, max_overflow=0, pool_timeout=0.05)
+        connection = engine.connect()
+        with self.assertRaises(exc.TimeoutError):
+            engine.connect()
+        connection.close()
+        engine.connect().close()
+        stats = database.pool_stats()
+        self.assertEqual((stats['checkouts'], stats['connects'],
+                          stats['timeouts'], stats['checked_out']),
+                         (3, 1, 1, 0))
+        self.assertGreaterEqual(stats['wait_max'], 0.05)
+        engine.dispose()
+
+
+class ReplicaRoutingCase(unittest.TestCase):
+    ## The primary is the in-memory test database, the replica a file
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.config = mock.patch.dict(app.config, {
+            'SQLALCHEMY_BINDS': {'replica': 'sqlite:///{}/replica.db'.format(
+                self.dir.name)}})
+        self.config.start()
+        database._lag['checked'] = None
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.replica = db.get_engine(app, bind='replica')
+        db.Model.metadata.create_all(self.replica)
+        db.session.add(User(username='primary', email='p@example.com'))
+        db.session.commit()
+        with self.replica.begin() as connection:
+            connection.execute(User.__table__.insert().values(
+                username='replica', email='r@example.com'))
+        # a fresh session, as each request gets
+        db.session.remove()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.replica.dispose()
+        self.app_context.pop()
+        self.config.stop()
+        self.dir.cleanup()
+
+    def usernames(self):
+        return [u.username for u in User.query.all()]
+
+    def test_get_reads_from_replica_until_a_write(self):
+        with app.test_request_context('/explore'):
+            database.route_reads()
+            self.assertEqual(self.usernames(), ['replica'])
+            db.session.add(User(username='new', email='n@example.com'))
+            db.session.commit()
+            # read-your-writes inside the request
+            self.assertEqual(self.usernames(), ['primary', 'new'])
+            database.remember_writes(None)
+            wrote_at = session['db_wrote_at']
+
+        # and for the client's next requests
+        with app.test_request_context('/explore'):
+            session['db_wrote_at'] = wrote_at
+            database.route_reads()
+            self.assertEqual(self.usernames(), ['primary', 'new'])
+        db.session.remove()
+
+        with app.test_request_context('/explore', method='POST'):
+            database.route_reads()
+            self.assertEqual(self.usernames(), ['primary', 'new'])
+
+    def test_lag_falls_back_to_primary(self):
+        with mock.patch.object(database, 'replica_lag', return_value=60):
+            with app.test_request_context('/explore'):
+                database.route_reads()
+                self.assertEqual(self.usernames(), ['primary'])
+        db.session.remove()
+        with app.test_request_context('/explore'):
+            database.route_reads()
+            self.assertEqual(self.usernames(), ['replica'])
+
+
+class MetricsCase(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        metrics.registry.clear()
+        for n in range(6):
+            db.session.add(User(username='user{}'.format(n),
+                                email='user{}@example.com'.format(n)))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_shape(self):
+        self.assertEqual(
+            metrics.shape('SELECT id\n  FROM user WHERE id IN (?, ?, ?)'),
+            'SELECT id FROM user WHERE id IN (?)')
+
+    def test_request_metrics_and_n_plus_one(self):
+        response = app.response_class('')
+        with mock.patch.dict(app.config, {'METRICS_DEBUG_HEADER': True}):
+            with app.test_request_context(
+                    '/explore', headers={'X-Debug-Metrics': '1'}):
+                metrics.start_request(app)
+                for n in range(6):
+                    User.query.filter_by(username='user{}'.format(n)).first()
+                metrics.finish_request(app, response)
+        debug = json.loads(response.headers['X-Request-Metrics'])
+        self.assertEqual(debug['queries'], 6)
+        self.assertEqual(len(debug['n_plus_one']), 1)
+        self.assertEqual(debug['statements'][0]['count'], 6)
+
+        client = app.test_client()
+        self.assertEqual(client.get('/login').status_code, 200)
+        text = metrics.registry.render()
+        self.assertIn('annex_request_duration_seconds_count'
+                      '{endpoint="login",method="GET"} 1', text)
+        self.assertIn('annex_request_n_plus_one_total'
+                      '{endpoint="explore",method="GET"} 1', text)
+        self.assertIn('annex_request_queries_total'
+                      '{endpoint="explore",method="GET"} 6', text)
+        self.assertIn('annex_slow_statement_seconds{endpoint="explore"',
+                      text)
+
+        # only scrapers holding the token see the endpoint
+        self.assertEqual(client.get('/metrics').status_code, 404)
+        with mock.patch.dict(app.config, {'METRICS_TOKEN': 'secret'}):
+            self.assertEqual(client.get('/metrics').status_code, 403)
+            self.assertEqual(client.get('/metrics', headers={
+                'Authorization': 'Bearer secret'}).status_code, 200)
+
+    def test_workers_add_up_in_metrics_dir(self):
+        path = tempfile.mkdtemp()
+        other = metrics.Registry()
+        with mock.patch.dict(app.config, {'METRICS_DIR': path}), \
+                mock.patch.object(os, 'getpid', return_value=0):
+            other.record('login', 'GET', 0.01, [('SELECT 1', 0.5)])
+        with mock.patch.dict(app.config, {'METRICS_DIR': path}):
+            metrics.registry.record('login', 'GET', 0.01, [('SELECT 1', 0.2)])
+            text = metrics.registry.render()
+        self.assertIn('annex_request_duration_seconds_count'
+                      '{endpoint="login",method="GET"} 2', text)
+        self.assertIn('annex_slow_statement_seconds{endpoint="login",'
+                      'statement="SELECT 1"} 0.5', text)
+
 
 class UserModelCase(unittest.TestCase):
     def setUp(self):
@@ -29,6 +222,27 @@ class UserModelCase(unittest.TestCase):
                                          'd4c74594d841139328695756648b6bd6'
                                          '?d=identicon&s=128'))
 
+    def test_last_seen_write_behind(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        tracker = activity.ActivityTracker()
+        now = datetime(2023, 8, 1, 12, 0, 0)
+        with mock.patch.object(tracker, 'start_flusher'):
+            self.assertTrue(tracker.touch(u1.id, now))
+            # inside the resolution window: nothing new to write
+            self.assertFalse(tracker.touch(u1.id, now + timedelta(seconds=5)))
+            self.assertTrue(tracker.touch(u2.id, now + timedelta(seconds=5)))
+        self.assertNotEqual(User.query.get(u1.id).last_seen, now)
+
+        self.assertEqual(tracker.flush(), 2)
+        self.assertEqual(tracker.flush(), 0)
+        db.session.expire_all()
+        self.assertEqual(User.query.get(u1.id).last_seen, now)
+        self.assertEqual(User.query.get(u2.id).last_seen,
+                         now + timedelta(seconds=5))
+
     def test_follow(self):
         u1 = User(username='john', email='john@example.com')
         u2 = User(username='susan', email='susan@example.com')
@@ -52,6 +266,33 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(u1.followed.count(), 0)
         self.assertEqual(u2.followers.count(), 0)
 
+    def test_follow_counters(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        u1.follow(u2)
+        u1.follow(u3)
+        u3.follow(u2)
+        u1.follow(u2)  # already following: no double count
+        db.session.commit()
+        self.assertEqual((u1.followed_count, u1.follower_count), (2, 0))
+        self.assertEqual((u2.followed_count, u2.follower_count), (0, 2))
+        self.assertEqual(u1.followed_among([u1, u2, u3]), {u2.id, u3.id})
+        self.assertEqual(u2.followed_among([u1, u3]), set())
+
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual((u1.followed_count, u2.follower_count), (1, 1))
+
+        u2.follower_count = 7
+        db.session.commit()
+        self.assertEqual(User.repair_follow_counts(), 1)
+        db.session.expire_all()
+        self.assertEqual(u2.follower_count, 1)
+        self.assertEqual(User.repair_follow_counts(), 0)
+
     def test_follow_posts(self):
         # create four users
         u1 = User(username='john', email='john@example.com')
@@ -90,5 +331,1177 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+    def test_timeline_fanout(self):
+        app.config['TIMELINE_FANOUT'] = True
+        try:
+            u1 = User(username='john', email='john@example.com')
+            u2 = User(username='susan', email='susan@example.com')
+            u3 = User(username='mary', email='mary@example.com')
+            db.session.add_all([u1, u2, u3])
+            db.session.commit()
+            u1.follow(u2)
+            db.session.commit()
+
+            now = datetime.utcnow()
+            p1 = Post(body="post from john", author=u1,
+                      timestamp=now + timedelta(seconds=1))
+            p2 = Post(body="post from susan", author=u2,
+                      timestamp=now + timedelta(seconds=2))
+            p3 = Post(body="post from mary", author=u3,
+                      timestamp=now + timedelta(seconds=3))
+            db.session.add_all([p1, p2, p3])
+            db.session.commit()
+            self.assertEqual(u1.home_posts().all(), [p2, p1])
+            self.assertEqual(u2.home_posts().all(), [p2])
+
+            # following backfills, unfollowing trims
+            u1.follow(u3)
+            db.session.commit()
+            self.assertEqual(u1.home_posts().all(), [p3, p2, p1])
+            u1.unfollow(u2)
+            db.session.commit()
+            self.assertEqual(u1.home_posts().all(), [p3, p1])
+
+            # a rebuild reproduces the same feeds as the UNION query
+            rebuild_timelines()
+            for u in [u1, u2, u3]:
+                self.assertEqual(u.timeline_posts().all(),
+                                 u.followed_posts().all())
+        finally:
+            app.config['TIMELINE_FANOUT'] = False
+
+    def test_keyset_pagination(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        now = datetime.utcnow()
+        # pairs of posts share a timestamp to exercise the id tie-breaker
+        posts = [Post(body='post {}'.format(i), author=[u1, u2][i % 2],
+                      timestamp=now + timedelta(seconds=i // 2))
+                 for i in range(7)]
+        db.session.add_all(posts)
+        u1.follow(u2)
+        db.session.commit()
+        expected = sorted(posts, key=lambda p: (p.timestamp, p.id),
+                          reverse=True)
+
+        for query in [Post.query, u1.followed_posts()]:
+            pages = [keyset_paginate(query, (Post.timestamp, Post.id),
+                                     per_page=3)]
+            while pages[-1].has_next:
+                pages.append(keyset_paginate(
+                    query, (Post.timestamp, Post.id),
+                    pages[-1].next_cursor, per_page=3))
+            self.assertEqual([len(p.items) for p in pages], [3, 3, 1])
+            self.assertEqual(sum([p.items for p in pages], []), expected)
+            self.assertFalse(pages[0].has_prev)
+
+            back = keyset_paginate(query, (Post.timestamp, Post.id),
+                                   pages[2].prev_cursor, per_page=3)
+            self.assertEqual(back.items, pages[1].items)
+            back = keyset_paginate(query, (Post.timestamp, Post.id),
+                                   back.prev_cursor, per_page=3)
+            self.assertEqual(back.items, pages[0].items)
+            self.assertFalse(back.has_prev)
+
+        page = keyset_paginate(Post.query, (Post.timestamp, Post.id),
+                               'not-a-cursor', per_page=3)
+        self.assertEqual(page.items, expected[:3])
+
+
+def plaid_transaction(id, name, amount=1.0, account_id='acc1'):
+    return {'transaction_id': id, 'name': name, 'account_id': account_id,
+            'date': '2023-08-01', 'merchant_name': name, 'amount': amount,
+            'iso_currency_code': 'USD', 'payment_channel': 'online',
+            'category': ['Food and Drink'], 'category_id': 13005000}
+
+
+class FragmentCacheCase(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.test_request_context()
+        self.app_context.push()
+        g.locale = 'en'
+        db.create_all()
+        fragments.backend().clear()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_render_posts_cached_until_profile_edit(self):
+        u = User(username='john', email='john@example.com')
+        p = Post(body='hello', author=u)
+        db.session.add_all([u, p])
+        db.session.commit()
+        first = fragments.render_posts([p])
+        self.assertIn('john', first)
+
+        # a cache hit serves the stored HTML without rendering again
+        with mock.patch.object(fragments, 'render_template') as render:
+            self.assertEqual(fragments.render_posts([p]), first)
+            render.assert_not_called()
+
+        # a new username is a new key, with no invalidation needed
+        u.username = 'johnny'
+        db.session.commit()
+        self.assertIn('johnny', fragments.render_posts([p]))
+
+        # each locale gets its own entry
+        g.locale = 'es'
+        with mock.patch.object(fragments, 'render_template',
+                               return_value='<es>') as render:
+            self.assertEqual(fragments.render_posts([p]), '<es>')
+            render.assert_called_once()
+
+
+class FileFragmentCacheCase(unittest.TestCase):
+    def test_entries_are_text_in_a_private_dir(self):
+        path = os.path.join(tempfile.mkdtemp(), 'fragments')
+        cache = fragments.FileBackend({'FRAGMENT_CACHE_DIR': path,
+                                       'FRAGMENT_CACHE_TTL': 60,
+                                       'FRAGMENT_CACHE_SIZE': 100})
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o700)
+        cache.set_many({'a': '<p>caf\u00e9</p>'})
+        self.assertEqual(cache.get_many(['a', 'b']), {'a': '<p>caf\u00e9</p>'})
+
+        os.chmod(path, 0o777)
+        with self.assertRaises(RuntimeError):
+            fragments.FileBackend({'FRAGMENT_CACHE_DIR': path,
+                                   'FRAGMENT_CACHE_TTL': 60,
+                                   'FRAGMENT_CACHE_SIZE': 100})
+
+
+class IdentityCacheCase(unittest.TestCase):
+    def setUp(self):
+        self.config = mock.patch.dict(app.config, {
+            'IDENTITY_CACHE_SIZE': 10, 'WTF_CSRF_ENABLED': False})
+        self.config.start()
+        models.identity_cache = None
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.john = User(username='john', email='john@example.com')
+        self.susan = User(username='susan', email='susan@example.com')
+        db.session.add_all([self.john, self.susan])
+        db.session.commit()
+        self.john, self.susan = self.john.id, self.susan.id
+        db.session.remove()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.config.stop()
+        models.identity_cache = None
+
+    def test_snapshot_merged_without_query(self):
+        first = models.load_user(str(self.john))
+        db.session.remove()
+        with mock.patch.object(User, 'query') as query:
+            second = models.load_user(str(self.john))
+            query.get.assert_not_called()
+        self.assertIsNot(first, second)
+        self.assertIs(second, db.session.get(User, self.john))
+        self.assertEqual(second.username, 'john')
+        self.assertFalse(db.session.dirty)
+
+        # the merged instance takes writes like a loaded one
+        second.about_me = 'hi'
+        db.session.commit()
+        self.assertIsInstance(models.identity_cache.get(self.john),
+                              type(models.user_snapshot(second)))
+        models.invalidate_user(self.john)
+        db.session.remove()
+        self.assertEqual(models.load_user(self.john).about_me, 'hi')
+        self.assertEqual(models.identity_cache_stats()['hits'], 2)
+        self.assertEqual(models.identity_cache_stats()['misses'], 2)
+
+    def test_invalidated_by_routes(self):
+        client = app.test_client()
+        with client.session_transaction() as s:
+            s['_user_id'] = str(self.john)
+        client.get('/edit_profile')
+        client.post('/follow/susan', data={})
+        self.assertIsNone(models.identity_cache.get(self.john))
+        self.assertEqual(models.load_user(self.susan).follower_count, 1)
+
+        client.post('/edit_profile', data={'username': 'johnny',
+                                           'about_me': ''})
+        db.session.remove()
+        self.assertEqual(models.load_user(self.john).username, 'johnny')
+
+    def test_changes_from_other_workers(self):
+        app.config['IDENTITY_CACHE_POLL'] = 0
+        self.assertEqual(models.load_user(self.john).username, 'john')
+        db.session.remove()
+        # another worker renames john and resets his password; this
+        # worker's invalidate_user is never called
+        User.query.get(self.john).username = 'johnny'
+        User.query.get(self.john).set_password('cat')
+        db.session.commit()
+        db.session.remove()
+        user = models.load_user(self.john)
+        self.assertEqual(user.username, 'johnny')
+        self.assertTrue(user.check_password('cat'))
+
+        # password hashes are never cached; they load when used
+        self.assertNotIn('password_hash', models.identity_cache.get(self.john))
+        app.config['IDENTITY_CACHE_POLL'] = 60
+        db.session.remove()
+        with mock.patch.object(User, 'query') as query:
+            user = models.load_user(self.john)
+            query.get.assert_not_called()
+        self.assertTrue(user.check_password('cat'))
+
+
+class PasswordHashingCase(unittest.TestCase):
+    def setUp(self):
+        self.config = mock.patch.dict(app.config, {
+            'PASSWORD_HASH_COST': 1000, 'WTF_CSRF_ENABLED': False})
+        self.config.start()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.config.stop()
+
+    def test_upgraded_on_login(self):
+        u = User(username='susan', email='susan@example.com')
+        u.set_password('cat')
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:1000$'))
+        db.session.add(u)
+        db.session.commit()
+
+        app.config.update(PASSWORD_HASH_ALGORITHM='scrypt',
+                          PASSWORD_HASH_COST=1024)
+        self.assertFalse(u.check_password('dog'))
+        self.assertFalse(db.session.is_modified(u))
+        client = app.test_client()
+        response = client.post('/login', data={'username': 'susan',
+                                               'password': 'cat'})
+        self.assertEqual(response.status_code, 302)
+        self.assertNotIn('/login', response.headers['Location'])
+        db.session.expire_all()
+        self.assertTrue(User.query.get(u.id).password_hash.startswith(
+            'scrypt:1024:8:1$'))
+        self.assertTrue(u.check_password('cat'))
+        self.assertFalse(u.check_password('dog'))
+
+    def test_hashes_fit_the_column(self):
+        length = User.__table__.c.password_hash.type.length
+        for algorithm, prefix in (('scrypt', 'scrypt:32768:8:1$'),
+                                  ('pbkdf2:sha512', 'pbkdf2:sha512:260000$')):
+            app.config.update(PASSWORD_HASH_ALGORITHM=algorithm,
+                              PASSWORD_HASH_COST=None,
+                              PASSWORD_HASH_WORKERS=0)
+            u = User(username='susan', email='susan@example.com')
+            u.set_password('cat')
+            self.assertTrue(u.password_hash.startswith(prefix))
+            self.assertLessEqual(len(u.password_hash), length)
+
+    def test_bad_settings(self):
+        for algorithm, cost in (('scrypt', 260000), ('scrypt', 1),
+                                ('pbkdf2:nope', None), ('bcrypt', None),
+                                ('pbkdf2:sha256', -1)):
+            with self.assertRaises(ValueError):
+                passwords.configured({'PASSWORD_HASH_ALGORITHM': algorithm,
+                                      'PASSWORD_HASH_COST': cost})
+
+    def test_inline_and_overloaded(self):
+        hasher = passwords.PasswordHasher()
+        with mock.patch.dict(app.config, {'PASSWORD_HASH_WORKERS': 0}):
+            self.assertEqual(hasher.verify(hasher.hash('cat'), 'cat'),
+                             (True, None))
+        self.assertIsNone(hasher.executor)
+        with mock.patch.dict(app.config, {'PASSWORD_HASH_QUEUE_SIZE': 1,
+                                          'PASSWORD_HASH_TIMEOUT': 0.01}):
+            hasher.hash('warm')
+            hasher.slots.acquire()
+            with self.assertRaises(passwords.ServiceUnavailable):
+                hasher.hash('cat')
+        hasher.shutdown()
+
+
+    def test_broken_pool_replaced_and_stuck_hash_times_out(self):
+        hasher = passwords.PasswordHasher()
+        hasher.hash('warm')
+        broken = hasher.executor
+        for process in list(broken._processes.values()):
+            process.kill()
+            process.join()
+        self.assertEqual(hasher.verify(hasher.hash('cat'), 'cat'),
+                         (True, None))
+        self.assertIsNot(hasher.executor, broken)
+        hasher.shutdown()
+
+        stuck = mock.Mock()
+        stuck.submit.return_value = Future()
+        hasher.executor = stuck
+        with mock.patch.dict(app.config, {'PASSWORD_HASH_TIMEOUT': 0.01}):
+            with self.assertRaises(passwords.ServiceUnavailable):
+                hasher.hash('cat')
+        hasher.executor = None
+
+
+class LanguageDetectionCase(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.user = User(username='john', email='john@example.com')
+        db.session.add(self.user)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_detect_language_memoized(self):
+        body = 'The weather is lovely today and we are going to the beach'
+        self.assertEqual(language.detect_language(body), 'en')
+        with mock.patch.object(language, 'detect') as detect:
+            self.assertEqual(language.detect_language(
+                '@susan  ' + body.upper() + ' https://example.com'), 'en')
+            detect.assert_not_called()
+        self.assertEqual(language.detect_language('12345'), '')
+
+    def test_detected_after_commit(self):
+        detector = language.Detector()
+        with mock.patch.dict(app.config, {'LANGUAGE_DETECT_WORKERS': 1}), \
+                mock.patch.object(language, 'detector', detector):
+            p = Post(body='Hoy hace muy buen tiempo y vamos a la playa',
+                     author=self.user)
+            db.session.add(p)
+            db.session.flush()
+            # nothing is detected until the post is committed
+            self.assertEqual(detector.pending, set())
+            db.session.commit()
+            self.assertTrue(detector.wait(10))
+        detector.shutdown()
+        db.session.expire_all()
+        self.assertEqual(Post.query.get(p.id).language, 'es')
+
+    def test_backfill(self):
+        bodies = ['Hoy hace muy buen tiempo y vamos a la playa',
+                  'The weather is lovely today and we are going to the beach',
+                  'Il fait très beau aujourd\'hui et nous allons à la plage',
+                  '12345', 'The weather is lovely today and we are going']
+        db.session.execute(Post.__table__.insert(), [
+            {'body': body, 'user_id': self.user.id} for body in bodies])
+        db.session.commit()
+        self.assertEqual(language.backfill(batch_size=2, processes=2), 5)
+        self.assertEqual([p.language for p in Post.query.order_by(Post.id)],
+                         ['es', 'en', 'fr', '', 'en'])
+        self.assertEqual(language.backfill(batch_size=2, processes=2), 0)
+
+
+class GatedTranslator(translation.StandInTranslator):
+    ## Stand-in that blocks inside the backend call until released
+    def __init__(self, config):
+        super().__init__(config)
+        self.entered = threading.Event()
+        self.gate = threading.Event()
+
+    def translate(self, texts, source, dest):
+        self.entered.set()
+        self.gate.wait(5)
+        return super().translate(texts, source, dest)
+
+
+class TranslationCase(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.translations = translation.Translations()
+        self.patch = mock.patch.object(translation, 'translations',
+                                       self.translations)
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_cache_tiers(self):
+        texts = [('hola', 'es'), ('bonjour', 'fr'), ('hola', 'es')]
+        self.assertEqual(self.translations.translate(texts, 'en'),
+                         ['[es->en] hola', '[fr->en] bonjour',
+                          '[es->en] hola'])
+        self.assertEqual(self.translations.stats['backend_calls'], 2)
+        self.translations.translate(texts, 'en')
+        self.assertEqual(self.translations.stats['memory_hits'], 2)
+
+        # a new process finds them in the translation table
+        fresh = translation.Translations()
+        self.assertEqual(fresh.translate([('hola', 'es')], 'en'),
+                         ['[es->en] hola'])
+        self.assertEqual((fresh.stats['db_hits'],
+                          fresh.stats['backend_calls']), (1, 0))
+
+    def test_concurrent_requests_coalesced(self):
+        translator = GatedTranslator(app.config)
+        self.translations.translator = translator
+        claimed = threading.Event()
+        claim = self.translations.claim
+
+        def claim_and_signal(keys):
+            mine, theirs = claim(keys)
+            if theirs:
+                claimed.set()
+            return mine, theirs
+
+        results = []
+
+        def request():
+            with app.app_context():
+                results.append(self.translations.translate(
+                    [('hola', 'es')], 'en'))
+
+        with mock.patch.object(self.translations, 'claim',
+                               claim_and_signal):
+            first = threading.Thread(target=request)
+            first.start()
+            self.assertTrue(translator.entered.wait(5))
+            second = threading.Thread(target=request)
+            second.start()
+            self.assertTrue(claimed.wait(5))
+            translator.gate.set()
+            first.join(5)
+            second.join(5)
+        self.assertEqual(results, [['[es->en] hola']] * 2)
+        self.assertEqual(translator.calls, 1)
+        self.assertEqual(self.translations.stats['coalesced'], 1)
+
+    def test_translate_endpoint(self):
+        u = User(username='john', email='john@example.com')
+        posts = [Post(body='hola', language='es', author=u),
+                 Post(body='hello', language='en', author=u),
+                 Post(body='12345', language='', author=u),
+                 Post(body='salut', language='fr', author=u)]
+        db.session.add_all(posts)
+        db.session.commit()
+        client = app.test_client()
+        with client.session_transaction() as s:
+            s['_user_id'] = str(u.id)
+
+        response = client.post('/translate', json={
+            'post_ids': [p.id for p in posts], 'dest_language': 'en'})
+        self.assertEqual(response.get_json(), {'translations': {
+            str(posts[0].id): '[es->en] hola',
+            str(posts[3].id): '[fr->en] salut'}})
+
+        response = client.post('/translate', data={
+            'text': 'hola', 'source_language': 'es', 'dest_language': 'en'})
+        self.assertEqual(response.get_json(), {'text': '[es->en] hola'})
+        self.assertEqual(self.translations.stats['backend_calls'], 2)
+
+        self.assertEqual(client.post('/translate', json={
+            'post_ids': ['x']}).status_code, 400)
+        with mock.patch.object(translation.StandInTranslator, 'translate',
+                               side_effect=OSError):
+            self.assertEqual(client.post('/translate', data={
+                'text': 'ciao', 'source_language': 'it'}).status_code, 502)
+
+
+class TransactionModelCase(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.user = User(username='john', email='john@example.com')
+        db.session.add(self.user)
+        db.session.commit()
+        db.session.add(Item(id='item1', access_token='token1',
+                            user_id=self.user.id))
+        db.session.add(Account(id='acc1', name='Checking', item_id='item1'))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_handle_db_transactions(self):
+        stats = Transaction.handle_db_transactions(
+            [plaid_transaction('t1', 'SQ *COFFEE'),
+             plaid_transaction('t2', 'GROCER')], [], [], self.user)
+        self.assertEqual(stats['added'], 2)
+        self.assertEqual(set(stats['timings']),
+                         {'renames', 'previous', 'upsert', 'delete',
+                          'rollups', 'commit'})
+
+        RenameRule.rename(self.user, 'SQ *COFFEE', 'Coffee')
+
+        # new rows pick up earlier renames; modified rows keep theirs
+        Transaction.handle_db_transactions(
+            [plaid_transaction('t3', 'SQ *COFFEE')],
+            [plaid_transaction('t1', 'SQ *COFFEE', amount=4.5)],
+            [{'transaction_id': 't2'}], self.user)
+        self.assertEqual(Transaction.query.get('t3').new_name, 'Coffee')
+        t1 = Transaction.query.get('t1')
+        self.assertEqual((t1.new_name, t1.amount), ('Coffee', 4.5))
+        self.assertIsNone(Transaction.query.get('t2'))
+        self.assertEqual(Transaction.query.count(), 2)
+
+    def test_spend_rollups(self):
+        Transaction.handle_db_transactions(
+            [plaid_transaction('t1', 'CAFE', amount=5.0),
+             plaid_transaction('t2', 'CAFE', amount=3.0),
+             plaid_transaction('t3', 'BUS', amount=2.0)], [], [], self.user)
+        self.assertEqual(monthly_totals(self.user),
+                         [(datetime(2023, 8, 1).date(), 10.0, 3)])
+
+        # a modified row moves its amount to its new day and category
+        moved = plaid_transaction('t1', 'CAFE', amount=4.0)
+        moved.update(date='2023-09-02', category=None)
+        Transaction.handle_db_transactions(
+            [], [moved], [{'transaction_id': 't2'}], self.user)
+        self.assertEqual(
+            [(m.isoformat(), total, count)
+             for m, total, count in monthly_totals(self.user)],
+            [('2023-08-01', 2.0, 1), ('2023-09-01', 4.0, 1)])
+        self.assertEqual(category_totals(self.user),
+                         [('Uncategorized', 4.0, 1),
+                          ('Food and Drink', 2.0, 1)])
+        self.assertEqual(DailySpend.query.count(), 2)
+        self.assertEqual(check_spend_rollups(), [])
+
+        # the checker notices drift and a rebuild repairs it
+        MonthlySpend.query.delete()
+        db.session.commit()
+        self.assertEqual(len(check_spend_rollups()), 2)
+        self.assertEqual(rebuild_spend_rollups(), (2, 2))
+        self.assertEqual(check_spend_rollups(), [])
+
+    def test_analytics(self):
+        analytics.cache().clear()
+        Account.query.get('acc1').current_balance = 50.0
+        payroll = plaid_transaction('t3', 'PAYROLL', amount=-100.0)
+        payroll['category'] = ['Transfer']
+        later = plaid_transaction('t4', 'CAFE', amount=6.0)
+        later['date'] = '2023-10-05'
+        Transaction.handle_db_transactions(
+            [plaid_transaction('t1', 'CAFE', amount=5.0),
+             plaid_transaction('t2', 'BUS', amount=3.0), payroll, later],
+            [], [], self.user)
+        frame = analytics.frame_for(self.user)
+        self.assertEqual(len(frame), 4)
+
+        months, categories, totals = frame.monthly_spend_by_category()
+        self.assertEqual([str(m) for m in months],
+                         ['2023-08', '2023-09', '2023-10'])
+        self.assertEqual(categories, ['Food and Drink', 'Transfer'])
+        self.assertEqual(totals.tolist(), [[8.0, 0.0], [0.0, 0.0],
+                                           [6.0, 0.0]])
+        _, spend, deltas, ratios = frame.month_over_month()
+        self.assertEqual(spend.tolist(), [8.0, 0.0, 6.0])
+        self.assertEqual(deltas.tolist()[1:], [-8.0, 6.0])
+        self.assertEqual(ratios[1], -1.0)
+        self.assertTrue(np.isnan(ratios[2]))
+
+        dates, balances = frame.running_balances()['acc1']
+        self.assertEqual([str(d) for d in dates[-2:]],
+                         ['2023-08-01', '2023-10-05'])
+        self.assertEqual(balances[-2:].tolist(), [56.0, 50.0])
+        self.assertEqual(frame.top_merchants(1), [('CAFE', 11.0, 2)])
+
+        # cached until a sync or rename changes the user's data
+        self.assertIs(analytics.frame_for(self.user), frame)
+        RenameRule.rename(self.user, 'CAFE', 'Coffee')
+        frame = analytics.frame_for(self.user)
+        self.assertEqual(frame.top_merchants(1), [('Coffee', 11.0, 2)])
+        Item.query.get('item1').cursor = 'next'
+        db.session.commit()
+        self.assertIsNot(analytics.frame_for(self.user), frame)
+
+    def test_purge_item(self):
+        db.session.add(Item(id='item2', access_token='token2',
+                            user_id=self.user.id))
+        db.session.add(Account(id='acc2', name='Savings', item_id='item2'))
+        db.session.commit()
+        Transaction.handle_db_transactions(
+            [plaid_transaction('t{}'.format(n), 'CAFE') for n in range(5)] +
+            [plaid_transaction('t9', 'BUS', account_id='acc2')],
+            [], [], self.user)
+
+        self.assertEqual(purge_item('item1', chunk_size=2), 5)
+        self.assertIsNone(Item.query.get('item1'))
+        self.assertIsNone(Account.query.get('acc1'))
+        self.assertEqual([t.id for t in Transaction.query.all()], ['t9'])
+        self.assertEqual(MonthlySpend.query.one().count, 1)
+        self.assertEqual(check_spend_rollups(), [])
+
+        # asynchronous mode: hidden at once, purged by a job worker
+        item = Item.query.get('item2')
+        item.deleted_at = datetime.utcnow()
+        db.session.commit()
+        self.assertEqual(len(analytics.TransactionFrame.load(self.user.id)),
+                         0)
+        jobs.enqueue('purge_item', key='item2', item_id='item2')
+        self.assertEqual(jobs.work_off(), 1)
+        self.assertEqual(Item.query.count(), 0)
+        self.assertEqual(Transaction.query.count(), 0)
+
+    def test_rename_rules(self):
+        other = User(username='susan', email='susan@example.com')
+        db.session.add(other)
+        db.session.commit()
+        db.session.add(Item(id='item2', access_token='token2',
+                            user_id=other.id))
+        db.session.add(Account(id='acc2', name='Savings', item_id='item2'))
+        db.session.commit()
+        Transaction.handle_db_transactions(
+            [plaid_transaction('t1', 'SQ *COFFEE'),
+             plaid_transaction('t2', 'sq *coffee '),
+             plaid_transaction('t3', 'GROCER')], [], [], self.user)
+        Transaction.handle_db_transactions(
+            [plaid_transaction('t4', 'SQ *COFFEE', account_id='acc2')],
+            [], [], other)
+
+        self.assertEqual(RenameRule.rename(self.user, 'SQ *COFFEE',
+                                           'Coffee'), 2)
+        self.assertEqual(Transaction.query.get('t2').new_name, 'Coffee')
+        # other users' transactions are untouched
+        self.assertIsNone(Transaction.query.get('t4').new_name)
+
+        # renaming the rename moves every merchant that displays it
+        self.assertEqual(RenameRule.rename(self.user, 'Coffee',
+                                           'Cafe'), 2)
+        self.assertEqual(RenameRule.rules_for(self.user)['sq *coffee'],
+                         'Cafe')
+
+
+class PlaidConnectCase(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        plaid_connect.institution_cache = None
+        plaid_connect.institution_stats.clear()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_client_is_reused(self):
+        with mock.patch.dict(app.config, {'PLAID_CLIENT_ID': 'id',
+                                          'PLAID_SECRET': 'secret'}):
+            client = plaid_connect.configure()
+            self.assertIs(plaid_connect.configure(), client)
+            self.assertEqual(client.api_client.configuration
+                             .connection_pool_maxsize,
+                             app.config['PLAID_POOL_SIZE'])
+            app.config['PLAID_SECRET'] = 'rotated'
+            self.assertIsNot(plaid_connect.configure(), client)
+
+    def test_institution_cache(self):
+        client = mock.Mock()
+        client.institutions_get_by_id.return_value.to_dict.return_value = {
+            'institution': {'institution_id': 'ins_1', 'name': 'First Bank'}}
+        with mock.patch.object(plaid_connect, 'configure',
+                               return_value=client):
+            self.assertEqual(plaid_connect.get_institution('ins_1'),
+                             'First Bank')
+            self.assertEqual(plaid_connect.get_institution('ins_1'),
+                             'First Bank')
+            # a fresh worker process still finds it in the database
+            plaid_connect.institution_cache.clear()
+            self.assertEqual(plaid_connect.get_institution('ins_1'),
+                             'First Bank')
+        self.assertEqual(client.institutions_get_by_id.call_count, 1)
+        stats = plaid_connect.institution_cache_stats()
+        self.assertEqual((stats['memory_hits'], stats['db_hits'],
+                          stats['api_calls'], stats['api_calls_saved']),
+                         (1, 1, 1, 2))
+
+
+class SyncTransactionsCase(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        user = User(username='john', email='john@example.com')
+        db.session.add(user)
+        db.session.commit()
+        db.session.add(Item(id='item1', access_token='token1',
+                            user_id=user.id))
+        db.session.add(Account(id='acc1', name='Checking', item_id='item1'))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def page(self, cursor, added, has_more):
+        response = mock.Mock()
+        response.to_dict.return_value = {
+            'added': added, 'modified': [], 'removed': [],
+            'next_cursor': cursor, 'has_more': has_more}
+        return response
+
+    def test_sync_resumes_from_last_page(self):
+        client = mock.Mock()
+        client.transactions_sync.side_effect = [
+            self.page('c1', [plaid_transaction('t1', 'A')], True),
+            ConnectionError('network down')]
+        with mock.patch.object(plaid_connect, 'configure',
+                               return_value=client):
+            with self.assertRaises(ConnectionError):
+                plaid_connect.sync_item('item1')
+        # the first page and its cursor were committed together
+        self.assertEqual(Item.query.get('item1').cursor, 'c1')
+        self.assertEqual(Transaction.query.count(), 1)
+
+        client.transactions_sync.side_effect = [
+            self.page('c2', [plaid_transaction('t2', 'B')], True),
+            self.page('c3', [plaid_transaction('t3', 'C')], False)]
+        with mock.patch.object(plaid_connect, 'configure',
+                               return_value=client):
+            result = plaid_connect.sync_item('item1')
+        request = client.transactions_sync.call_args_list[2][0][0]
+        self.assertEqual(request.cursor, 'c1')
+        self.assertEqual(result['added'], 2)
+        self.assertEqual([p['page'] for p in result['pages']], [1, 2])
+        self.assertEqual(Item.query.get('item1').cursor, 'c3')
+        self.assertEqual(Transaction.query.count(), 3)
+
+
+    def test_sync_drops_cached_analytics(self):
+        user_id = Item.query.get('item1').user_id
+        analytics.cache().set(user_id, ('stamp', 'frame'))
+        client = mock.Mock()
+        client.transactions_sync.return_value = self.page(
+            'c1', [plaid_transaction('t1', 'A')], False)
+        with mock.patch.object(plaid_connect, 'configure',
+                               return_value=client):
+            plaid_connect.sync_item('item1')
+        self.assertIsNone(analytics.cache().get(user_id))
+
+    def test_restarts_are_capped(self):
+        mutation = plaid.ApiException(status=400)
+        mutation.body = json.dumps(
+            {'error_code': 'TRANSACTIONS_SYNC_MUTATION_DURING_PAGINATION'})
+        client = mock.Mock()
+        client.transactions_sync.side_effect = mutation
+        with mock.patch.dict(app.config, {'SYNC_MAX_RESTARTS': 2,
+                                          'SYNC_RESTART_BACKOFF': 0}), \
+                mock.patch.object(plaid_connect, 'configure',
+                                  return_value=client):
+            with self.assertRaises(RuntimeError):
+                plaid_connect.sync_item('item1')
+        self.assertEqual(client.transactions_sync.call_count, 3)
+
+    def test_overlapping_syncs_apply_each_page_once(self):
+        pages = {'': self.page('c1', [plaid_transaction('t1', 'A', 5.0)],
+                               False),
+                 'c1': self.page('c1', [], False)}
+        overlapped = []
+
+        def transactions_sync(request):
+            if not overlapped:
+                # another worker syncs the item while this page is in flight
+                overlapped.append(None)
+                overlapped.append(plaid_connect.sync_item('item1'))
+            return pages[request.cursor]
+        client = mock.Mock()
+        client.transactions_sync.side_effect = transactions_sync
+        with mock.patch.object(plaid_connect, 'configure',
+                               return_value=client):
+            result = plaid_connect.sync_item('item1')
+        # the stale page was dropped and the sync went on from c1
+        self.assertEqual((overlapped[1]['added'], result['added']), (1, 0))
+        self.assertEqual(client.transactions_sync.call_args_list[-1][0][0]
+                         .cursor, 'c1')
+        self.assertEqual(Item.query.get('item1').cursor, 'c1')
+        self.assertEqual((DailySpend.query.one().total,
+                          MonthlySpend.query.one().count), (5.0, 1))
+
+
+class StandInPlaid(BaseHTTPRequestHandler):
+    ## Answers /accounts/balance/get like Plaid for the tokens in `balances`,
+    ## /item/public_token/exchange for the public tokens in `exchanges`,
+    ## /item/remove and /link/token/create
+    balances = {}
+    exchanges = {}
+    requests = []
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if self.path == '/link/token/create':
+            self.requests.append((self.path, body['user']['client_user_id']))
+            self.reply(200, {'link_token': 'link-sandbox-1',
+                             'expiration': '2026-10-18T00:00:00Z',
+                             'request_id': 'r'})
+            return
+        if self.path == '/item/remove':
+            self.requests.append((self.path, body['access_token']))
+            self.reply(200, {'request_id': 'r'})
+            return
+        if self.path == '/item/public_token/exchange':
+            access_token, item_id = self.exchanges[body['public_token']]
+            self.reply(200, {'access_token': access_token,
+                             'item_id': item_id, 'request_id': 'r'})
+            return
+        self.requests.append((self.path, body['access_token']))
+        accounts = self.balances.get(body['access_token'])
+        if accounts is None:
+            self.reply(400, {'error_type': 'INVALID_INPUT',
+                             'error_code': 'INVALID_ACCESS_TOKEN',
+                             'error_message': 'bad token',
+                             'display_message': None, 'request_id': 'r'})
+            return
+        self.reply(200, {
+            'accounts': [{'account_id': id, 'balances': {
+                'available': current, 'current': current, 'limit': None,
+                'iso_currency_code': 'USD',
+                'unofficial_currency_code': None},
+                'mask': '0000', 'name': id, 'official_name': None,
+                'type': 'depository', 'subtype': 'checking'}
+                for id, current in accounts],
+            'item': {'item_id': body['access_token'], 'webhook': '',
+                     'institution_id': 'ins_1',
+                     'error': None, 'available_products': [],
+                     'billed_products': [], 'consent_expiration_time': None,
+                     'update_type': 'background'},
+            'request_id': 'r'})
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class BalanceRefreshCase(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StandInPlaid)
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        StandInPlaid.requests = []
+        StandInPlaid.balances = {'token1': [('acc1', 10.5), ('acc2', 20.0)],
+                                 'token2': [('acc3', 30.0)]}
+        self.config = mock.patch.dict(app.config, {
+            'PLAID_CLIENT_ID': 'id', 'PLAID_SECRET': 'secret',
+            'PLAID_HOST': 'http://127.0.0.1:{}'.format(
+                self.server.server_port)})
+        self.config.start()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        user = User(username='john', email='john@example.com')
+        db.session.add(user)
+        db.session.commit()
+        for n, accounts in ((1, ['acc1', 'acc2']), (2, ['acc3']),
+                            (3, ['acc4'])):
+            item_id = 'item{}'.format(n)
+            db.session.add(Item(id=item_id, user_id=user.id,
+                                access_token='token{}'.format(n)))
+            for account_id in accounts:
+                db.session.add(Account(id=account_id, name=account_id,
+                                       item_id=item_id))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.config.stop()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_refresh_all(self):
+        result = balances.refresh_all(workers=4, rate=100)
+        self.assertEqual((result['refreshed'], result['failed'],
+                          result['skipped'], result['accounts']),
+                         (2, 1, 0, 3))
+        self.assertGreater(result['items_per_second'], 0)
+        self.assertEqual(sorted(token for _, token in StandInPlaid.requests),
+                         ['token1', 'token2', 'token3'])
+        self.assertEqual([Account.query.get(id).current_balance
+                          for id in ('acc1', 'acc2', 'acc3', 'acc4')],
+                         [10.5, 20.0, 30.0, None])
+        self.assertIsNone(Item.query.get('item3').balances_updated_at)
+
+        # recently refreshed items are skipped; the failed one is retried
+        StandInPlaid.requests = []
+        result = balances.refresh_all(workers=4, rate=100)
+        self.assertEqual((result['refreshed'], result['failed'],
+                          result['skipped']), (0, 1, 2))
+        self.assertEqual(StandInPlaid.requests,
+                         [('/accounts/balance/get', 'token3')])
+
+    def test_rate_limit(self):
+        limiter = balances.RateLimiter(50, burst=1)
+        started = datetime.utcnow()
+        for _ in range(6):
+            limiter.acquire()
+        self.assertGreaterEqual(datetime.utcnow() - started,
+                                timedelta(seconds=0.09))
+
+
+class PlaidLinkCase(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StandInPlaid)
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        StandInPlaid.requests = []
+        StandInPlaid.balances = {'token9': [('acc9', 5.0)]}
+        StandInPlaid.exchanges = {'public-9': ('token9', 'item9')}
+        self.config = mock.patch.dict(app.config, {
+            'PLAID_CLIENT_ID': 'id', 'PLAID_SECRET': 'secret',
+            'PLAID_PRODUCTS': ['transactions'],
+            'PLAID_HOST': 'http://127.0.0.1:{}'.format(
+                self.server.server_port)})
+        self.config.start()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        john = User(username='john', email='john@example.com')
+        susan = User(username='susan', email='susan@example.com')
+        db.session.add_all([john, susan, Institution(
+            id='ins_1', name='First Bank', data='{"name": "First Bank"}',
+            updated_at=datetime.utcnow())])
+        db.session.commit()
+        self.john, self.susan = john.id, susan.id
+        db.session.remove()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.config.stop()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def client(self, user_id):
+        client = app.test_client()
+        with client.session_transaction() as s:
+            s['_user_id'] = str(user_id)
+        return client
+
+    def test_link_flow_is_stateless(self):
+        response = self.client(self.john).post(
+            '/set_access_token', json={'public_token': 'public-9'})
+        self.assertEqual(response.get_json(), {'item_id': 'item9'})
+        item = Item.query.get('item9')
+        self.assertEqual((item.user_id, item.access_token, item.ins_name),
+                         (self.john, 'token9', 'First Bank'))
+        self.assertEqual(Account.query.get('acc9').current_balance, 5.0)
+
+        # any other worker can serve the follow-up from the database,
+        # without asking Plaid for the balances again
+        StandInPlaid.requests = []
+        response = self.client(self.john).get('/balance/get?item_id=item9')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['accounts'], [{
+            'account_id': 'acc9', 'name': 'acc9', 'type': 'checking',
+            'balances': {'current': 5.0}}])
+        self.assertEqual(StandInPlaid.requests, [])
+        self.assertEqual(self.client(self.susan).get(
+            '/balance/get?item_id=item9').status_code, 404)
+        self.assertEqual(self.client(self.susan).post(
+            '/set_access_token',
+            json={'public_token': 'public-9'}).status_code, 403)
+        # the token minted by the rejected exchange is removed
+        self.assertEqual(StandInPlaid.requests[-1],
+                         ('/item/remove', 'token9'))
+
+    def test_create_link_token(self):
+        response = self.client(self.john).post('/create_link_token')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['link_token'], 'link-sandbox-1')
+        self.assertEqual(StandInPlaid.requests[0][0], '/link/token/create')
+
+
+class MailPoolCase(unittest.TestCase):
+    def setUp(self):
+        self.sink = SMTPSink().start()
+        self.config = mock.patch.dict(app.config, {
+            'MAIL_SERVER': '127.0.0.1',
+            'MAIL_PORT': self.sink.server_address[1], 'MAIL_USE_TLS': False, 'MAIL_WORKERS': 2, 'MAIL_BATCH_SIZE': 5,
+            'MAIL_RETRY_BACKOFF': 0})
+        self.config.start()
+        mail.init_app(app)
+        self.app_context = app.app_context()
+        self.app_context.push()
+        self.pool = MailPool()
+
+    def tearDown(self):
+        self.pool.shutdown(timeout=5)
+        self.app_context.pop()
+        self.config.stop()
+        mail.init_app(app)
+        self.sink.stop()
+
+    def message(self, n):
+        msg = Message('Message {}'.format(n), sender='admin@example.com',
+                      recipients=['user{}@example.com'.format(n)])
+        msg.body = 'hello'
+        return msg
+
+    def test_batches_over_persistent_connections(self):
+        for n in range(20):
+            self.assertTrue(self.pool.submit(self.message(n)))
+        self.pool.shutdown(timeout=5)
+        self.assertEqual(self.sink.messages, 20)
+        self.assertLessEqual(self.sink.connections, 2)
+        self.assertEqual(self.pool.stats['sent'], 20)
+        # drained pools refuse new mail
+        self.assertFalse(self.pool.submit(self.message(21)))
+
+    def test_shutdown_stops_every_worker(self):
+        # a batch ends at its first STOP, leaving the rest for other workers
+        idle = MailPool()
+        with mock.patch.object(MailPool, 'run'):
+            idle.start()
+        for msg in (self.message(1), email.STOP, email.STOP):
+            idle.queue.put(msg)
+        self.assertEqual(len(idle.batch()), 2)
+        self.assertEqual(idle.batch(), [email.STOP])
+
+        app.config['MAIL_WORKERS'] = 4
+        self.pool.start()
+        workers = list(self.pool.workers)
+        self.pool.shutdown(timeout=5)
+        self.assertFalse(any(thread.is_alive() for thread in workers))
+
+    def test_backpressure(self):
+        app.config.update(MAIL_QUEUE_SIZE=1, MAIL_QUEUE_TIMEOUT=0.01)
+        with mock.patch.object(MailPool, 'run'):
+            self.assertTrue(self.pool.submit(self.message(1)))
+            self.assertFalse(self.pool.submit(self.message(2)))
+        self.assertEqual(self.pool.stats['refused'], 1)
+        self.pool.queue.get_nowait()
+
+    def test_retry_transient_failures(self):
+        connection = mock.MagicMock()
+        connection.send.side_effect = [
+            smtplib.SMTPServerDisconnected('gone'), None,
+            smtplib.SMTPRecipientsRefused({})]
+        with mock.patch.object(mail, 'connect', return_value=connection):
+            self.assertIs(self.pool.deliver(None, self.message(1)),
+                          connection)
+            self.assertIsNone(self.pool.deliver(connection,
+                                                self.message(2)))
+        self.assertEqual((self.pool.stats['retries'],
+                          self.pool.stats['sent'],
+                          self.pool.stats['failed']), (1, 1, 1))
+
+
+class JobQueueCase(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.calls = []
+        jobs.handlers['test'] = self.handler
+
+    def tearDown(self):
+        del jobs.handlers['test']
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def handler(self, item_id, fail=False):
+        self.calls.append(item_id)
+        if fail:
+            raise ValueError('boom')
+
+    def test_enqueue_collapses_queued_jobs(self):
+        j1 = jobs.enqueue('test', key='item1', item_id='item1')
+        j2 = jobs.enqueue('test', key='item1', item_id='item1')
+        j3 = jobs.enqueue('test', key='item2', item_id='item2')
+        self.assertEqual(j1.id, j2.id)
+        self.assertNotEqual(j1.id, j3.id)
+        self.assertEqual(jobs.work_off(), 2)
+        self.assertEqual(sorted(self.calls), ['item1', 'item2'])
+        self.assertEqual(Job.query.get(j1.id).status, 'done')
+
+        # once claimed, a new webhook queues a fresh job
+        j4 = jobs.enqueue('test', key='item1', item_id='item1')
+        self.assertNotEqual(j1.id, j4.id)
+
+    def test_retry_with_backoff(self):
+        app.config['JOB_MAX_ATTEMPTS'] = 2
+        try:
+            j = jobs.enqueue('test', item_id='item1', fail=True)
+        finally:
+            app.config['JOB_MAX_ATTEMPTS'] = 5
+        jobs.run_job(jobs.claim())
+        j = Job.query.get(j.id)
+        self.assertEqual((j.status, j.attempts), ('queued', 1))
+        self.assertGreater(j.run_at, datetime.utcnow())
+        self.assertIn('boom', j.last_error)
+        self.assertIsNone(jobs.claim())
+
+        j.run_at = datetime.utcnow()
+        db.session.commit()
+        jobs.run_job(jobs.claim())
+        self.assertEqual(Job.query.get(j.id).status, 'failed')
+
+    def test_retry_keeps_its_key(self):
+        j = jobs.enqueue('test', key='item1', item_id='item1', fail=True)
+        jobs.run_job(jobs.claim())
+        # new webhooks still collapse into the pending retry
+        self.assertEqual(jobs.enqueue('test', key='item1', item_id='item1',
+                                      fail=True).id, j.id)
+        self.assertEqual(Job.query.get(j.id).status, 'queued')
+
+        # a retry that finds a fresh job queued while it ran gives way to it
+        j.run_at = datetime.utcnow()
+        db.session.commit()
+        claimed = jobs.claim()
+        fresh = jobs.enqueue('test', key='item1', item_id='item1')
+        jobs.run_job(claimed)
+        self.assertEqual(Job.query.get(j.id).status, 'superseded')
+        self.assertEqual(Job.query.get(fresh.id).status, 'queued')
+
+    def test_lease_renewed_while_running(self):
+        reclaimed = []
+
+        def slow(item_id):
+            time.sleep(0.5)
+            reclaimed.append(jobs.claim())
+        jobs.handlers['slow'] = slow
+        app.config['JOB_VISIBILITY_TIMEOUT'] = 0.2
+        try:
+            j = jobs.enqueue('slow', item_id='item1')
+            jobs.run_job(jobs.claim())
+        finally:
+            app.config['JOB_VISIBILITY_TIMEOUT'] = 300
+            del jobs.handlers['slow']
+        self.assertEqual(reclaimed, [None])
+        self.assertEqual(Job.query.get(j.id).status, 'done')
+
+    def test_visibility_timeout(self):
+        j = jobs.enqueue('test', item_id='item1')
+        claimed = jobs.claim()
+        self.assertEqual(claimed.id, j.id)
+        self.assertIsNone(jobs.claim())
+
+        # the first worker died; its lease expires and the job is reclaimed
+        claimed.locked_until = datetime.utcnow() - timedelta(seconds=1)
+        db.session.commit()
+        reclaimed = jobs.claim()
+        self.assertEqual((reclaimed.id, reclaimed.attempts), (j.id, 2))
+        jobs.run_job(reclaimed)
+        self.assertEqual(Job.query.get(j.id).status, 'done')
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
\ No newline at end of file